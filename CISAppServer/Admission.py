@@ -0,0 +1,304 @@
+# -*- coding: UTF-8 -*-
+"""
+Module with the admission controller of new jobs.
+
+The controller keeps the number of free job slots (global and per service),
+the free quota per service and the free space of the output file system as
+tokens in memory. Tokens are consumed when a job is admitted and updated from
+job state transitions reported by JobManager. Transitions that happen in the
+worker processes are reported when the worker finishes. The tokens are
+resynchronised with the DB only every few iterations and only while no
+workers are running.
+"""
+
+import os
+import heapq
+import logging
+
+from Config import conf, VERBOSE
+from Jobs import JobState, ACTIVE_STATES
+
+logger = logging.getLogger(__name__)
+
+#: Result of :py:meth:`AdmissionController.admit`: job may be submitted
+ADMIT = 0
+#: Result of :py:meth:`AdmissionController.admit`: no free job slots
+NO_SLOTS = 1
+#: Result of :py:meth:`AdmissionController.admit`: quota exceeded
+NO_QUOTA = 2
+
+
+class AdmissionController(object):
+    """
+    Token based accounting of job slots and quota used to decide which
+    waiting jobs may be submitted.
+    """
+
+    def __init__(self, services):
+        """
+        :param services: dict with Service instances (ServiceStore).
+        """
+        self.services = services
+        #: Free global job slots
+        self.slots = 0
+        #: Free job slots per service
+        self.service_slots = {}
+        #: Free quota per service in bytes
+        self.service_quota = {}
+        #: Free space of the output file system in bytes
+        self.hard_quota = 0
+        #: Number of sync calls left before the tokens are reloaded from DB
+        self.steps = 0
+
+    def invalidate(self):
+        """ Force the resync of tokens on the next :py:meth:`sync` call. """
+        self.steps = 0
+
+    def sync(self, counters):
+        """
+        Reload tokens if the resync is due.
+
+        :param counters: callable returning a list of tuples (service, active
+            job count, used quota), e.g.
+            :py:meth:`StateManager.get_service_counters`.
+        :return: True if the tokens were reloaded.
+        """
+        if self.steps > 0:
+            self.steps -= 1
+            return False
+
+        _active = 0
+        self.service_slots = {}
+        self.service_quota = {}
+        for _name, _service in self.services.items():
+            self.service_slots[_name] = _service.config['max_jobs']
+            self.service_quota[_name] = _service.config['quota']
+        for (_name, _count, _size) in counters():
+            _active += _count
+            if _name in self.service_slots:
+                self.service_slots[_name] -= _count
+                self.service_quota[_name] -= _size
+        self.slots = conf.config_max_jobs - _active
+
+        _stat = os.statvfs(conf.gate_path_output)
+        self.hard_quota = _stat.f_frsize * _stat.f_bavail
+
+        self.steps = conf.config_admission_step - 1
+        logger.log(VERBOSE, '@Admission - Free job slots: %s, service slots: '
+                   '%s.', self.slots, self.service_slots)
+        return True
+
+    def admit(self, service):
+        """
+        Check if a job of a service may be submitted and consume its tokens.
+
+        :param service: name of the service.
+        :return: ADMIT, NO_SLOTS or NO_QUOTA.
+        """
+        if self.slots <= 0 or self.service_slots[service] <= 0:
+            return NO_SLOTS
+        _size = self.services[service].config['job_size']
+        if self.service_quota[service] < _size or self.hard_quota < _size:
+            return NO_QUOTA
+        self.slots -= 1
+        self.service_slots[service] -= 1
+        self.service_quota[service] -= _size
+        self.hard_quota -= _size
+        return ADMIT
+
+    def transition(self, service, old_state, new_state):
+        """
+        Update slot tokens after a job state change (queue, finish, exit).
+
+        :param service: name of the service.
+        :param old_state: job state before the change.
+        :param new_state: job state after the change.
+        """
+        _delta = int(old_state in ACTIVE_STATES) - \
+            int(new_state in ACTIVE_STATES)
+        if not _delta:
+            return
+        self.slots += _delta
+        if service in self.service_slots:
+            self.service_slots[service] += _delta
+
+    def release(self, service, size):
+        """
+        Return quota of a removed job.
+
+        :param service: name of the service.
+        :param size: size of the job output in bytes.
+        """
+        if service in self.service_quota:
+            self.service_quota[service] += size
+        self.hard_quota += size
+
+    def has_slots(self, service=None):
+        """
+        Check if there are free job slots.
+
+        :param service: if specified check slots of the service too.
+        """
+        if self.slots <= 0:
+            return False
+        return service is None or self.service_slots.get(service, 0) > 0
+
+    def ready(self, jobs):
+        """
+        Iterate over jobs that may be considered for admission.
+
+        Jobs are grouped in per service queues. Services without free slots
+        are skipped at once and iteration stops when no global slots are
+        left. Jobs are returned in the order of the input list (submit time)
+        across services.
+
+        :param jobs: list of Job instances sorted by submit time.
+        """
+        _queues = {}
+        for _i, _job in enumerate(jobs):
+            _queues.setdefault(_job.status.service, []).append((_i, _job))
+        _heap = []
+        for _name, _queue in _queues.items():
+            if self.has_slots(_name):
+                _queue.reverse()
+                _heap.append((_queue[-1][0], _name, _queue))
+        heapq.heapify(_heap)
+        while _heap and self.slots > 0:
+            _i, _name, _queue = _heap[0]
+            _job = _queue.pop()[1]
+            yield _job
+            if _queue and self.has_slots(_name):
+                heapq.heapreplace(_heap, (_queue[-1][0], _name, _queue))
+            else:
+                heapq.heappop(_heap)
+
+
+class WaitQueue(object):
+    """
+    Jobs parked with wait flags (FLAG_WAIT_INPUT, FLAG_WAIT_QUOTA) ordered by
+    the expiry of their wait time.
+
+    Parked jobs are not considered for admission until their wait time
+    expires or they are woken up early (freed quota, new input). Woken jobs
+    are remembered until they are admitted, so that they do not wait again if
+    no job slot is free when they are visited.
+    """
+
+    def __init__(self):
+        #: Heap of (expiry, job ID). Entries of removed jobs are dropped lazily
+        self.heap = []
+        #: Parked jobs: {job ID: (expiry, service, wait flags)}
+        self.parked = {}
+        #: IDs of parked jobs per service
+        self.services = {}
+        #: IDs of parked jobs per wait flag
+        self.flags = {JobState.FLAG_WAIT_INPUT: set(),
+                      JobState.FLAG_WAIT_QUOTA: set()}
+        #: IDs of jobs woken up but not admitted yet
+        self.woken = set()
+
+    def __len__(self):
+        return len(self.parked)
+
+    def __contains__(self, job_id):
+        return job_id in self.parked
+
+    def park(self, job_id, service, expiry, flags):
+        """
+        Park a job until expiry.
+
+        :param flags: wait flags of the job.
+        """
+        self.discard(job_id)
+        self.parked[job_id] = (expiry, service, flags)
+        self.services.setdefault(service, set()).add(job_id)
+        for _flag, _ids in self.flags.items():
+            if flags & _flag:
+                _ids.add(job_id)
+        heapq.heappush(self.heap, (expiry, job_id))
+
+    def discard(self, job_id):
+        """ Forget a job, e.g. when it is removed. """
+        self.woken.discard(job_id)
+        self.__remove(job_id)
+
+    def expire(self, now):
+        """
+        Wake up jobs whose wait time expired.
+
+        :param now: current time.
+        :return: number of woken jobs.
+        """
+        _n = 0
+        while self.heap and self.heap[0][0] <= now:
+            _expiry, _jid = heapq.heappop(self.heap)
+            _entry = self.parked.get(_jid)
+            if _entry is None or _entry[0] != _expiry:
+                continue
+            self.__remove(_jid)
+            self.woken.add(_jid)
+            _n += 1
+        return _n
+
+    def wake(self, job_ids, flag):
+        """
+        Wake up parked jobs waiting for flag.
+
+        :param job_ids: iterable with job IDs.
+        :param flag: FLAG_WAIT_INPUT or FLAG_WAIT_QUOTA.
+        :return: number of woken jobs.
+        """
+        _n = 0
+        for _jid in job_ids:
+            _entry = self.parked.get(_jid)
+            if _entry is None or not _entry[2] & flag:
+                continue
+            self.__remove(_jid)
+            self.woken.add(_jid)
+            _n += 1
+        return _n
+
+    def wake_service(self, service, flag):
+        """
+        Wake up parked jobs of a service waiting for flag.
+
+        :return: number of woken jobs.
+        """
+        return self.wake(list(self.services.get(service, ())), flag)
+
+    def waiting_for(self, flag):
+        """
+        Get IDs of parked jobs waiting for flag.
+
+        :return: set of job IDs.
+        """
+        return self.flags[flag]
+
+    def is_woken(self, job_id):
+        """
+        Check if a job was woken up and was not admitted yet.
+
+        :return: True if the job was woken up.
+        """
+        return job_id in self.woken
+
+    def pop_woken(self, job_id):
+        """
+        Check if a job was woken up and forget it.
+
+        :return: True if the job was woken up.
+        """
+        if job_id in self.woken:
+            self.woken.discard(job_id)
+            return True
+        return False
+
+    def __remove(self, job_id):
+        _entry = self.parked.pop(job_id, None)
+        if _entry is not None:
+            _ids = self.services[_entry[1]]
+            _ids.discard(job_id)
+            if not _ids:
+                del self.services[_entry[1]]
+            for _ids in self.flags.values():
+                _ids.discard(job_id)
@@ -116,6 +116,8 @@ class Config(dict):
         self.config_progress_step = 1
         #: Every n-th status query run garbage collector
         self.config_garbage_step = 5
+        #: Every n-th status query resync job slots and quota with the DB
+        self.config_admission_step = 10
         #: Timeout for job cleanup before forcing shutdown
         self.config_shutdown_time = 2
         #: Timeout for jobs with wait flag in seconds (Job with wait flag will
@@ -206,13 +208,21 @@ class Config(dict):
         self.pbs_max_jobs = 100  #: Maximum number of concurent PBS jobs
         #: Timeout in seconds for PBS commands (qstat, qsub, qdel)
         self.pbs_timeout = 60
+        #: Interval in seconds between qstat runs of the background poller
+        self.pbs_poll_interval = 5
+        #: Maximum number of concurrent qstat calls (one per service user)
+        self.pbs_poll_threads = 4
+        #: Maximum number of jobs submitted by a single shell running qsub
+        self.pbs_submit_batch = 50
         #: Path where SSH backend will store job IDs
         self.ssh_path_queue = 'SSH/Queue'
         #: Path where SSH backeng will create job working directories
         self.ssh_path_work = 'SSH/Scratch'
         #: Name of default SSH execution host
         self.ssh_default_queue = 'localhost'
-        #: Maximum number of concurent jobs per SSH execution host
+        #: Maximum number of concurent jobs per SSH execution host. The limits
+        #: are summed up into one limit shared by all hosts, so a single host
+        #: can take all job slots.
         self.ssh_max_jobs = {
             'localhost': 2
         }
@@ -224,12 +234,42 @@ class Config(dict):
                     os.path.join(os.environ["HOME"], ".ssh"),
                     "known_hosts"
                 )
+        #: Timeout in seconds for establishing SSH connections
+        self.ssh_connect_timeout = 30
+        #: Maximum number of concurrent sessions (commands) per SSH connection
+        self.ssh_max_sessions = 8
+        #: Interval in seconds of keepalive packets sent over idle SSH
+        #: connections. Dead connections are detected and replaced
+        self.ssh_keepalive = 30
+        #: Delay in seconds before reconnecting to a failed SSH host. Doubled
+        #: after every failed attempt up to ssh_backoff_max
+        self.ssh_backoff = 5
+        #: Maximum delay in seconds between reconnection attempts
+        self.ssh_backoff_max = 300
+        #: Timeout in seconds for job status checks of SSH execution hosts
+        self.ssh_timeout = 60
+        #: Maximum number of SSH execution hosts checked concurrently
+        self.ssh_poll_threads = 8
+        #: Maximum number of jobs submitted by a single shsub call
+        self.ssh_submit_batch = 50
+        #: Path where local backend will store job exit codes
+        self.local_path_queue = 'Local/Queue'
+        #: Path where local backend will create job working directories
+        self.local_path_work = 'Local/Scratch'
+        #: Maximum number of concurent local jobs
+        self.local_max_jobs = 4
+        #: Timeout in seconds for starting local jobs
+        self.local_timeout = 60
         self.dummy_max_jobs = 100  #: Maximum number of concurent Dummy jobs
         self.dummy_turbo = False  #: Dummy scheduler turbo mode - all jobs finish instantly
         #: Path with services configuration files
         self.service_path_conf = 'Services'
         #: Path with services scripts and input files
         self.service_path_data = 'Services/Data'
+        #: Hardlink service data files without template markup into job work
+        #: directories instead of copying them. Jobs must not modify such
+        #: files in place as they are shared with the service data directory
+        self.service_data_hardlink = False
         #: Valid job states as well as names of directories on shared storage
         #: that are used to monitor job states
         self.service_states = (
@@ -250,6 +290,13 @@ class Config(dict):
         self.service_schedulers = ('pbs', 'ssh', 'dummy')
         #: Default scheduler
         self.service_default_scheduler = 'pbs'
+        #: Additional scheduler classes: {scheduler name: "module.Class"}.
+        #: The modules have to be importable by AppServer
+        self.scheduler_classes = {}
+        #: Scheduler settings overrides: {scheduler name: {setting: value}}.
+        #: Supported settings: default_queue, max_jobs, pool_size, batch_size
+        #: and poll_interval
+        self.scheduler_options = {}
         #: Default user name for job execution
         self.service_username = 'apprunner'
         #: Default job minimum lifetime in hours (supports fractions). Jobs
@@ -271,6 +318,14 @@ class Config(dict):
         #: Default expected output size of a job in MB. It is used to estimate
         #: space requirements for jobs that are to be scheduled.
         self.service_job_size = 50
+        #: Default method of chaining output of finished jobs as job input:
+        #: "copy", "reflink" (clone files where the file system supports it,
+        #: copy otherwise), "hardlink" or "symlink". Files linked with
+        #: "hardlink" and "symlink" are made read-only to protect the output
+        #: of the chained job. Writable files of other users are copied.
+        #: "symlink" leaves dangling links if the source job is deleted while
+        #: the chained job runs
+        self.service_chain_mode = 'copy'
         #: Default scheduler
         self.service_scheduler = 'pbs'
         #: Limit of nested Object type variables
@@ -281,15 +336,41 @@ class Config(dict):
         self.gate_path_shared = 'Shared'
         #: Path where jobs output will be stored
         self.gate_path_output = 'Output'
+        #: Path where AppGW stores job input files (one directory per job)
+        self.gate_path_input = 'Input'
         #: Path where jobs output is moved before removal (aleviates problems
         #: with files that are still in use)
         self.gate_path_dump = 'Dump'
+        #: Maximum number of files removed from gate_path_dump per second
+        #: (0 - no limit)
+        self.gate_dump_files_rate = 2000
+        #: Maximum number of bytes removed from gate_path_dump per second
+        #: (0 - no limit)
+        self.gate_dump_bytes_rate = 0
+        #: Interval in seconds between checks of empty gate_path_dump and
+        #: retries of entries that could not be removed
+        self.gate_dump_interval = 10
+        #: Mode of AppGW directories monitoring: "poll" - list the directories
+        #: every iteration (works on network file systems), "inotify" - react
+        #: to file system events (local file systems only, falls back to
+        #: "poll" if inotify is not available)
+        self.gate_watch_mode = 'poll'
+        #: Minimal interval in seconds between main loop iterations when woken
+        #: up by AppGW events
+        self.gate_watch_interval = 0.5
+        #: Format of job status records passed to AppGW: "files" - separate
+        #: files in opts and time directories, "json" - one JSON record per
+        #: job in the status directory. State and flag symlinks are created in
+        #: both cases
+        self.gate_status_format = 'files'
         #: Path where jobs description is stored
         self.gate_path_jobs = None
         #: Path where jobs internal state is stored
         self.gate_path_opts = None
         #: Path where job timestamps are stored
         self.gate_path_time = None
+        #: Path where job status records are stored (json status format)
+        self.gate_path_status = None
         #: Path where new jobs are symlinked
         self.gate_path_new = None
         #: Path where waiting jobs are symlinked
@@ -400,6 +481,7 @@ class Config(dict):
         self.gate_path_jobs = os.path.join(self.gate_path_shared, 'jobs')
         self.gate_path_opts = os.path.join(self.gate_path_shared, 'opts')
         self.gate_path_time = os.path.join(self.gate_path_shared, 'time')
+        self.gate_path_status = os.path.join(self.gate_path_shared, 'status')
         self.gate_path_flags = os.path.join(self.gate_path_shared, 'flags')
         self.gate_path_flag_stop = \
             os.path.join(self.gate_path_flags, 'stop')
@@ -448,10 +530,12 @@ class Config(dict):
             "daemon_path_workdir",
             "gate_path_shared",
             "gate_path_output",
+            "gate_path_input",
             "gate_path_dump",
             "gate_path_jobs",
             "gate_path_opts",
             "gate_path_time",
+            "gate_path_status",
             "gate_path_flags",
             "gate_path_flag_stop",
             "gate_path_flag_delete",
@@ -470,10 +554,7 @@ class Config(dict):
             "gate_path_aborted",
             "gate_path_killed",
         ]
-        if 'pbs' in self.service_schedulers:
-            _mkdirs.extend(("pbs_path_queue", "pbs_path_work"))
-        if 'ssh' in self.service_schedulers:
-            _mkdirs.extend(("ssh_path_queue", "ssh_path_work"))
+        # Directories of the schedulers are created by SchedulerStore.init
         for _path in _mkdirs:
             if not os.path.isdir(self[_path]):
                 self.mkdir_p(self[_path])
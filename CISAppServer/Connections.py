@@ -0,0 +1,243 @@
+# -*- coding: UTF-8 -*-
+"""
+Module with the pool of SSH connections to execution hosts.
+
+One connection is kept per login (user@host) and shared by many concurrent
+sessions (SSH channels) up to ssh_max_sessions. Every login has its own lock,
+so a slow or unreachable host does not stall commands run on the others.
+Dead connections are detected by paramiko keepalive and replaced on the next
+use. Failed connection attempts are retried with an exponential backoff.
+"""
+
+import time
+import threading
+import logging
+import spur
+
+from Config import conf, VERBOSE
+
+logger = logging.getLogger(__name__)
+
+
+class SshPoolError(Exception):
+    """ Connection to an execution host is not available. """
+
+
+def create_shell(host_name, user_name):
+    """
+    Create a new spur SSH shell. The connection is not established yet.
+
+    :param host_name: execution host name.
+    :param user_name: user name.
+    :return: spur.SshShell instance.
+    """
+    try:
+        return spur.SshShell(  # Assume default private key is valid
+            hostname=host_name,
+            username=user_name,
+            connect_timeout=conf.ssh_connect_timeout,
+            # Workaround for paramiko not understanding host ecdsa keys.
+            # @TODO If possible disable such keys on sshd at host and
+            # remove this from production code.
+            missing_host_key=spur.ssh.MissingHostKey.accept,
+            # Hack to speedup connection setup - use a minimal known_hosts
+            # file - requires a patch for spur. Patch in Scripts directory
+            known_hosts_file=conf.ssh_known_hosts
+        )
+    except TypeError:  # Fallback when spur is not patched
+        return spur.SshShell(  # Assume default private key is valid
+            hostname=host_name,
+            username=user_name,
+            connect_timeout=conf.ssh_connect_timeout,
+            # Workaround for paramiko not understanding host ecdsa keys.
+            # @TODO If possible disable such keys on sshd at host and
+            # remove this from production code.
+            missing_host_key=spur.ssh.MissingHostKey.accept
+        )
+
+
+def is_alive(shell):
+    """
+    Check if the connection of a spur.SshShell is still active.
+
+    :param shell: spur.SshShell instance.
+    """
+    _client = getattr(shell, '_client', None)
+    if _client is None:
+        return False
+    _transport = _client.get_transport()
+    return _transport is not None and _transport.is_active()
+
+
+class SshLogin(object):
+    """
+    Connection of a single login with its lock, session limit and metrics.
+    """
+
+    def __init__(self, host_name, user_name):
+        #: Execution host name
+        self.host_name = host_name
+        #: User name
+        self.user_name = user_name
+        #: Lock guarding connection setup
+        self.lock = threading.Lock()
+        #: Limit of concurrent sessions
+        self.sessions = threading.BoundedSemaphore(conf.ssh_max_sessions)
+        #: Connected spur.SshShell instance
+        self.shell = None
+        #: Number of consecutive failed connection attempts
+        self.failures = 0
+        #: Time before which no new connection attempt is made
+        self.retry_time = 0
+        #: Counters: connects, failures, commands, errors, active
+        self.metrics = dict.fromkeys(
+            ('connects', 'failures', 'commands', 'errors', 'active'), 0)
+
+
+class SshConnectionPool(object):
+    """
+    Pool of SSH connections to execution hosts.
+    """
+
+    def __init__(self, factory=create_shell):
+        """
+        :param factory: callable(host_name, user_name) creating new
+            spur.SshShell instances.
+        """
+        #: Shell factory
+        self.factory = factory
+        #: Logins: {user@host: :py:class:`SshLogin`}
+        self.logins = {}
+        #: Lock guarding the logins dict only
+        self.lock = threading.Lock()
+
+    def run(self, host_name, user_name, command, stdin=None, **kwargs):
+        """
+        Run a command on an execution host.
+
+        The command is retried once on a fresh connection if the session
+        could not be opened (the command did not start).
+
+        :param host_name: execution host name.
+        :param user_name: user name.
+        :param command: list with the command and its arguments.
+        :param stdin: string written to the standard input of the command.
+            The input is not closed, the command should read only what it
+            expects.
+        :param kwargs: passed to spur.SshShell.run.
+        :return: spur ExecutionResult.
+        """
+        _login = self.__get_login(host_name, user_name)
+        with _login.sessions:
+            _login.metrics['active'] += 1
+            try:
+                for _retry in (True, False):
+                    _shell = self.__connect(_login)
+                    try:
+                        _login.metrics['commands'] += 1
+                        if stdin is None:
+                            return _shell.run(command, **kwargs)
+                        _process = _shell.spawn(command, **kwargs)
+                        _process.stdin_write(stdin)
+                        return _process.wait_for_result()
+                    except spur.ssh.ConnectionError:
+                        _login.metrics['errors'] += 1
+                        self.__drop(_login, _shell)
+                        if not _retry:
+                            raise
+                        logger.warning("@SSH - Connection to %s@%s lost. "
+                                       "Reconnecting.", user_name, host_name)
+                    except:
+                        _login.metrics['errors'] += 1
+                        raise
+            finally:
+                _login.metrics['active'] -= 1
+
+    def metrics(self):
+        """
+        Get pool metrics.
+
+        :return: dict {user@host: dict with counters and connection state}.
+        """
+        _metrics = {}
+        for _name, _login in self.logins.items():
+            _metrics[_name] = dict(_login.metrics,
+                                   connected=_login.shell is not None,
+                                   backoff=max(0, _login.retry_time -
+                                               time.time()))
+        return _metrics
+
+    def close(self):
+        """ Close all connections. """
+        with self.lock:
+            _logins = self.logins.values()
+            self.logins = {}
+        for _login in _logins:
+            with _login.lock:
+                if _login.shell is not None:
+                    self.__close(_login.shell)
+                    _login.shell = None
+
+    def __get_login(self, host_name, user_name):
+        _name = "%s@%s" % (user_name, host_name)
+        with self.lock:
+            if _name not in self.logins:
+                self.logins[_name] = SshLogin(host_name, user_name)
+            return self.logins[_name]
+
+    def __connect(self, login):
+        """
+        Get a live connection of a login, connect if required.
+
+        :raises SshPoolError: if the connection is in backoff.
+        """
+        with login.lock:
+            if login.shell is not None:
+                if is_alive(login.shell):
+                    return login.shell
+                logger.warning("@SSH - Connection to %s@%s is dead.",
+                               login.user_name, login.host_name)
+                self.__close(login.shell)
+                login.shell = None
+
+            if time.time() < login.retry_time:
+                raise SshPoolError(
+                    "Connection to %s@%s failed %s times. Next retry in %.0fs."
+                    % (login.user_name, login.host_name, login.failures,
+                       login.retry_time - time.time()))
+
+            logger.log(VERBOSE, "@SSH - Create new SSH connection %s@%s.",
+                       login.user_name, login.host_name)
+            try:
+                _shell = self.factory(login.host_name, login.user_name)
+                # Establish the connection without running any command
+                _transport = _shell._get_ssh_transport()
+                _transport.set_keepalive(conf.ssh_keepalive)
+            except:
+                login.failures += 1
+                login.metrics['failures'] += 1
+                login.retry_time = time.time() + min(
+                    conf.ssh_backoff_max,
+                    conf.ssh_backoff * 2 ** (login.failures - 1))
+                raise
+            login.failures = 0
+            login.retry_time = 0
+            login.metrics['connects'] += 1
+            login.shell = _shell
+            logger.log(VERBOSE, "@SSH - SSH connection ready.")
+            return _shell
+
+    def __drop(self, login, shell):
+        """ Forget a broken connection unless it was already replaced. """
+        with login.lock:
+            if login.shell is shell:
+                login.shell = None
+        self.__close(shell)
+
+    def __close(self, shell):
+        try:
+            shell.close()
+        except:
+            logger.log(VERBOSE, "@SSH - Unable to close connection.",
+                       exc_info=True)
+
@@ -0,0 +1,210 @@
+# -*- coding: UTF-8 -*-
+"""
+Module with helpers used to propagate job state changes to AppGateway.
+
+Job state is exposed to AppGateway through the shared file system: symlinks in
+state and flag directories, time stamp files and files with auxiliary info.
+Changes are collected in a batch and applied in one pass grouped per directory
+so that every change costs as few system calls as possible.
+"""
+
+import os
+import json
+import errno
+import fcntl
+import logging
+
+from Config import VERBOSE
+
+logger = logging.getLogger(__name__)
+
+#: Version of the layout of job status records
+RECORD_VERSION = 1
+
+
+class GatewayBatch(object):
+    """
+    Batch of file system operations that propagate job state changes to the
+    AppGW.
+
+    Operations are registered per directory and executed by :py:meth:`execute`.
+    Symlinks that already exist and files that are already removed are not
+    treated as errors, so no existence checks are needed.
+    """
+
+    def __init__(self):
+        #: Symlinks to create: {directory: {name: target}}
+        self.links = {}
+        #: Entries to remove: {directory: set(name)}
+        self.unlinks = {}
+        #: Files to write: {directory: {name: contents}}
+        self.files = {}
+        #: Time stamps to set: {directory: {name: UNIX time stamp}}
+        self.stamps = {}
+        #: Status record fields to update: {directory: {name: {field: value}}}
+        self.records = {}
+        #: Number of failed operations in the last execute call
+        self.errors = 0
+
+    def __len__(self):
+        return sum(len(_ops) for _group in
+                   (self.links, self.unlinks, self.files, self.stamps,
+                    self.records)
+                   for _ops in _group.values())
+
+    def link(self, path, name, target):
+        """
+        Create symlink path/name pointing to target.
+
+        Overrides a pending removal of the same entry.
+        """
+        self.links.setdefault(path, {})[name] = target
+        if name in self.unlinks.get(path, ()):
+            self.unlinks[path].discard(name)
+
+    def unlink(self, path, name):
+        """
+        Remove path/name.
+
+        Overrides a pending creation of the same entry.
+        """
+        self.unlinks.setdefault(path, set()).add(name)
+        for _group in (self.links, self.files, self.stamps, self.records):
+            if path in _group:
+                _group[path].pop(name, None)
+
+    def write(self, path, name, data):
+        """ Store data in the file path/name. """
+        self.files.setdefault(path, {})[name] = data
+        if name in self.unlinks.get(path, ()):
+            self.unlinks[path].discard(name)
+
+    def touch(self, path, name, tstamp):
+        """
+        Create file path/name and set its access and modification time.
+
+        :param tstamp: UNIX time stamp.
+        """
+        self.stamps.setdefault(path, {})[name] = tstamp
+        if name in self.unlinks.get(path, ()):
+            self.unlinks[path].discard(name)
+
+    def update(self, path, name, fields):
+        """
+        Update fields of the JSON status record path/name.
+
+        The record is created if it does not exist and replaced atomically.
+        Updates of the same record are merged. Concurrent updates from other
+        processes are serialised with a lock on the directory.
+
+        :param fields: dict with the new values of record fields.
+        """
+        self.records.setdefault(path, {}).setdefault(name, {}).update(fields)
+        if name in self.unlinks.get(path, ()):
+            self.unlinks[path].discard(name)
+
+    def execute(self):
+        """
+        Apply all registered operations and reset the batch.
+
+        New entries are created before the old ones are removed, so that a job
+        is always visible in at least one state directory. Errors are logged
+        and do not stop the remaining operations.
+
+        :return: number of failed operations.
+        """
+        self.errors = 0
+        for _path, _ops in sorted(self.links.items()):
+            for _name, _target in _ops.items():
+                self.__call(os.symlink, errno.EEXIST, _target,
+                            os.path.join(_path, _name))
+        for _path, _ops in sorted(self.files.items()):
+            for _name, _data in _ops.items():
+                self.__call(self.__write, None, os.path.join(_path, _name),
+                            _data)
+        for _path, _ops in sorted(self.stamps.items()):
+            for _name, _tstamp in _ops.items():
+                self.__call(self.__touch, None, os.path.join(_path, _name),
+                            _tstamp)
+        for _path, _ops in sorted(self.records.items()):
+            # Status records are updated by the main process and the workers.
+            # Serialise the updates with a lock on the directory.
+            try:
+                _lock = os.open(_path, os.O_RDONLY)
+            except OSError as e:
+                self.errors += len(_ops)
+                logger.error("@GatewayBatch - Unable to update %s: %s",
+                             _path, e)
+                continue
+            try:
+                fcntl.flock(_lock, fcntl.LOCK_EX)
+                for _name, _fields in _ops.items():
+                    self.__call(self.__update, None, _path, _name, _fields)
+            finally:
+                os.close(_lock)
+        for _path, _ops in sorted(self.unlinks.items()):
+            for _name in _ops:
+                self.__call(os.unlink, errno.ENOENT,
+                            os.path.join(_path, _name))
+
+        logger.log(VERBOSE, "@GatewayBatch - Applied %s operations (%s "
+                   "failed).", len(self), self.errors)
+        self.links = {}
+        self.unlinks = {}
+        self.files = {}
+        self.stamps = {}
+        self.records = {}
+        return self.errors
+
+    def __call(self, method, ignore, *args):
+        """ Call method(*args), log errors other than ignored errno. """
+        try:
+            method(*args)
+        except (OSError, IOError) as e:
+            if e.errno == ignore:
+                return
+            self.errors += 1
+            logger.error("@GatewayBatch - Unable to update %s: %s",
+                         args[-1] if method is os.symlink else args[0], e)
+        except ValueError as e:
+            self.errors += 1
+            logger.error("@GatewayBatch - Unable to update %s: %s",
+                         args[0], e)
+
+    @staticmethod
+    def __write(path, data):
+        _fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        try:
+            if isinstance(data, unicode):
+                data = data.encode('utf-8')
+            while data:
+                data = data[os.write(_fd, data):]
+        finally:
+            os.close(_fd)
+
+    @staticmethod
+    def __touch(path, tstamp):
+        os.close(os.open(path, os.O_WRONLY | os.O_CREAT, 0o666))
+        os.utime(path, (tstamp, tstamp))
+
+    @staticmethod
+    def __update(path, name, fields):
+        _name = os.path.join(path, name)
+        try:
+            with open(_name) as _f:
+                _record = json.load(_f)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            _record = {'version': RECORD_VERSION}
+        except ValueError:
+            logger.warning("@GatewayBatch - Corrupted status record %s. "
+                           "Will replace.", _name)
+            _record = {'version': RECORD_VERSION}
+        _record.update(fields)
+
+        # Write to a temporary file and rename it so that AppGW never reads a
+        # partial record
+        _tmp = os.path.join(path, '.%s.%d.tmp' % (name, os.getpid()))
+        GatewayBatch.__write(_tmp, json.dumps(_record))
+        os.rename(_tmp, _name)
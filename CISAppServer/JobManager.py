@@ -6,7 +6,6 @@ Main module of CISAppServer. Responsible for job management.
 
 import os
 import sys
-import shutil
 import time
 import logging
 import threading
@@ -18,8 +17,9 @@ from datetime import datetime, timedelta
 import Globals as G
 from Config import conf, VERBOSE, ExitCodes
 from Services import ValidatorInputFileError, ValidatorError, CisError
-from Schedulers import rmtree_error
 from Jobs import JobState
+from Admission import AdmissionController, WaitQueue, NO_SLOTS, NO_QUOTA
+from Reaper import DumpReaper, dump
 
 version = "0.9"
 
@@ -62,23 +62,39 @@ class JobManager(object):
         self.__w_counter_slots = {}
         for _s in G.SERVICE_STORE:
             self.__w_counter_slots[_s] = 0
+        # Job slots and quota accounting
+        self.__admission = AdmissionController(G.SERVICE_STORE)
+        # Jobs with wait flags parked until their wait time expires
+        self.__wait_queue = WaitQueue()
+        # Job input directories present at the last check
+        self.__input_list = None
         # Time stamp for the last iteration
         self.__time_stamp = datetime.utcnow()
         self.__timing = {}
+        # Scheduler job slots shared with the workers
+        self.__slots_step = 0
+        self.sync_slots()
+        _slots = G.SCHEDULER_STORE.get_slots()
         # Thread list
         self.__thread_lock = multiprocessing.Lock()
         self.__thread_pool_submit = multiprocessing.Pool(
                 processes = conf.config_max_threads,
                 initializer = worker_init,
-                initargs=(conf, "SubmitWorker", self.__thread_lock)
+                initargs=(conf, "SubmitWorker", self.__thread_lock, _slots)
                 )
         self.__thread_pool_cleanup = multiprocessing.Pool(
                 processes = conf.config_max_threads,
                 initializer = worker_init,
-                initargs=(conf, "CleanupWorker", self.__thread_lock)
+                initargs=(conf, "CleanupWorker", self.__thread_lock, _slots)
                 )
         self.__thread_list_submit = []
         self.__thread_list_cleanup = []
+        # Background removal of the dump directory
+        self.__reaper = DumpReaper(conf.gate_path_dump,
+                                   conf.gate_dump_files_rate,
+                                   conf.gate_dump_bytes_rate,
+                                   conf.gate_dump_interval)
+        self.__reaper.start()
 
     def clear(self):
         _start_time = datetime.utcnow()
@@ -93,6 +109,8 @@ class JobManager(object):
         self.__thread_pool_submit = None
         self.__thread_pool_cleanup = None
         logger.debug("Subprocesses closed")
+        self.__reaper.stop()
+        logger.debug("Dump reaper stopped: %s", self.__reaper.backlog())
 
         if self.__terminate:
             _job_list = []
@@ -141,67 +159,19 @@ class JobManager(object):
         _dt_final = timedelta(hours=conf.service_max_lifetime)
 
         logger.log(VERBOSE, '@JManager - Run query.')
-        # Count current active jobs
+        # Resync job slots and quota with the DB when due. Only when no
+        # workers are running, otherwise state changes already stored by a
+        # worker would be applied again when its result is collected.
         try:
-            _active_count = G.STATE_MANAGER.get_active_job_count()
+            if not self.__thread_list_submit and \
+                    not self.__thread_list_cleanup:
+                self.__admission.sync(G.STATE_MANAGER.get_service_counters)
         except:
             logger.error('Unable to contact with the DB.', exc_info=True)
             self.__timing["check_new_jobs"] = (datetime.utcnow() - _start_time).total_seconds()
             return
-
-        # Available job slots
-        _new_slots = conf.config_max_jobs - _active_count
-
-        logger.log(VERBOSE, 'Free job slots: %s.', _new_slots)
-
-        _stat_out = os.statvfs(conf.gate_path_output)
-        _hard_quota = _stat_out.f_frsize * _stat_out.f_bavail
-
-        # Available job slots per service
-        #_service_slots = {}
-        #for (_service_name, _service) in G.SERVICE_STORE.items():
-            # Count current active jobs
-            #_service_active_count = G.STATE_MANAGER.get_active_job_count(
-            #        service=_service_name)
-            # Available job slots
-            #_service_slots[_service_name] = _service.config['max_jobs'] - \
-            #        _service_active_count
-
         #TODO Add available job slots per scheduler - flag the jobs to wait
-        # Available job slots per service
-        try:
-            _counters = G.STATE_MANAGER.get_active_service_counters()
-        except:
-            logger.error('Unable to contact the DB.', exc_info=True)
-            self.__timing["check_new_jobs"] = (datetime.utcnow() - _start_time).total_seconds()
-            return
-        _service_jobs = { _key : 0 for _key in G.SERVICE_STORE }
-        for (_count, _key) in _counters:
-            _service_jobs[_key] = _count
-
-        # Available quota per service
-        try:
-            _counters = G.STATE_MANAGER.get_quota_service_counters()
-        except:
-            logger.error('Unable to contact the DB.', exc_info=True)
-            self.__timing["check_new_jobs"] = (datetime.utcnow() - _start_time).total_seconds()
-            return
-        _service_quota = {
-                _key : _service.config['quota'] for \
-                        _key, _service in G.SERVICE_STORE.items()
-                }
-        for (_count, _key) in _counters:
-            _service_quota[_key] -= _count
 
-        # Available job slots
-        _service_slots = {}
-        for (_service_name, _service) in G.SERVICE_STORE.items():
-            _service_slots[_service_name] = _service.config['max_jobs'] - \
-                    _service_jobs[_service_name]
-
-        logger.log(VERBOSE, '@JManager - Free service slots: %s.', _service_slots)
-
-        _i = 0
         _j = 0
         _batch = []
         try:
@@ -212,13 +182,44 @@ class JobManager(object):
             return
         if len(_job_list):
             logger.debug("Detected %s new jobs", len(_job_list))
-        for _job in _job_list:
-            if _job.get_flag(JobState.FLAG_DELETE):
+
+        # Wake up jobs whose wait time expired or whose input appeared
+        self.__wait_queue.expire(_now)
+        self.wake_input_jobs()
+        # Skip parked jobs
+        if len(self.__wait_queue):
+            _job_list = [_job for _job in _job_list
+                         if _job.id() not in self.__wait_queue]
+            logger.log(VERBOSE, '@JManager - Jobs in wait state: %s.',
+                       len(self.__wait_queue))
+
+        # Limit the number of warning messages about services without free
+        # job slots
+        _waiting = set(_job.status.service for _job in _job_list)
+        for _service_name in _waiting:
+            if self.__admission.has_slots(_service_name) or \
+                    not self.__admission.has_slots():
+                self.__w_counter_slots[_service_name] = 0
                 continue
+            if self.__w_counter_slots[_service_name] == 0:
+                logger.warning(
+                    "@JManager - All job slots in use for service %s." %
+                    _service_name
+                )
+            if self.__w_counter_slots[_service_name] > 9999:
+                logger.error(
+                    "@JManager - All job slots in use for service %s. "
+                    "Message repeated 10000 times." %
+                    _service_name
+                )
+                self.__w_counter_slots[_service_name] = 0
+            else:
+                self.__w_counter_slots[_service_name] += 1
 
-            # Check for job slots left
-            if _i >= _new_slots:
-                break
+        # Jobs of services with free slots in the order of submission
+        for _job in self.__admission.ready(_job_list):
+            if _job.get_flag(JobState.FLAG_DELETE):
+                continue
 
             # Check for unit of work time left
             if not self.__check_unit_timer():
@@ -242,24 +243,32 @@ class JobManager(object):
                     if _submit_time < _now:
                         _job.die("@JManager - Input file not available for "
                                  "job %s. Time out." % _job.id())
+                        self.__admission.transition(
+                            _job.status.service, 'waiting', _job.get_state())
+                        self.__wait_queue.discard(_job.id())
                         continue
 
-                # Check wait timeout
-                if _wait_input or _wait_quota:
+                # Check wait timeout. Jobs that were woken up do not have
+                # to wait any longer.
+                if (_wait_input or _wait_quota) and \
+                        not self.__wait_queue.is_woken(_job.id()):
                     _wait_time = _job.status.wait_time
                     _wait_time += _dt
                     if _wait_time > _now:
                         logger.log(VERBOSE,
                                 '@JManager - Job %s in wait state. End: %s, '
                                 'Now: %s.', _job.id(), _wait_time, _now)
+                        self.__wait_queue.park(
+                            _job.id(), _job.status.service, _wait_time,
+                            _job.status.flags)
                         continue
-                    else:
-                        logger.log(VERBOSE, '@JManager - Job %s wait finished.',
-                                _job.id())
-                        if _wait_input:
-                            _job.set_flag(JobState.FLAG_WAIT_INPUT, remove=True)
-                        if _wait_quota:
-                            _job.set_flag(JobState.FLAG_WAIT_QUOTA, remove=True)
+                if _wait_input or _wait_quota:
+                    logger.log(VERBOSE, '@JManager - Job %s wait finished.',
+                            _job.id())
+                    if _wait_input:
+                        _job.set_flag(JobState.FLAG_WAIT_INPUT, remove=True)
+                    if _wait_quota:
+                        _job.set_flag(JobState.FLAG_WAIT_QUOTA, remove=True)
             except:
                 logger.log(VERBOSE, '@JManager - Wait flag extraction failed '
                         'for job %s.', _job.id(), exc_info=True)
@@ -269,31 +278,12 @@ class JobManager(object):
 
             logger.debug('@JManager - Detected new job %s.', _job.id())
             _service_name = _job.status.service
-            _service = G.SERVICE_STORE[_service_name]
-            # Check available service slots
-            if _service_slots[_service_name] <= 0:
-                # Limit the number of warning messages
-                if self.__w_counter_slots[_service_name] == 0:
-                    logger.warning(
-                        "@JManager - All job slots in use for service %s." %
-                        _service_name
-                    )
-                if self.__w_counter_slots[_service_name] > 9999:
-                    logger.error(
-                        "@JManager - All job slots in use for service %s. "
-                        "Message repeated 10000 times." %
-                        _service_name
-                    )
-                    self.__w_counter_slots[_service_name] = 0
-                else:
-                    self.__w_counter_slots[_service_name] += 1
-                continue
-            else:
-                self.__w_counter_slots[_service_name] = 0
             # @TODO should be moved?? from here for batch submits??
-            # Check the service quota
-            if _service_quota[_service_name] < _service.config['job_size'] or \
-                    _hard_quota < _service.config['job_size']:
+            # Check available job slots and the service quota
+            _admission = self.__admission.admit(_service_name)
+            if _admission == NO_SLOTS:
+                continue
+            elif _admission == NO_QUOTA:
                 logger.warning(
                     "@JManager - Quota for service %s exceeded." %
                     _service_name
@@ -301,14 +291,15 @@ class JobManager(object):
                 # Flag the job to wait (no need to check the quota every tick)
                 _job.set_flag(JobState.FLAG_WAIT_QUOTA)
                 _job.status.wait_time = datetime.utcnow()
+                self.__wait_queue.park(
+                    _job.id(), _service_name, _job.status.wait_time + _dt,
+                    _job.status.flags)
                 continue
 
+            # The job no longer needs the woken mark
+            self.__wait_queue.pop_woken(_job.id())
             _batch.append(_job)
-            _service_slots[_service_name] -= 1  # Mark slot as used
-            _service_quota[_service_name] -= _service.config['job_size']
-            _hard_quota -= _service.config['job_size']
             _j += 1
-            _i += 1  # Mark slot as used
 
             logger.debug("Batch size: %s / %s.", _j, conf.config_batch_jobs)
             if _j >= conf.config_batch_jobs:
@@ -330,6 +321,29 @@ class JobManager(object):
 
         self.__timing["check_new_jobs"] = (datetime.utcnow() - _start_time).total_seconds()
 
+    def wake_input_jobs(self):
+        """
+        Wake up jobs waiting for input whose input directory appeared since
+        the last check.
+        """
+        _parked = self.__wait_queue.waiting_for(JobState.FLAG_WAIT_INPUT)
+        if not _parked:
+            self.__input_list = None
+            return
+        try:
+            _list = set(G.STATE_MANAGER.get_input_list())
+        except:
+            logger.error('Unable to list job input directories.',
+                         exc_info=True)
+            return
+        if self.__input_list is not None:
+            _n = self.__wait_queue.wake(_parked & (_list - self.__input_list),
+                                        JobState.FLAG_WAIT_INPUT)
+            if _n:
+                logger.debug('@JManager - Input appeared for %s waiting '
+                             'jobs.', _n)
+        self.__input_list = _list
+
     def check_running_jobs(self):
         """
         Check status of running jobs.
@@ -342,6 +356,9 @@ class JobManager(object):
 
         # Loop over supported schedulers
         for _sname, _scheduler in G.SCHEDULER_STORE.items():
+            # Do not update job states more often than every poll interval
+            if not _scheduler.update_due():
+                continue
             try:
                 _jobs = G.STATE_MANAGER.get_job_list(scheduler=_sname)
             except:
@@ -464,6 +481,9 @@ class JobManager(object):
                     continue
             elif _job.get_state() == 'waiting':
                 _job.finish('User request', 'killed', ExitCodes.UserKill)
+                self.__admission.transition(_job.status.service, 'waiting',
+                                            _job.get_state())
+                self.__wait_queue.discard(_job.id())
             else:
                 logger.warning("@JManager - Cannot kill job %s. "
                                "It is already finished.", _job.id())
@@ -517,24 +537,31 @@ class JobManager(object):
             if _job.get_state() in ('processing', 'cleanup', 'closing'):
                 continue
 
-            # Remove the output directory and its contents
+            # Remove the output directory and its contents. The removal is
+            # finished in background by the dump reaper
             _output = os.path.join(conf.gate_path_output, _jid)
-            _dump = os.path.join(conf.gate_path_dump, _jid)
             try:
                 if os.path.isdir(_output):
-                    shutil.move(_output, _dump)
-                    shutil.rmtree(_dump, onerror=rmtree_error)
+                    dump(_output, _jid)
             except:
                 logger.error("Cannot remove job output %s.", _jid,
                              exc_info=True)
 
             # Delete the job
             try:
+                _service = _job.status.service
+                _size = _job.get_size()
                 G.STATE_MANAGER.delete_job(_job)
             except:
                 #@TODO some limit on remove attempts?
                 logger.error("Cannot remove job %s.", _jid, exc_info=True)
                 continue
+            self.__wait_queue.discard(_jid)
+            # Freed quota allows parked jobs of the service to run
+            if _size:
+                self.__admission.release(_service, _size)
+                self.__wait_queue.wake_service(_service,
+                                               JobState.FLAG_WAIT_QUOTA)
 
             logger.info('@JManager - Job %s removed with all data.' %
                         _jid)
@@ -647,32 +674,69 @@ class JobManager(object):
 
         _clean = True
 
-        # Remove finished threads
-        for _thread in self.__thread_list_submit:
+        # Remove finished threads. Workers report final states of their jobs
+        # which are used to update job slots.
+        for _thread in self.__thread_list_submit[:]:
             if _thread.ready():
                 try:
-                    _thread.get()
+                    _states = _thread.get()
+                    # The worker failed to load or store the jobs. Tokens of
+                    # the batch are returned by a resync with the DB.
+                    if not _states:
+                        self.__admission.invalidate()
+                    # Validation can change the service of a job
+                    for (_service, _new_service, _state) in _states:
+                        self.__admission.transition(_service, 'processing',
+                                                    'waiting')
+                        self.__admission.transition(_new_service, 'waiting',
+                                                    _state)
                 except:
                     logger.error("Subprocess raised an exception.",
                             exc_info=True)
+                    self.__admission.invalidate()
                 self.__thread_list_submit.remove(_thread)
                 _clean = False
                 logger.debug("Removed finished subprocess.")
-        for _thread in self.__thread_list_cleanup:
+        for _thread in self.__thread_list_cleanup[:]:
             if _thread.ready():
                 try:
-                    _thread.get()
+                    _states = _thread.get()
+                    if not _states:
+                        self.__admission.invalidate()
+                    for (_service, _state) in _states:
+                        self.__admission.transition(_service, 'cleanup',
+                                                    _state)
                 except:
                     logger.error("Subprocess raised an exception.",
                             exc_info=True)
+                    self.__admission.invalidate()
                 self.__thread_list_cleanup.remove(_thread)
                 _clean = False
                 logger.debug("Removed finished subprocess.")
         if not _clean:
             G.STATE_MANAGER.check_commit()
 
+        # Without running workers all reserved job slots are in the DB
+        self.__slots_step -= 1
+        if self.__slots_step <= 0 and not self.__thread_list_submit and \
+                not self.__thread_list_cleanup:
+            self.sync_slots()
+
         self.__timing["check_finished_threads"] = (datetime.utcnow() - _start_time).total_seconds()
 
+    def sync_slots(self):
+        """
+        Resync scheduler job slot counters with the DB. No workers should be
+        running.
+        """
+        try:
+            G.SCHEDULER_STORE.sync_slots(
+                G.STATE_MANAGER.get_scheduler_counters())
+        except:
+            logger.error('Unable to contact with the DB.', exc_info=True)
+            return
+        self.__slots_step = conf.config_admission_step
+
     def check_stuck_jobs(self):
         """
         Check for jobs in processing and cleanup states. If found when
@@ -681,6 +745,14 @@ class JobManager(object):
         worker is present that was supposed to take care of those jobs.
         """
         _start_time = datetime.utcnow()
+        try:
+            _count = G.STATE_MANAGER.load_dirty()
+        except:
+            logger.error('Unable to contact with the DB.', exc_info=True)
+            self.__timing["check_stuck_jobs"] = (datetime.utcnow() - _start_time).total_seconds()
+            return
+
+        logger.debug("Found %s jobs not synced with the GW", _count)
         try:
             _job_list = G.STATE_MANAGER.get_job_list("cleanup")
         except:
@@ -835,6 +907,8 @@ class JobManager(object):
                 _job.die("Unable to change state.")
 
         if not G.STATE_MANAGER.check_commit():
+            # Admitted jobs did not change state
+            self.__admission.invalidate()
             self.__timing["batch_submit"] = (datetime.utcnow() - _start_time).total_seconds()
             return
 
@@ -988,6 +1062,7 @@ class JobManager(object):
             # Calculate last iteration execute time
             _exec_time = (datetime.utcnow() - self.__time_stamp).total_seconds()
             logger.log(VERBOSE, "Iteration time: %s", _exec_time)
+            logger.log(VERBOSE, "Dump backlog: %s", self.__reaper.backlog())
             # Calculate required sleep time
             _dt = conf.config_sleep_time - _exec_time
             if _dt < 0:
@@ -995,9 +1070,22 @@ class JobManager(object):
                     logger.error("Main loop execution behind "
                                  "schedule by %s seconds.", _dt)
                     logger.error("Timing profile %s", self.__timing)
+                    logger.error("Dump backlog %s", self.__reaper.backlog())
             else:
-                # Sleep
-                time.sleep(_dt)
+                # Sleep until next iteration is due or the AppGW reports
+                # new requests
+                try:
+                    _woken = G.STATE_MANAGER.wait_gw(_dt)
+                except:
+                    logger.error("Unable to watch GW.", exc_info=True)
+                    time.sleep(_dt)
+                    _woken = False
+                # Do not iterate too often when woken up by the AppGW
+                if _woken:
+                    _dt = conf.gate_watch_interval - \
+                        (datetime.utcnow() - self.__time_stamp).total_seconds()
+                    if _dt > 0:
+                        time.sleep(_dt)
             # Store new time stamp
             self.__time_stamp = datetime.utcnow()
             self.__timing = {}
@@ -1041,11 +1129,13 @@ class JobManager(object):
         self.__time_stamp_unit = datetime.utcnow()
 
 
-def worker_init(config, work_id, lock):
+def worker_init(config, work_id, lock, slots):
     """
     Initialize worker process.
 
     :param config: Config.Config instance.
+    :param slots: dict with scheduler job slot counters shared with
+        JobManager.
     """
     threading.current_thread().name = "%s_%s" % (work_id, os.getpid())
     # Initialize config
@@ -1059,6 +1149,7 @@ def worker_init(config, work_id, lock):
     lock.acquire()
     G.init()
     lock.release()
+    G.SCHEDULER_STORE.share_slots(slots)
 
 def worker_submit_profile(job_ids):
     """
@@ -1072,7 +1163,9 @@ def worker_submit(job_ids):
     Generate job related scripts and submit them to selected scheduler.
 
     :param job: The Job object to submit.
-    :return: True on success, False otherwise.
+    :return: list of tuples (service, service after validation, state) with
+        final states of the jobs. Empty if the jobs could not be loaded or
+        their states could not be stored.
     """
     logger.debug("Submit batch of %s jobs.", len(job_ids))
 
@@ -1086,8 +1179,11 @@ def worker_submit(job_ids):
         logger.error("Unable to connect to DB.",
                      exc_info=True)
         #@TODO we should somehow recover from this otherwise jobs will remain in processing state forever
-        return
+        return []
 
+    _services = [_job.status.service for _job in _jobs]
+    # Jobs ready for submission per scheduler
+    _ready = {}
     for _job in _jobs:
         _jid = _job.id()
 
@@ -1124,20 +1220,37 @@ def worker_submit(job_ids):
             _job.die("Unable to obtain scheduler and "
                          "service instance.", exc_info=True)
             continue
-        # Ask scheduler to generate scripts and submit the job
+        # Ask scheduler to generate scripts
         try:
             if _scheduler.generate_scripts(_job):
                 if _scheduler.chain_input_data(_job):
-                    if _scheduler.submit(_job):
-                        _job.queue()
-                    else:
-                        _job.wait()
+                    _ready.setdefault(_job.status.scheduler, []).append(_job)
         except:
             _job.die("Unable to submit job.", exc_info=True)
             continue
 
-    G.STATE_MANAGER.check_commit(_session)
+    # Submit the jobs in batches, one per scheduler
+    for _name, _batch in _ready.items():
+        try:
+            _results = G.SCHEDULER_STORE[_name].submit_batch(_batch)
+        except:
+            for _job in _batch:
+                _job.die("Unable to submit job.", exc_info=True)
+            continue
+        for _job, _submitted in zip(_batch, _results):
+            if _submitted:
+                _job.queue()
+            # Jobs aborted by the scheduler are already closing
+            elif _job.get_state() == 'processing':
+                _job.wait()
+
+    _states = [(_service, _job.status.service, _job.status.state)
+               for _service, _job in zip(_services, _jobs)]
+    if not G.STATE_MANAGER.check_commit(_session):
+        # Job states were not stored
+        return []
     logger.debug("Job submit thread finished.")
+    return _states
 
 def worker_cleanup_profile(job_ids):
     """
@@ -1148,6 +1261,11 @@ def worker_cleanup_profile(job_ids):
 
 def worker_cleanup(job_ids):
     """
+    Finalise jobs and move them into their exit states.
+
+    :return: list of tuples (service, state) with final states of the jobs.
+        Empty if the jobs could not be loaded or their states could not be
+        stored.
     """
     logger.debug("Cleanup batch of %s jobs.", len(job_ids))
 
@@ -1157,7 +1275,7 @@ def worker_cleanup(job_ids):
     except:
         logger.error("Unable to connect to DB.",
                      exc_info=True)
-        return
+        return []
 
     for _job in _jobs:
         _jid = _job.id()
@@ -1179,6 +1297,10 @@ def worker_cleanup(job_ids):
                              _jid, exc_info=True)
                 continue
 
-    G.STATE_MANAGER.check_commit(_session)
+    _states = [(_job.status.service, _job.status.state) for _job in _jobs]
+    if not G.STATE_MANAGER.check_commit(_session):
+        # Job states were not stored
+        return []
     logger.debug("Job cleanup thread finished.")
+    return _states
 
@@ -6,6 +6,7 @@ DB.
 """
 
 import os
+import errno
 import logging
 import time
 from datetime import datetime
@@ -14,17 +15,20 @@ from decorator import decorator
 
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.ext.mutable import Mutable
-from sqlalchemy.exc import SQLAlchemyError, DataError
+from sqlalchemy.exc import SQLAlchemyError, DataError, IntegrityError
 from sqlalchemy.pool import Pool
-from sqlalchemy import event, create_engine, func
+from sqlalchemy import event, create_engine, func, inspect, select, literal, \
+        case
 from sqlalchemy.orm import relationship, backref, sessionmaker, deferred, \
-        joinedload, Session
+        joinedload, object_session, Session
 from sqlalchemy.orm.exc import NoResultFound
-from sqlalchemy import Column, BigInteger, Integer, String, DateTime, PickleType, ForeignKey
+from sqlalchemy import Column, BigInteger, Integer, String, DateTime, PickleType, ForeignKey, Index
 
 import Globals as G
 from Config import conf, VERBOSE, ExitCodes
 from Tools import rollback
+from Watchers import create_watcher
+from Gateway import GatewayBatch
 
 
 logger = logging.getLogger(__name__)
@@ -142,6 +146,18 @@ class JobState(Base):
     D_ALL -= 1
     #: Dirty status of job attributes
     attr_dirty = Column(Integer)
+    #: State last propagated to AppGW (not stored in the DB). Set on the first
+    #: state change after a sync. None means unknown.
+    gw_state = None
+
+    # Dirty JobStates are tracked in memory (see DIRTY_STATES). The partial
+    # index is used only to find them after a crash. MySQL does not support
+    # partial indexes and will create a regular one.
+    __table_args__ = (
+        Index('ix_job_states_attr_dirty', attr_dirty,
+              postgresql_where=(attr_dirty > 0),
+              sqlite_where=(attr_dirty > 0)),
+    )
 
     def __init__(self, id, service=None, scheduler=None, state=None, exit_message=None,
                  exit_state=None, exit_code=None, submit_time=None, start_time=None,
@@ -164,68 +180,121 @@ class JobState(Base):
         self.attr_dirty = 0
         self.flags_dirty = 0
 
+class JobStateRecord(object):
+    """
+    Plain (not mapped) set of JobState values. Used to propagate jobs that
+    were inserted in bulk to AppGW without the cost of ORM instances.
+    """
+
+    def __init__(self, id, attr_dirty, gw_state=None, **kwargs):
+        self.id = id
+        self.service = None
+        self.scheduler = None
+        self.state = None
+        self.exit_message = None
+        self.exit_state = None
+        self.exit_code = None
+        self.submit_time = None
+        self.start_time = None
+        self.stop_time = None
+        self.wait_time = None
+        self.flags = 0
+        self.flags_dirty = 0
+        for _key, _value in kwargs.items():
+            setattr(self, _key, _value)
+        self.attr_dirty = attr_dirty
+        self.gw_state = gw_state
+
+#: JobState instances with changes that were not yet synced with AppGw. Filled
+#: by the "set" listeners so that the sync does not have to scan the DB.
+DIRTY_STATES = set()
+
+#: Maximal number of Job IDs passed to a single IN clause
+ID_CHUNK = 500
+
+#: Job states that occupy job slots
+ACTIVE_STATES = ("queued", "processing", "running", "closing", "cleanup")
+
+
+def mark_dirty(target, flag):
+    """
+    Set a dirty flag of JobState instance and register it for sync with AppGw.
+
+    :param target: JobState instance
+    :param flag: one of JobState.D_* values
+    """
+    target.attr_dirty |= flag
+    DIRTY_STATES.add(target)
+
+
 # Listeners to "set" events for JobState attributes. They set dirty flags that
 # are used to sync the changes with AppGw.
 @event.listens_for(JobState.id, 'set')
 def set_job_state_id(target, value, oldvalue, initiator):
-    target.attr_dirty |= target.D_ID
+    mark_dirty(target, target.D_ID)
 
 
 @event.listens_for(JobState.service, 'set')
 def set_job_state_service(target, value, oldvalue, initiator):
-    target.attr_dirty |= target.D_SERVICE
+    mark_dirty(target, target.D_SERVICE)
 
 
 @event.listens_for(JobState.scheduler, 'set')
 def set_job_state_scheduler(target, value, oldvalue, initiator):
-    target.attr_dirty |= target.D_SCHEDULER
+    mark_dirty(target, target.D_SCHEDULER)
 
 
-@event.listens_for(JobState.state, 'set')
+@event.listens_for(JobState.state, 'set', active_history=True)
 def set_job_state_state(target, value, oldvalue, initiator):
     logger.log(VERBOSE, "@JobState - Dirty: state changed (%s => %s)",
             oldvalue, value)
-    target.attr_dirty |= target.D_STATE
+    # Remember the state known to AppGW so that only its link is removed
+    if not target.attr_dirty & target.D_STATE:
+        if oldvalue in conf.service_states:
+            target.gw_state = oldvalue
+        else:
+            target.gw_state = None
+    mark_dirty(target, target.D_STATE)
 
 
 @event.listens_for(JobState.exit_message, 'set')
 def set_job_state_exit_message(target, value, oldvalue, initiator):
-    target.attr_dirty |= target.D_EXIT_MESSAGE
+    mark_dirty(target, target.D_EXIT_MESSAGE)
 
 
 @event.listens_for(JobState.exit_state, 'set')
 def set_job_state_exit_state(target, value, oldvalue, initiator):
-    target.attr_dirty |= target.D_EXIT_STATE
+    mark_dirty(target, target.D_EXIT_STATE)
 
 
 @event.listens_for(JobState.exit_code, 'set')
 def set_job_state_exit_code(target, value, oldvalue, initiator):
-    target.attr_dirty |= target.D_EXIT_CODE
+    mark_dirty(target, target.D_EXIT_CODE)
 
 
 @event.listens_for(JobState.submit_time, 'set')
 def set_job_state_submit_time(target, value, oldvalue, initiator):
-    target.attr_dirty |= target.D_SUBMIT_TIME
+    mark_dirty(target, target.D_SUBMIT_TIME)
 
 
 @event.listens_for(JobState.start_time, 'set')
 def set_job_state_start_time(target, value, oldvalue, initiator):
-    target.attr_dirty |= target.D_START_TIME
+    mark_dirty(target, target.D_START_TIME)
 
 
 @event.listens_for(JobState.stop_time, 'set')
 def set_job_state_stop_time(target, value, oldvalue, initiator):
-    target.attr_dirty |= target.D_STOP_TIME
+    mark_dirty(target, target.D_STOP_TIME)
 
 
 @event.listens_for(JobState.wait_time, 'set')
 def set_job_state_wait_time(target, value, oldvalue, initiator):
-    target.attr_dirty |= target.D_WAIT_TIME
+    mark_dirty(target, target.D_WAIT_TIME)
 
 
 @event.listens_for(JobState.flags, 'set')
 def set_job_state_flags(target, value, oldvalue, initiator):
-    target.attr_dirty |= target.D_FLAGS
+    mark_dirty(target, target.D_FLAGS)
     # For new objects oldvalue is not set
     if isinstance(oldvalue, int):
         _diff = value ^ int(oldvalue)
@@ -233,10 +302,15 @@ def set_job_state_flags(target, value, oldvalue, initiator):
         _diff = value
     target.flags_dirty |= _diff
 
-# Listeners to "delete" event for JobState instances. Call the cleanup.
+# Listeners to "delete" event for JobState instances. Queue the cleanup, it
+# is performed by StateManager.commit once the removal is persisted.
 @event.listens_for(JobState, 'after_delete')
 def delete_job_state(mapper, connection, target):
-    G.STATE_MANAGER.cleanup(target.id)
+    object_session(target).info.setdefault('cleanup', []).append(target.id)
+
+@event.listens_for(Session, 'after_soft_rollback')
+def rollback_session(thissession, previous_transaction):
+    thissession.info.pop('cleanup', None)
 
 @event.listens_for(Session, 'before_flush')
 def flush_session(thissession, flush_context, instances):
@@ -370,10 +444,7 @@ class Job(Base):
         elif job_state.id != job_id:
             raise Exception("Inconsistent job IDs: %s != %s" % (job_state.id, job_id))
 
-        _service = None
-        for _name in G.SERVICE_STORE:
-            if job_id.startswith(_name):
-                _service = _name
+        _service = G.SERVICE_STORE.match(job_id)
         if _service is None:
             raise Exception("Unknown Job service for job: %s." % job_id)
         else:
@@ -752,6 +823,13 @@ class StateManager(object):
         self.session = self.session_factory()
         # Create the tables in the DB (creation is skipped if tables exist)
         Base.metadata.create_all(self.engine)
+        # Indexes are not created for existing tables
+        _indexes = [_i['name'] for _i in
+                    inspect(self.engine).get_indexes(JobState.__tablename__)]
+        for _index in JobState.__table__.indexes:
+            if _index.name not in _indexes:
+                logger.info("Create DB index %s", _index.name)
+                _index.create(self.engine)
         self.commit()
         logger.debug("StateManager initialized")
 
@@ -798,6 +876,10 @@ class StateManager(object):
             session = self.session
 
         session.commit()
+        # Remove AppGW state of deleted jobs
+        _ids = session.info.pop('cleanup', None)
+        if _ids:
+            self.cleanup_many(_ids)
 
     def check_commit(self, session=None):
         """
@@ -846,6 +928,24 @@ class StateManager(object):
 
         session.flush()
 
+    @rollback(SQLAlchemyError)
+    def load_dirty(self, session=None):
+        """
+        Register JobStates that are marked dirty in the DB for sync with the
+        AppGW. Dirty states are normally tracked in memory, this recovers the
+        ones left after a crash.
+
+        :param session: if specified use this session instance instead of the
+            default.
+        :return: number of dirty JobStates found.
+        """
+        if session is None:
+            session = self.session
+
+        _list = session.query(JobState).filter(JobState.attr_dirty > 0).all()
+        DIRTY_STATES.update(_list)
+        return len(_list)
+
     def poll_gw(self, session=None):
         """
         Check for changes in job states issued by the AppGW.
@@ -857,6 +957,26 @@ class StateManager(object):
         """
         raise NotImplementedError
 
+    def wait_gw(self, timeout):
+        """
+        Wait for changes issued by the AppGW.
+
+        :param timeout: maximum time to wait in seconds.
+        :return: True if a change was detected before timeout, False
+            otherwise.
+        """
+        if timeout > 0:
+            time.sleep(timeout)
+        return False
+
+    def get_input_list(self):
+        """
+        Get the list of job input directories uploaded by the AppGW.
+
+        :return: list of job IDs.
+        """
+        return os.listdir(conf.gate_path_input)
+
     def cleanup(self, job_id):
         """
         Cleanup AppGW state after Job removal.
@@ -865,6 +985,15 @@ class StateManager(object):
         """
         raise NotImplementedError
 
+    def cleanup_many(self, ids):
+        """
+        Cleanup AppGW state after removal of several jobs.
+
+        :param ids: list of Job IDs.
+        """
+        for _jid in ids:
+            self.cleanup(_jid)
+
     def new_job(self, job_id):
         """
         Create new Job instance with job_id identifier and attach it to DB
@@ -906,6 +1035,105 @@ class StateManager(object):
         self.commit(session)
         session.expunge(job)
 
+    @rollback(SQLAlchemyError)
+    def insert_jobs(self, job_ids, session=None):
+        """
+        Insert new jobs into the DB in bulk. Jobs are created in the *waiting*
+        state just like with :py:meth:`new_job`, but no ORM instances are
+        created and the rows are inserted with a few multi-row statements.
+
+        IDs that do not match any service or are too long, and IDs already
+        present in the DB are rejected. If the insert fails anyway the jobs
+        are inserted in halves (each committed) until the failing IDs are
+        singled out. Otherwise the changes are left for the caller to commit.
+
+        The set listeners of :py:class:`JobState` are not triggered, the
+        caller is responsible for propagating the new jobs to the AppGW.
+
+        :param job_ids: list of unique job IDs.
+        :param session: if specified use this session instance instead of the
+            default.
+        :return: tuple (inserted, rejected, existing) - list of dicts with
+            :py:class:`JobState` column values of inserted jobs, lists of
+            rejected IDs and IDs already present in the DB.
+        """
+        if session is None:
+            session = self.session
+
+        _rejected = []
+        _ids = []
+        _max_len = JobState.id.property.columns[0].type.length
+        for _jid in set(job_ids):
+            if len(_jid) > _max_len or G.SERVICE_STORE.match(_jid) is None:
+                _rejected.append(_jid)
+            else:
+                _ids.append(_jid)
+
+        _existing = set()
+        for _i in range(0, len(_ids), ID_CHUNK):
+            _existing.update(_id for (_id,) in session.query(JobState.id).
+                             filter(JobState.id.in_(_ids[_i:_i + ID_CHUNK])))
+
+        _now = datetime.utcnow()
+        _rows = [{
+            'id': _jid,
+            'service': G.SERVICE_STORE.match(_jid),
+            'state': 'waiting',
+            'exit_code': ExitCodes.Undefined,
+            'submit_time': _now,
+            'flags': 0,
+            'flags_dirty': 0,
+            'attr_dirty': 0,
+        } for _jid in _ids if _jid not in _existing]
+
+        try:
+            self.__insert_rows(_rows, session)
+        except (DataError, IntegrityError):
+            logger.warning("@StateManager: Bulk insert of %s jobs failed, "
+                           "will isolate malformed jobs.", len(_rows),
+                           exc_info=True)
+            session.rollback()
+            _rows, _bad = self.__insert_isolated(_rows, session)
+            _rejected.extend(_bad)
+
+        logger.log(VERBOSE, u"@StateManager: Inserted %s new jobs (%s "
+                   u"rejected, %s already present).", len(_rows),
+                   len(_rejected), len(_existing))
+        return _rows, _rejected, list(_existing)
+
+    def __insert_rows(self, rows, session):
+        """
+        Insert JobState and Job rows, a pair of statements per ID_CHUNK jobs.
+        """
+        for _i in range(0, len(rows), ID_CHUNK):
+            _chunk = rows[_i:_i + ID_CHUNK]
+            session.execute(JobState.__table__.insert(), _chunk)
+            session.execute(Job.__table__.insert().from_select(
+                ['status_key', 'size'],
+                select([JobState.key, literal(0)]).where(
+                    JobState.id.in_([_row['id'] for _row in _chunk]))))
+
+    def __insert_isolated(self, rows, session):
+        """
+        Insert rows committing in halves until the failing ones are found.
+
+        :return: tuple (inserted rows, list of failed IDs)
+        """
+        try:
+            self.__insert_rows(rows, session)
+            session.commit()
+            return rows, []
+        except (DataError, IntegrityError):
+            session.rollback()
+        if len(rows) == 1:
+            logger.error("@StateManager: Unable to insert job %s.",
+                         rows[0]['id'], exc_info=True)
+            return [], [rows[0]['id']]
+        _half = len(rows) // 2
+        _first, _bad_first = self.__insert_isolated(rows[:_half], session)
+        _second, _bad_second = self.__insert_isolated(rows[_half:], session)
+        return _first + _second, _bad_first + _bad_second
+
     def merge_job(self, job, session=None):
         """
         Merge state of a Job instance into the DB session.
@@ -1036,6 +1264,57 @@ class StateManager(object):
         # Execute query
         return _q.all()
 
+    @rollback(SQLAlchemyError)
+    def set_flag_many(self, ids, flag, session=None):
+        """
+        Set a job flag for a set of jobs.
+
+        Jobs that already have the flag set are skipped. The flags are set
+        with a single UPDATE statement (per chunk of IDs), no ORM instances are
+        loaded. As the change is not propagated to the AppGW it should be used
+        for flags that originate from the AppGW.
+
+        :param ids: iterable with Job IDs.
+        :param flag: a flag or set of flags to set, see
+            :py:meth:`Job.set_flag`.
+        :param session: if specified use this session instance instead of the
+            default.
+        :return: set of Job IDs that were not found in the DB.
+        """
+        if session is None:
+            session = self.session
+
+        if flag <= 0 or flag > JobState.FLAG_ALL:
+            raise Exception("Unknown job flags %s." % flag)
+
+        _ids = list(set(ids))
+        _missing = set(_ids)
+        _update = []
+        # Limit the number of bound parameters per statement (SQLite allows
+        # 999)
+        for _i in range(0, len(_ids), ID_CHUNK):
+            _chunk = _ids[_i:_i + ID_CHUNK]
+            for _id, _flags in session.query(JobState.id, JobState.flags).\
+                    filter(JobState.id.in_(_chunk)):
+                _missing.discard(_id)
+                if _flags & flag != flag:
+                    _update.append(_id)
+        for _i in range(0, len(_update), ID_CHUNK):
+            _chunk = _update[_i:_i + ID_CHUNK]
+            session.query(JobState).filter(JobState.id.in_(_chunk)).update(
+                {JobState.flags: JobState.flags.op('|')(flag)},
+                synchronize_session=False)
+        # Instances already loaded in the session have to reload the flags
+        if _update:
+            _update = set(_update)
+            for _entry in list(session.identity_map.values()):
+                if isinstance(_entry, JobState) and _entry.id in _update:
+                    session.expire(_entry, ['flags'])
+
+        logger.log(VERBOSE, u"@StateManager: Flag %s set for %s jobs, %s "
+                   u"not found.", flag, len(_update), len(_missing))
+        return _missing
+
     @rollback(SQLAlchemyError)
     def get_job_count(self, state="all", service=None, scheduler=None,
                       flag=None, session=None):
@@ -1273,6 +1552,49 @@ class StateManager(object):
         # Execute query
         return _q.all()
 
+    @rollback(SQLAlchemyError)
+    def get_service_counters(self, session=None):
+        """
+        Get the number of active jobs and the size of quota used by jobs per
+        service. Both counters are obtained with a single query.
+
+        :param Session session: if specified use this session instance instead
+            of the default.
+
+        :return: List of tuples (service, active job count, used quota).
+        """
+        if session is None:
+            session = self.session
+
+        _active = case([(JobState.state.in_(ACTIVE_STATES), 1)], else_=0)
+        _q = session.query(JobState.service, func.sum(_active),
+                           func.coalesce(func.sum(Job.size), 0)).\
+            outerjoin(Job, Job.status_key == JobState.key).\
+            group_by(JobState.service)
+        # Execute query. MySQL returns SUM as decimal.
+        return [(_service, int(_count), int(_size))
+                for (_service, _count, _size) in _q.all()]
+
+    @rollback(SQLAlchemyError)
+    def get_scheduler_counters(self, session=None):
+        """
+        Get the number of jobs submitted to each scheduler (jobs holding
+        scheduler job slots).
+
+        :param Session session: if specified use this session instance instead
+            of the default.
+
+        :return: List of tuples (scheduler, job count).
+        """
+        if session is None:
+            session = self.session
+
+        _q = session.query(SchedulerQueue.scheduler,
+                           func.count(SchedulerQueue.key)).\
+            join(Job, Job.key == SchedulerQueue.job_key).\
+            group_by(SchedulerQueue.scheduler)
+        return [(_scheduler, int(_count)) for (_scheduler, _count) in _q.all()]
+
     @rollback(SQLAlchemyError)
     def remove_flags(self, flag, service='all', session=None):
         """
@@ -1324,8 +1646,28 @@ class StateManager(object):
         session.delete(job)
 
 class FileStateManager(StateManager):
+    def __init__(self):
+        super(FileStateManager, self).__init__()
+        #: Watcher of AppGW directories. Created on first use so that worker
+        #: processes do not watch the directories.
+        self.watcher = None
+
+    def clear(self):
+        if self.watcher is not None:
+            self.watcher.stop()
+            self.watcher = None
+        super(FileStateManager, self).clear()
+
+    def wait_gw(self, timeout):
+        return self.__get_watcher().wait(timeout)
+
+    def get_input_list(self):
+        return self.__get_watcher().listdir(conf.gate_path_input)
+
     def new_job(self, jid, session=None):
         _job = Job(jid)
+        # Job requests are symlinked in the "new" directory by AppGW
+        _job.status.gw_state = 'new'
         self.attach_job(_job, session)
         return _job
 
@@ -1335,7 +1677,7 @@ class FileStateManager(StateManager):
 
         _path = conf.gate_path_new
         try:
-            _list = os.listdir(_path)
+            _list = self.__get_watcher().listdir(_path)
         except:
             logger.error(u"@FileStateManager - Unable to read directory: %s." %
                          _path, exc_info=True)
@@ -1346,40 +1688,31 @@ class FileStateManager(StateManager):
         # Limit number of jobs to process in one go
         if len(_list) > (conf.config_batch_jobs * conf.config_max_threads):
             _list = _list[0:(conf.config_batch_jobs * conf.config_max_threads)]
-        for _jid in _list:
-            # Create new Job instance. It will be created in 'waiting' state
-            _job = self.new_job(_jid)
-            if _job is None:
-                continue
 
-        # TODO an explicit commit would be usefull. The query below will issue
-        # a commit anyway. What if job is malformed and results in an SQL error?
-        # We should singleout such jobs and throw them away ...
-        try:
-            self.commit()
-        except DataError:
-            # TODO
-            # Are the job objects invalidated?? Should we remove them?? Should
-            # we create them anew??
-            # For now create them once again ...
-
-            # Limit number of jobs to process and commit them one by one. Mark
-            # as aborted those that fail.
-            _n = (conf.config_batch_jobs * conf.config_max_threads) / 10
-            if len(_list) > _n:
-                _list = _list[0:_n]
-            for _jid in _list:
-                # Create new Job instance. It will be created in 'waiting' state
-                _job = self.new_job(_jid)
-                if _job is None:
-                    continue
-                try:
-                    self.commit()
-                except DataError:
-                    _js = JobState()
-                    _js.id = _jid
-                    _js.state = "aborted"
-                    self.__state_change(_js)
+        # Jobs are inserted in bulk. Malformed ones are marked as aborted.
+        _rows, _rejected, _existing = self.insert_jobs(_list)
+        _batch = GatewayBatch()
+        for _row in _rows:
+            # Job requests are symlinked in the "new" directory by AppGW
+            _js = JobStateRecord(
+                    _row['id'], JobState.D_SERVICE | JobState.D_STATE |
+                    JobState.D_EXIT_CODE | JobState.D_SUBMIT_TIME,
+                    gw_state='new', service=_row['service'],
+                    state=_row['state'], exit_code=_row['exit_code'],
+                    submit_time=_row['submit_time'])
+            self.__sync_state(_js, _batch)
+        for _jid in _rejected:
+            logger.error(u"@FileStateManager - Malformed job request: %s",
+                         _jid)
+            _js = JobStateRecord(_jid, JobState.D_STATE, gw_state='new',
+                                 state='aborted')
+            self.__sync_state(_js, _batch)
+        for _jid in _existing:
+            logger.warning(u"@FileStateManager - Job request already "
+                           u"present in the DB: %s", _jid)
+            _batch.unlink(conf.gate_path_new, _jid)
+        _batch.execute()
+        self.commit()
 
         # Get list of waiting jobs (includes new requests and request not processed yet)
         _jobs = self.get_job_list("waiting")
@@ -1396,86 +1729,87 @@ class FileStateManager(StateManager):
 
         session.flush()
 
-        for _entry in session.query(JobState).filter(JobState.attr_dirty > 0):
-            logger.log(VERBOSE, "@FileStateManager: Found dirty (%s) JobState (%s).",
-                    _entry.attr_dirty, _entry.id)
-            if _entry.attr_dirty & JobState.D_SERVICE:
-                self.__service_change(_entry)
-            if _entry.attr_dirty & JobState.D_STATE:
-                self.__state_change(_entry)
-            if _entry.attr_dirty & JobState.D_EXIT_MESSAGE:
-                self.__exit_message_change(_entry)
-            if _entry.attr_dirty & JobState.D_EXIT_STATE:
-                self.__exit_state_change(_entry)
-            if _entry.attr_dirty & JobState.D_EXIT_CODE:
-                self.__exit_code_change(_entry)
-            if _entry.attr_dirty & JobState.D_SUBMIT_TIME:
-                self.__submit_time_change(_entry)
-            if _entry.attr_dirty & JobState.D_START_TIME:
-                self.__start_time_change(_entry)
-            if _entry.attr_dirty & JobState.D_STOP_TIME:
-                self.__stop_time_change(_entry)
-            if _entry.attr_dirty & JobState.D_WAIT_TIME:
-                self.__wait_time_change(_entry)
-            if _entry.attr_dirty & JobState.D_FLAGS:
-                self.__flags_change(_entry)
-            _entry.attr_dirty = 0
+        # Changes are collected and pushed to the AppGW in one go
+        _batch = GatewayBatch()
+        for _entry in list(DIRTY_STATES):
+            _state = inspect(_entry)
+            # Forget removed JobStates and those whose session was closed or
+            # rolled back without commit - the DB still has them marked as
+            # dirty.
+            if _state.deleted or _state.was_deleted or _state.detached or \
+                    _state.transient:
+                DIRTY_STATES.discard(_entry)
+                continue
+            # Changes made in other sessions are pushed on their commit
+            if object_session(_entry) is not session:
+                continue
+            DIRTY_STATES.discard(_entry)
+            self.__sync_state(_entry, _batch)
+        _batch.execute()
 
         super(FileStateManager, self).commit(session)
 
+    def __sync_state(self, status, batch):
+        """
+        Propagate changes of a JobState marked by its dirty flags to the GW.
+
+        :param status: JobState instance
+        :param batch: GatewayBatch instance that collects the changes
+        """
+        if not status.attr_dirty:
+            return
+        logger.log(VERBOSE, "@FileStateManager: Found dirty (%s) JobState (%s).",
+                status.attr_dirty, status.id)
+        if status.attr_dirty & JobState.D_SERVICE:
+            self.__service_change(status, batch)
+        if status.attr_dirty & JobState.D_STATE:
+            self.__state_change(status, batch)
+        if status.attr_dirty & JobState.D_EXIT_MESSAGE:
+            self.__exit_message_change(status, batch)
+        if status.attr_dirty & JobState.D_EXIT_STATE:
+            self.__exit_state_change(status, batch)
+        if status.attr_dirty & JobState.D_EXIT_CODE:
+            self.__exit_code_change(status, batch)
+        if status.attr_dirty & JobState.D_SUBMIT_TIME:
+            self.__submit_time_change(status, batch)
+        if status.attr_dirty & JobState.D_START_TIME:
+            self.__start_time_change(status, batch)
+        if status.attr_dirty & JobState.D_STOP_TIME:
+            self.__stop_time_change(status, batch)
+        if status.attr_dirty & JobState.D_WAIT_TIME:
+            self.__wait_time_change(status, batch)
+        if status.attr_dirty & JobState.D_FLAGS:
+            self.__flags_change(status, batch)
+        status.attr_dirty = 0
+
     def poll_gw(self, session=None):
         logger.log(VERBOSE, u"@FileStateManager: Poll AppGW for status changes.")
         if session is None:
             session = self.session
 
-        # Kill flags
-        _path = conf.gate_path_flag_stop
-        try:
-            _list = os.listdir(_path)
-        except:
-            logger.error(u"@FileStateManager - Unable to read directory: %s." %
-                         _path, exc_info=True)
-            return
-        logger.log(VERBOSE, u"@FileStateManager: Obtained job kill flags.")
-
-        #@TODO should we use session??
-        for _job in self.get_job_list(flag=JobState.FLAG_STOP):
-            if _job.id() in _list:
-                _list.remove(_job.id())
-
-        #@TODO set flag in one query ??
-        for _id in _list:
+        # Set job flags requested by the AppGW: kill and delete. Jobs that
+        # are not present in the DB are removed.
+        for _path, _flag, _name in (
+                (conf.gate_path_flag_stop, JobState.FLAG_STOP, u"kill"),
+                (conf.gate_path_flag_delete, JobState.FLAG_DELETE, u"delete")):
             try:
-                _job = self.get_job(_id)
-                _job.set_flag(JobState.FLAG_STOP)
-            except NoResultFound as e:
-                logger.error('Job %s not found in the DB. Will remove.' % _id, exc_info=True)
-                self.cleanup(_id)
-        logger.log(VERBOSE, u"@FileStateManager: Jobs flagged for kill.")
-
-        # Delete flags
-        _path = conf.gate_path_flag_delete
-        try:
-            _list = os.listdir(_path)
-        except:
-            logger.error(u"@FileStateManager - Unable to read directory: %s." %
-                         _path, exc_info=True)
-            return
-        logger.log(VERBOSE, u"@FileStateManager: Obtained job delete flags: %s", _list)
-
-        for _job in self.get_job_list(flag=JobState.FLAG_DELETE):
-            if _job.id() in _list:
-                _list.remove(_job.id())
+                _list = self.__get_watcher().listdir(_path)
+            except:
+                logger.error(u"@FileStateManager - Unable to read directory: "
+                             u"%s." % _path, exc_info=True)
+                return
+            logger.log(VERBOSE, u"@FileStateManager: Obtained %s job %s "
+                       u"flags.", len(_list), _name)
+            if not _list:
+                continue
 
-        #@TODO set flag in one query ??
-        for _id in _list:
-            try:
-                _job = self.get_job(_id)
-                _job.set_flag(JobState.FLAG_DELETE)
-            except NoResultFound as e:
-                logger.error('Job %s not found in the DB. Will remove.' % _id, exc_info=True)
-                self.cleanup(_id)
-        logger.log(VERBOSE, u"@FileStateManager: Jobs flagged for delete.")
+            _orphans = self.set_flag_many(_list, _flag, session=session)
+            if _orphans:
+                logger.error(u"Jobs not found in the DB. Will remove: %s",
+                             u", ".join(sorted(_orphans)))
+                self.cleanup_many(list(_orphans))
+            logger.log(VERBOSE, u"@FileStateManager: Jobs flagged for %s.",
+                       _name)
 
     def cleanup(self, id):
         """
@@ -1485,42 +1819,84 @@ class FileStateManager(StateManager):
 
         :param id: JobID
         """
-        _jid = id
-
-        logger.log(VERBOSE, u"@FileStateManager: Job cleanup (%s)", _jid)
-        # Remove job symlinks
-        for _state, _path in conf.gate_path.items():
-            _name = os.path.join(_path, _jid)
-            if os.path.exists(_name):
-                os.unlink(_name)
-        # Remove job file after symlinks (otherwise os.path.exists
-        # fails on symlinks)
-        _name = os.path.join(conf.gate_path_jobs, _jid)
-        if os.path.exists(_name):
-            os.unlink(_name)
-        else:
-            logger.warning("Job file does not exist during cleanup: %s", _name)
-        # Remove time stamps
-        _list = os.listdir(conf.gate_path_time)
-        for _item in _list:
-            if _item.endswith(_jid):
-                _name = os.path.join(conf.gate_path_time, _item)
-                os.unlink(_name)
-        # Remove persistent data
-        _list = os.listdir(conf.gate_path_opts)
-        for _item in _list:
-            if _item.endswith(_jid):
-                _name = os.path.join(conf.gate_path_opts, _item)
+        self.cleanup_many((id,))
+
+    def cleanup_many(self, ids):
+        """
+        Cleanup after removal of several jobs.
+
+        Removes the flags and other files representing job state. File names
+        are known so no directory has to be listed.
+
+        :param ids: list of JobIDs
+        """
+        logger.log(VERBOSE, u"@FileStateManager: Cleanup of %s jobs",
+                   len(ids))
+        _batch = GatewayBatch()
+        for _jid in ids:
+            logger.log(VERBOSE, u"@FileStateManager: Job cleanup (%s)", _jid)
+            # Remove job symlinks
+            for _path in conf.gate_path.values():
+                _batch.unlink(_path, _jid)
+            # Remove time stamps and persistent data. Files of both status
+            # formats are removed in case the format was changed.
+            for _name in ('submit_', 'start_', 'stop_', 'wait_'):
+                _batch.unlink(conf.gate_path_time, _name + _jid)
+            for _name in ('message_', 'state_', 'code_'):
+                _batch.unlink(conf.gate_path_opts, _name + _jid)
+            _batch.unlink(conf.gate_path_status, _jid + '.json')
+        _batch.execute()
+
+        # Remove job files after symlinks
+        for _jid in ids:
+            _name = os.path.join(conf.gate_path_jobs, _jid)
+            try:
                 os.unlink(_name)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    logger.error("Unable to remove job file: %s", _name,
+                                 exc_info=True)
+                else:
+                    logger.warning("Job file does not exist during cleanup: "
+                                   "%s", _name)
+
+    def __get_watcher(self):
+        """
+        Get the watcher of AppGW directories. Start it if necessary.
+        """
+        if self.watcher is None:
+            self.watcher = create_watcher((
+                conf.gate_path_new,
+                conf.gate_path_flag_stop,
+                conf.gate_path_flag_delete,
+                conf.gate_path_input
+            ))
+        return self.watcher
 
-    def __service_change(self, status):
-        pass
+    def __update_record(self, status, batch, **fields):
+        """
+        Update the JSON status record of the job.
 
-    def __state_change(self, status):
+        :param ststus: JobState instace
+        :param batch: GatewayBatch instance that collects the changes
+        :param fields: record fields to update
+        :return: True if JSON status records are used, False otherwise
+        """
+        if conf.gate_status_format != 'json':
+            return False
+        fields['id'] = status.id
+        batch.update(conf.gate_path_status, status.id + '.json', fields)
+        return True
+
+    def __service_change(self, status, batch):
+        self.__update_record(status, batch, service=status.service)
+
+    def __state_change(self, status, batch):
         """
         Propagate the job state to the GW.
 
         :param ststus: JobState instace
+        :param batch: GatewayBatch instance that collects the changes
         """
         _jid = status.id
         _new_state = status.state
@@ -1528,139 +1904,133 @@ class FileStateManager(StateManager):
         logger.log(VERBOSE, "@FileStateManager: State changed to: %s (%s)",
                 _new_state, _jid)
         # Mark new state in the shared file system
-        os.symlink(
-            os.path.join(conf.gate_path_jobs, _jid),
-            os.path.join(conf.gate_path[_new_state], _jid)
-        )
-
-        # Remove all other possible states just in case we previously failed
-        for _state in conf.service_states:
+        batch.link(conf.gate_path[_new_state], _jid,
+                   os.path.join(conf.gate_path_jobs, _jid))
+        self.__update_record(status, batch, state=_new_state)
+
+        # Remove the previous state. If it is not known remove all other
+        # possible states just in case we previously failed
+        if status.gw_state is not None:
+            _states = (status.gw_state,)
+        else:
+            _states = conf.service_states
+        for _state in _states:
             if _state != _new_state:
-                _name = os.path.join(conf.gate_path[_state], _jid)
-                if os.path.exists(_name):
-                    os.unlink(_name)
+                batch.unlink(conf.gate_path[_state], _jid)
+        status.gw_state = _new_state
 
-    def __exit_message_change(self, status):
+    def __exit_message_change(self, status, batch):
         """
         Propagate the exit message to the GW.
 
         :param ststus: JobState instace
+        :param batch: GatewayBatch instance that collects the changes
         """
         _jid = status.id
 
         logger.log(VERBOSE, "@FileStateManager: Store exit msg: %s (%s)",
                 status.exit_message, _jid)
+        if self.__update_record(status, batch,
+                                exit_message=status.exit_message):
+            return
         # The auxiliary info is stored in the opts directory as files with
         # names concatanated from data type name and job ID.
-        _opt = os.path.join(conf.gate_path_opts, 'message_' + _jid)
-        with open(_opt, 'w') as _f:
-            _f.write(status.exit_message)
+        batch.write(conf.gate_path_opts, 'message_' + _jid,
+                    status.exit_message)
 
-    def __exit_state_change(self, status):
+    def __exit_state_change(self, status, batch):
         """
         Propagate the exit state to the GW.
 
         :param ststus: JobState instace
+        :param batch: GatewayBatch instance that collects the changes
         """
         _jid = status.id
 
         logger.log(VERBOSE, "@FileStateManager: Store exit state: %s (%s)",
                 status.exit_state, _jid)
+        if self.__update_record(status, batch, exit_state=status.exit_state):
+            return
         # The auxiliary info is stored in the opts directory as files with
         # names concatanated from data type name and job ID.
-        _opt = os.path.join(conf.gate_path_opts, 'state_' + _jid)
-        with open(_opt, 'w') as _f:
-            _f.write(status.exit_state)
+        batch.write(conf.gate_path_opts, 'state_' + _jid, status.exit_state)
 
-    def __exit_code_change(self, status):
+    def __exit_code_change(self, status, batch):
         """
         Propagate the exit code to the GW.
 
         :param ststus: JobState instace
+        :param batch: GatewayBatch instance that collects the changes
         """
         _jid = status.id
 
         logger.log(VERBOSE, "@FileStateManager: Store exit code: %s (%s)",
                 status.exit_code, _jid)
+        if self.__update_record(status, batch, exit_code=status.exit_code):
+            return
         # The auxiliary info is stored in the opts directory as files with
         # names concatanated from data type name and job ID.
-        _opt = os.path.join(conf.gate_path_opts, 'code_' + _jid)
-        with open(_opt, 'w') as _f:
-            _f.write("%s" % status.exit_code)
+        batch.write(conf.gate_path_opts, 'code_' + _jid,
+                    "%s" % status.exit_code)
 
-    def __submit_time_change(self, status):
+    def __time_change(self, name, value, status, batch):
         """
-        Propagate the submit timestamp to the GW.
+        Propagate a timestamp to the GW.
 
+        :param name: event name: submit, start, stop or wait
+        :param value: datetime of the event
         :param ststus: JobState instace
+        :param batch: GatewayBatch instance that collects the changes
         """
         _jid = status.id
 
-        logger.log(VERBOSE, "@FileStateManager: Submit time change: %s (%s)",
-                status.submit_time, _jid)
+        logger.log(VERBOSE, "@FileStateManager: %s time change: %s (%s)",
+                name.capitalize(), value, _jid)
+        # Calculate UNIX time stamp as number of seconds since epoch
+        _tstamp = (value - datetime(1970,1,1)).total_seconds()
+        if self.__update_record(status, batch, **{name + "_time": _tstamp}):
+            return
         # Timestamps are stored in the time directory as files with names
         # concatanated from event name and job ID.
-        _fname = os.path.join(conf.gate_path_time, "submit_" + _jid)
-        # Calculate UNIX time stamp as number of seconds since epoch
-        _tstamp = (status.submit_time - datetime(1970,1,1)).total_seconds()
-        with file(_fname, 'a'):
-            os.utime(_fname, (_tstamp, _tstamp))
+        batch.touch(conf.gate_path_time, name + "_" + _jid, _tstamp)
 
-    def __start_time_change(self, status):
+    def __submit_time_change(self, status, batch):
         """
-        Propagate the start timestamp to the GW.
+        Propagate the submit timestamp to the GW.
 
         :param ststus: JobState instace
+        :param batch: GatewayBatch instance that collects the changes
         """
-        _jid = status.id
+        self.__time_change("submit", status.submit_time, status, batch)
 
-        logger.log(VERBOSE, "@FileStateManager: Start time change: %s (%s)",
-                status.start_time, _jid)
-        # Timestamps are stored in the time directory as files with names
-        # concatanated from event name and job ID.
-        _fname = os.path.join(conf.gate_path_time, "start_" + _jid)
-        # Calculate UNIX time stamp as number of seconds since epoch
-        _tstamp = (status.start_time - datetime(1970,1,1)).total_seconds()
-        with file(_fname, 'a'):
-            os.utime(_fname, (_tstamp, _tstamp))
+    def __start_time_change(self, status, batch):
+        """
+        Propagate the start timestamp to the GW.
 
-    def __stop_time_change(self, status):
+        :param ststus: JobState instace
+        :param batch: GatewayBatch instance that collects the changes
+        """
+        self.__time_change("start", status.start_time, status, batch)
+
+    def __stop_time_change(self, status, batch):
         """
         Propagate the stop timestamp to the GW.
 
         :param ststus: JobState instace
+        :param batch: GatewayBatch instance that collects the changes
         """
-        _jid = status.id
-
-        logger.log(VERBOSE, "@FileStateManager: Stop time change: %s (%s)",
-                status.stop_time, _jid)
-        # Timestamps are stored in the time directory as files with names
-        # concatanated from event name and job ID.
-        _fname = os.path.join(conf.gate_path_time, "stop_" + _jid)
-        # Calculate UNIX time stamp as number of seconds since epoch
-        _tstamp = (status.stop_time - datetime(1970,1,1)).total_seconds()
-        with file(_fname, 'a'):
-            os.utime(_fname, (_tstamp, _tstamp))
+        self.__time_change("stop", status.stop_time, status, batch)
 
-    def __wait_time_change(self, status):
+    def __wait_time_change(self, status, batch):
         """
         Propagate the wait timestamp to the GW.
 
         :param ststus: JobState instace
+        :param batch: GatewayBatch instance that collects the changes
         """
-        _jid = status.id
-
-        logger.log(VERBOSE, "@FileStateManager: Wait time change: %s (%s)",
-                status.wait_time, _jid)
-        # Timestamps are stored in the time directory as files with names
-        # concatanated from event name and job ID.
-        _fname = os.path.join(conf.gate_path_time, "wait_" + _jid)
-        # Calculate UNIX time stamp as number of seconds since epoch
-        _tstamp = (status.wait_time - datetime(1970,1,1)).total_seconds()
-        with file(_fname, 'a'):
-            os.utime(_fname, (_tstamp, _tstamp))
+        self.__time_change("wait", status.wait_time, status, batch)
 
-    def __flags_change(self, status):
+    def __flags_change(self, status, batch):
         """
         Propagate the changes in flags to the GW.
 
@@ -1668,62 +2038,29 @@ class FileStateManager(StateManager):
         by Server is used.
 
         :param status: - JobState instance
+        :param batch: GatewayBatch instance that collects the changes
         """
         _jid = status.id
-        _flags_add = []    # Flags to set
-        _flags_remove = [] # Flags to remove
 
         logger.log(VERBOSE, "@FileStateManager: Flags change: %s (%s)",
                 status.flags, _jid)
         # Consider only flags that were modified - have flags_dirty flag set
-        # Flags that are currently set are added to _flags_add
-        # Flags that are not set are added to _flags_remove
-        if status.flags_dirty & JobState.FLAG_DELETE:
-            _flag = 'flag_delete'
-            if status.flags & JobState.FLAG_DELETE:
-                _flags_add.append(_flag)
-            else:
-                _flags_remove.append(_flag)
-        if status.flags_dirty & JobState.FLAG_STOP:
-            _flag = 'flag_stop'
-            if status.flags & JobState.FLAG_STOP:
-                _flags_add.append(_flag)
-            else:
-                _flags_remove.append(_flag)
-        if status.flags_dirty & JobState.FLAG_WAIT_QUOTA:
-            _flag = 'flag_wait_quota'
-            if status.flags & JobState.FLAG_WAIT_QUOTA:
-                _flags_add.append(_flag)
-            else:
-                _flags_remove.append(_flag)
-        if status.flags_dirty & JobState.FLAG_WAIT_INPUT:
-            _flag = 'flag_wait_input'
-            if status.flags & JobState.FLAG_WAIT_INPUT:
-                _flags_add.append(_flag)
-            else:
-                _flags_remove.append(_flag)
-        if status.flags_dirty & JobState.FLAG_OLD_API:
-            _flag = 'flag_old_api'
-            if status.flags & JobState.FLAG_OLD_API:
-                _flags_add.append(_flag)
+        # Flags that are currently set are linked, flags that are not set are
+        # removed
+        for _value, _flag in (
+                (JobState.FLAG_DELETE, 'flag_delete'),
+                (JobState.FLAG_STOP, 'flag_stop'),
+                (JobState.FLAG_WAIT_QUOTA, 'flag_wait_quota'),
+                (JobState.FLAG_WAIT_INPUT, 'flag_wait_input'),
+                (JobState.FLAG_OLD_API, 'flag_old_api')):
+            if not status.flags_dirty & _value:
+                continue
+            if status.flags & _value:
+                # Mark new state in the shared file system
+                batch.link(conf.gate_path[_flag], _jid,
+                           os.path.join(conf.gate_path_jobs, _jid))
             else:
-                _flags_remove.append(_flag)
-
-        # Set new flags
-        for _flag in _flags_add:
-            _path = os.path.join(conf.gate_path[_flag], _jid)
-            # Mark new state in the shared file system
-            if not os.path.exists(_path):
-                os.symlink(
-                    os.path.join(conf.gate_path_jobs, _jid),
-                    _path
-                )
-
-        # Remove old flags
-        for _flag in _flags_remove:
-            _path = os.path.join(conf.gate_path[_flag], _jid)
-            if os.path.exists(_path):
-                os.unlink(_path)
+                batch.unlink(conf.gate_path[_flag], _jid)
 
         # Remove the dirty flag
         status.flags_dirty = 0
@@ -0,0 +1,192 @@
+# -*- coding: UTF-8 -*-
+"""
+Module with the background remover of the dump directory.
+
+Directories to be removed (job output, replaced output) are renamed into the
+gate_path_dump directory by :py:func:`dump`. The rename is fast and safe for
+processes still reading the files. The :py:class:`DumpReaper` thread owns the
+dump directory and removes its contents at a limited rate, so removal of large
+output trees does not block the main loop or the workers and does not saturate
+the file system. Contents left in the dump directory by a previous run are
+removed after a restart.
+"""
+
+import os
+import stat
+import time
+import shutil
+import threading
+import logging
+
+from Config import conf, VERBOSE
+
+logger = logging.getLogger(__name__)
+
+
+def dump(path, name):
+    """
+    Move a file or directory to the dump directory to be removed by the
+    reaper. The dump directory should be on the same file system as path so
+    that a rename is used.
+
+    :param path: path to remove.
+    :param name: name of the entry in the dump directory (e.g. job ID). A
+        unique suffix is appended.
+    """
+    _target = os.path.join(conf.gate_path_dump, "%s.%.6f.%s" %
+                           (name, time.time(), os.getpid()))
+    shutil.move(path, _target)
+
+
+class DumpReaper(object):
+    """
+    Background thread removing contents of the dump directory.
+
+    The rate of removal is limited to files_rate files and bytes_rate bytes per
+    second (zero means no limit).
+    """
+
+    def __init__(self, path, files_rate=0, bytes_rate=0, interval=10):
+        """
+        :param path: dump directory.
+        :param files_rate: maximum number of removed files per second.
+        :param bytes_rate: maximum number of removed bytes per second.
+        :param interval: interval in seconds between scans of the dump
+            directory.
+        """
+        #: Dump directory
+        self.path = path
+        #: Maximum number of removed files per second
+        self.files_rate = files_rate
+        #: Maximum number of removed bytes per second
+        self.bytes_rate = bytes_rate
+        #: Interval in seconds between scans of a dump directory that is empty
+        #: or whose entries cannot be removed
+        self.interval = interval
+        #: Number of entries of the dump directory waiting for removal
+        self.pending = 0
+        #: Total number of removed files
+        self.removed_files = 0
+        #: Total number of removed bytes
+        self.removed_bytes = 0
+        #: Event set to stop the reaper
+        self.stopped = threading.Event()
+        #: Reaper thread
+        self.thread = None
+        #: Start of the current rate limit window and files and bytes
+        #: removed in it
+        self.__window = (0, 0, 0)
+
+    def start(self):
+        """ Start the reaper thread. """
+        self.thread = threading.Thread(target=self.run, name="DumpReaper")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """ Stop the reaper thread. Unfinished removals resume on restart. """
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def backlog(self):
+        """
+        Get reaper metrics.
+
+        :return: dict with the number of pending entries and totals of removed
+            files and bytes.
+        """
+        return {'pending': self.pending, 'removed_files': self.removed_files,
+                'removed_bytes': self.removed_bytes}
+
+    def run(self):
+        """ Reaper thread main loop. """
+        while not self.stopped.is_set():
+            try:
+                _names = os.listdir(self.path)
+            except OSError:
+                logger.error("@Reaper - Unable to list dump directory %s.",
+                             self.path, exc_info=True)
+                _names = []
+            self.pending = len(_names)
+            _removed = 0
+            for _name in _names:
+                if self.stopped.is_set():
+                    return
+                _start = time.time()
+                if self.remove(os.path.join(self.path, _name)):
+                    _removed += 1
+                    self.pending -= 1
+                    logger.log(VERBOSE, "@Reaper - Removed %s in %.3fs.",
+                               _name, time.time() - _start)
+            # Entries that cannot be removed are retried after the interval
+            if not _removed:
+                self.stopped.wait(self.interval)
+
+    def remove(self, path):
+        """
+        Remove a file or a directory tree respecting the rate limits.
+
+        :param path: path to remove.
+        :return: True if the path was removed.
+        """
+        try:
+            if not stat.S_ISDIR(os.lstat(path).st_mode):
+                return self.__unlink(path)
+        except OSError:
+            logger.error("@Reaper - Cannot remove %s.", path, exc_info=True)
+            return False
+
+        for _root, _dirs, _files in os.walk(path, topdown=False):
+            for _file in _files:
+                if self.stopped.is_set():
+                    return False
+                self.__unlink(os.path.join(_root, _file))
+            for _dir in _dirs:
+                _name = os.path.join(_root, _dir)
+                # os.walk lists links to directories as directories
+                if os.path.islink(_name):
+                    self.__unlink(_name)
+                    continue
+                try:
+                    os.rmdir(_name)
+                except OSError:
+                    logger.error("@Reaper - Cannot remove %s.", _name,
+                                 exc_info=True)
+        try:
+            os.rmdir(path)
+        except OSError:
+            logger.error("@Reaper - Cannot remove %s.", path, exc_info=True)
+            return False
+        return True
+
+    def __unlink(self, path):
+        """
+        Remove a file and wait if the rate limit is exceeded.
+
+        :return: True if the file was removed.
+        """
+        _size = 0
+        try:
+            if self.bytes_rate:
+                _size = os.lstat(path).st_size
+            os.unlink(path)
+        except OSError:
+            logger.error("@Reaper - Cannot remove %s.", path, exc_info=True)
+            return False
+        self.removed_files += 1
+        self.removed_bytes += _size
+
+        _now = time.time()
+        _start, _files, _bytes = self.__window
+        if _now - _start >= 1:
+            _start, _files, _bytes = _now, 0, 0
+        _files += 1
+        _bytes += _size
+        if (self.files_rate and _files >= self.files_rate) or \
+                (self.bytes_rate and _bytes >= self.bytes_rate):
+            # Budget of the current second is used up
+            self.stopped.wait(max(0, _start + 1 - _now))
+            _start, _files, _bytes = time.time(), 0, 0
+        self.__window = (_start, _files, _bytes)
+        return True
@@ -4,17 +4,29 @@ Module with implementations of the Scheduler interface.
 """
 
 import os
+import sys
+import errno
+import fcntl
+import ctypes
+import ctypes.util
+import importlib
+import signal
+import pipes
 import xml.etree.cElementTree as ET
 import stat
 import re
 import shutil
+import tempfile
 import logging
-import spur
 import threading
+import multiprocessing
 import random
+import time
+
+from multiprocessing.pool import ThreadPool
 
 # Import subprocess32 module from pip
-from subprocess32 import Popen, PIPE, STDOUT, TimeoutExpired
+from subprocess32 import Popen, PIPE, STDOUT
 
 from jinja2 import Environment, FileSystemLoader, Template
 
@@ -24,6 +36,8 @@ import Jobs  # Import full module - resolves circular dependencies
 import Globals as G
 from Config import conf, VERBOSE, ExitCodes
 from Tools import rollback
+from Connections import SshConnectionPool
+from Reaper import dump
 
 logger = logging.getLogger(__name__)
 
@@ -39,6 +53,414 @@ def rmtree_error(function, path, exc_info):
                  (function, path), exc_info=exc_info)
 
 
+class SlotCounter(object):
+    """
+    Counter of job slots used in a scheduler.
+
+    The counter is shared by JobManager with the worker processes (passed on
+    worker initialisation) so that slots are reserved atomically on submit and
+    released on job cleanup without counting jobs in the DB.
+    """
+
+    def __init__(self, limit):
+        """
+        :param limit: maximum number of concurrent jobs. A dict with limits
+            per execution host is summed up into one limit shared by all
+            hosts. Jobs are not counted per host, so a single host can take
+            all slots.
+        """
+        if isinstance(limit, dict):
+            limit = sum(limit.values())
+        #: Maximum number of concurrent jobs
+        self.limit = limit
+        #: Number of used job slots
+        self.used = multiprocessing.Value('i', 0)
+
+    def reserve(self, count=1):
+        """
+        Reserve free job slots.
+
+        :param count: number of requested slots.
+        :return: number of reserved slots, at most count.
+        """
+        with self.used.get_lock():
+            _count = max(0, min(count, self.limit - self.used.value))
+            self.used.value += _count
+        return _count
+
+    def release(self, count=1):
+        """
+        Return job slots.
+
+        :param count: number of returned slots.
+        """
+        with self.used.get_lock():
+            self.used.value = max(0, self.used.value - count)
+
+    def reset(self, used):
+        """
+        Set the number of used job slots, e.g. to the number of jobs found in
+        the DB.
+        """
+        with self.used.get_lock():
+            self.used.value = used
+
+
+#: ioctl request cloning a file (reflink) on btrfs, XFS and other CoW file
+#: systems
+FICLONE = 0x40049409
+
+
+def copy_static(source, target, mode, link=False):
+    """
+    Materialize a static file in a job work directory.
+
+    A hardlink is used if allowed, otherwise the file is cloned (reflink)
+    where the file system supports it and copied if it does not.
+
+    :param source: source file name.
+    :param target: target file name.
+    :param mode: permissions of the target file.
+    :param link: if True the target may be a hardlink of the source (the
+        source must already have the same mode).
+    """
+    if link:
+        try:
+            os.link(source, target)
+            return
+        except OSError:
+            pass
+    with open(source, 'rb') as _fin:
+        with open(target, 'wb') as _fou:
+            try:
+                fcntl.ioctl(_fou.fileno(), FICLONE, _fin.fileno())
+            except IOError:
+                shutil.copyfileobj(_fin, _fou, 65536)
+            os.fchmod(_fou.fileno(), mode)
+
+
+def has_markup(file_name, markup):
+    """
+    Check if a file contains any of the markup strings. The file is read in
+    chunks so large data files do not have to fit in memory.
+
+    :param file_name: file name.
+    :param markup: list of strings.
+    """
+    _overlap = max(len(_m) for _m in markup) - 1
+    _tail = ''
+    with open(file_name, 'rb') as _f:
+        while True:
+            _chunk = _f.read(1048576)
+            if not _chunk:
+                return False
+            _chunk = _tail + _chunk
+            if any(_m in _chunk for _m in markup):
+                return True
+            _tail = _chunk[-_overlap:]
+
+
+def make_readable(path):
+    """
+    Make a directory tree readable by everyone in a single pass. Only the
+    entries missing the permissions are changed. Symbolic links are not
+    followed.
+
+    :param path: directory path.
+    :return: number of changed entries.
+    """
+    _dir_bits = stat.S_IRUSR | stat.S_IXUSR | stat.S_IRGRP | stat.S_IXGRP | \
+        stat.S_IROTH | stat.S_IXOTH
+    _file_bits = stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH
+    _count = 0
+    _st = os.lstat(path)
+    if _st.st_mode & _dir_bits != _dir_bits:
+        os.chmod(path, stat.S_IMODE(_st.st_mode) | _dir_bits)
+        _count += 1
+    _dirs = [path]
+    while _dirs:
+        _dir = _dirs.pop()
+        try:
+            _names = os.listdir(_dir)
+        except OSError:
+            logger.error("@Scheduler - Unable to list directory %s.", _dir,
+                         exc_info=True)
+            continue
+        for _name in _names:
+            _name = os.path.join(_dir, _name)
+            try:
+                _st = os.lstat(_name)
+                if stat.S_ISDIR(_st.st_mode):
+                    _bits = _dir_bits
+                    _dirs.append(_name)
+                elif stat.S_ISREG(_st.st_mode):
+                    _bits = _file_bits
+                else:
+                    continue
+                # Directories are changed before they are listed
+                if _st.st_mode & _bits != _bits:
+                    os.chmod(_name, stat.S_IMODE(_st.st_mode) | _bits)
+                    _count += 1
+            except OSError:
+                logger.error("@Scheduler - Unable to change permissions of "
+                             "%s.", _name, exc_info=True)
+    return _count
+
+
+#: renameat2 flag exchanging two paths atomically (Linux 3.15 and newer)
+RENAME_EXCHANGE = 2
+#: Directory file descriptor meaning the current working directory
+AT_FDCWD = -100
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+except OSError:
+    _libc = None
+
+
+def exchange(source, target):
+    """
+    Atomically exchange two paths.
+
+    :param source: first path.
+    :param target: second path.
+    :raises OSError: if the exchange failed. ENOSYS or EINVAL if it is not
+        supported by the system or the file system.
+    """
+    _renameat2 = getattr(_libc, 'renameat2', None)
+    if _renameat2 is None:
+        raise OSError(errno.ENOSYS, os.strerror(errno.ENOSYS), target)
+    _encoding = sys.getfilesystemencoding() or 'utf-8'
+    if isinstance(source, unicode):
+        source = source.encode(_encoding)
+    if isinstance(target, unicode):
+        target = target.encode(_encoding)
+    if _renameat2(AT_FDCWD, source, AT_FDCWD, target, RENAME_EXCHANGE):
+        _errno = ctypes.get_errno()
+        raise OSError(_errno, os.strerror(_errno), target)
+
+
+def publish(work_dir, job_id):
+    """
+    Move a job working directory to the output directory.
+
+    The directory appears in the output directory at once (rename). When the
+    working directory is on another file system it is copied under a
+    temporary name first. Existing output of the job is atomically exchanged
+    with the new one and moved to the dump directory afterwards, so the job
+    output never disappears. Where the exchange is not supported the old
+    output is renamed aside right before the new one is renamed in, leaving
+    a window of two renames without output.
+
+    :param work_dir: job working directory.
+    :param job_id: job ID.
+    """
+    _out_dir = os.path.join(conf.gate_path_output, job_id)
+    _src_dir = work_dir
+    try:
+        if os.stat(work_dir).st_dev != os.stat(conf.gate_path_output).st_dev:
+            _tmp_dir = os.path.join(conf.gate_path_output, '.%s.tmp' % job_id)
+            shutil.rmtree(_tmp_dir, ignore_errors=True)
+            shutil.copytree(work_dir, _tmp_dir, symlinks=True)
+            _src_dir = _tmp_dir
+        if os.path.isdir(_out_dir):
+            logger.debug('@Scheduler - Replace existing output directory')
+            try:
+                # Old output is left in _src_dir
+                exchange(_src_dir, _out_dir)
+                _old_dir = _src_dir
+            except OSError as e:
+                if e.errno not in (errno.ENOSYS, errno.EINVAL):
+                    raise
+                _old_dir = os.path.join(conf.gate_path_output,
+                                        '.%s.old' % job_id)
+                shutil.rmtree(_old_dir, ignore_errors=True)
+                os.rename(_out_dir, _old_dir)
+                os.rename(_src_dir, _out_dir)
+            # out and dump should be on the same partition so that rename
+            # is used. This will make sure that processes reading from out
+            # will not cause rmtree to throw exceptions
+            dump(_old_dir, job_id)
+        else:
+            os.rename(_src_dir, _out_dir)
+    except:
+        if _src_dir != work_dir:
+            shutil.rmtree(_src_dir, ignore_errors=True)
+        raise
+    if _src_dir != work_dir:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def link_tree(source, target, mode):
+    """
+    Recreate a directory tree with files linked to the files of the source
+    tree.
+
+    Files linked with "hardlink" or "symlink" are made read-only, so that
+    they cannot be modified through the links. Only files owned by the
+    AppServer user are changed, writable files of other users (e.g. output
+    written by the batch system) are copied instead. Files that cannot be
+    linked (other file system, EPERM/EACCES e.g. with fs.protected_hardlinks)
+    are copied as well.
+
+    Symlinks point to the output of the source job. If the source job is
+    deleted while the chained job runs, the links are left dangling.
+
+    :param source: source directory.
+    :param target: target directory, must not exist.
+    :param mode: "reflink", "hardlink" or "symlink".
+    :raises ValueError: for unknown modes.
+    """
+    if mode not in ('reflink', 'hardlink', 'symlink'):
+        raise ValueError("Unknown chain mode: %s" % mode)
+
+    _write = stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH
+    os.mkdir(target)
+    for _root, _dirs, _files in os.walk(source):
+        _out_dir = os.path.join(target, os.path.relpath(_root, source))
+        for _dir in _dirs:
+            _name = os.path.join(_root, _dir)
+            if os.path.islink(_name):
+                # os.walk does not follow links, keep them as they are
+                os.symlink(os.readlink(_name), os.path.join(_out_dir, _dir))
+            else:
+                os.mkdir(os.path.join(_out_dir, _dir))
+        for _file in _files:
+            _name = os.path.join(_root, _file)
+            _out_name = os.path.join(_out_dir, _file)
+            if os.path.islink(_name):
+                os.symlink(os.readlink(_name), _out_name)
+                continue
+            _st = os.stat(_name)
+            _mode = stat.S_IMODE(_st.st_mode)
+            _link = mode != 'reflink'
+            # Protect the source from modification through the links
+            if _link and _mode & _write:
+                _link = _st.st_uid == os.geteuid()
+                try:
+                    if _link:
+                        os.chmod(_name, _mode & ~_write)
+                        _mode &= ~_write
+                except OSError as e:
+                    if e.errno not in (errno.EPERM, errno.EACCES):
+                        raise
+                    _link = False
+            if _link:
+                try:
+                    if mode == 'hardlink':
+                        os.link(_name, _out_name)
+                    else:
+                        os.symlink(os.path.abspath(_name), _out_name)
+                    continue
+                except OSError as e:
+                    if e.errno not in (errno.EXDEV, errno.EPERM,
+                                       errno.EACCES):
+                        raise
+            copy_static(_name, _out_name, _mode)
+
+
+class ScriptBundle(object):
+    """
+    Scripts and input files of a service compiled once per service (when
+    services are loaded).
+
+    Holds the directory skeleton of the service data directory, compiled
+    templates and file modes, so that scripts of a job are generated without
+    walking the service data tree. Only files with template markup are
+    rendered, static files are linked or copied (:py:func:`copy_static`).
+    """
+
+    #: Markup starting template variables, statements and comments
+    markup = ('@@{', '{%', '{#')
+
+    def __init__(self, service):
+        """
+        :param service: name of the service.
+        """
+        #: Service name
+        self.service = service
+        #: Service data directory
+        self.path = os.path.join(conf.service_path_data, service)
+        #: Subdirectories (relative paths) in the order of creation
+        self.dirs = []
+        #: Files: list of (relative path, compiled template, mode, hardlink
+        #: allowed). The template is None for static files
+        self.files = []
+        #: Message explaining why scripts cannot be generated
+        self.error = None
+        #: Jinja2 environment configuration
+        self.template_env = Environment(
+            loader=FileSystemLoader(conf.service_path_data),
+            variable_start_string=r'@@{',
+            variable_end_string=r'}',
+            trim_blocks=True,
+            lstrip_blocks=True
+        )
+        self.compile()
+
+    def compile(self):
+        """ Walk through the service data directory and compile templates. """
+        # Verify that input dir exists
+        if not os.path.isdir(self.path):
+            self.error = "Service data directory not found: %s." % self.path
+            return
+
+        # Verify that input dir contains "pbs.sh" and "epilogue.sh" scripts
+        for _script in ('pbs.sh', 'epilogue.sh'):
+            if not os.path.isfile(os.path.join(self.path, _script)):
+                self.error = "Missing \"%s\" script for service %s." % \
+                    (_script, self.service)
+                return
+
+        for _path, _dirs, _files in os.walk(self.path):
+            # Relative paths for subdirectories
+            _sub_dir = os.path.relpath(_path, self.path)
+            for _dir in _dirs:
+                self.dirs.append(os.path.normpath(os.path.join(_sub_dir, _dir)))
+            for _file in _files:
+                # Skip editor buffers and recovery files
+                if _file.endswith('~'):
+                    continue
+                if _file.startswith('.') and _file.endswith('.swp'):
+                    continue
+                _name = os.path.normpath(os.path.join(_sub_dir, _file))
+                try:
+                    self.files.append(self.compile_file(_name))
+                except:
+                    logger.error("@Scheduler - Unable to compile template "
+                                 "%s/%s.", self.service, _name, exc_info=True)
+                    self.error = "Unable to compile template %s/%s." % \
+                        (self.service, _name)
+                    return
+
+    def compile_file(self, name):
+        """
+        Compile a single file of the service.
+
+        :param name: path of the file relative to the service data directory.
+        :return: tuple (name, template, mode, hardlink allowed).
+        """
+        _source = os.path.join(self.path, name)
+        _template = None
+        if has_markup(_source, self.markup):
+            _template = self.template_env.get_template(
+                os.path.join(self.service, name))
+
+        _source_mode = stat.S_IMODE(os.stat(_source).st_mode)
+        _mode = _source_mode
+        # Make sure that "pbs.sh" is executable
+        if name == 'pbs.sh':
+            _mode |= stat.S_IXUSR
+        # Make sure that "epilogue.sh" is executable
+        # Make sure it is not writable by group and others - torque will
+        # silently ignore it otherwise
+        elif name == 'epilogue.sh':
+            _mode = (_mode | stat.S_IXUSR) & ~stat.S_IWGRP & ~stat.S_IWOTH
+        # Hardlinks share permissions with the source
+        _link = conf.service_data_hardlink and _mode == _source_mode
+        return name, _template, _mode, _link
+
+
 class Scheduler(object):
     """
     Virtual Class implementing simple interface for execution backend. Actual
@@ -52,6 +474,10 @@ class Scheduler(object):
     # burden lets do it every n-th step
     __progress_step = 0
 
+    #: Settings that may be overridden by :py:meth:`configure`
+    options = ('default_queue', 'max_jobs', 'pool_size', 'batch_size',
+               'poll_interval')
+
     def __init__(self):
         #: Working directory path
         self.work_path = None
@@ -61,14 +487,44 @@ class Scheduler(object):
         self.default_queue = None
         #: Maximum number of concurrent jobs
         self.max_jobs = None
-        #: Jinja2 environment configuration
-        self.template_env = Environment(
-            loader=FileSystemLoader(conf.service_path_data),
-            variable_start_string=r'@@{',
-            variable_end_string=r'}',
-            trim_blocks=True,
-            lstrip_blocks=True
-        )
+        #: Maximum number of concurrent status checks
+        self.pool_size = 1
+        #: Maximum number of jobs submitted by a single call
+        self.batch_size = 1
+        #: Minimum interval in seconds between job state updates
+        self.poll_interval = 0
+        #: Time of the last job state update
+        self.last_update = 0
+        #: Counter of used job slots (:py:class:`SlotCounter`)
+        self.slots = None
+
+    def configure(self, options):
+        """
+        Override scheduler settings, e.g. with scheduler_options from the
+        config.
+
+        :param options: dict with values of attributes listed in
+            :py:attr:`Scheduler.options`.
+        :raises ValueError: for unknown settings.
+        """
+        for _key, _value in options.items():
+            if _key not in Scheduler.options:
+                raise ValueError("Unknown setting of scheduler %s: %s" %
+                                 (self.name, _key))
+            setattr(self, _key, _value)
+
+    def update_due(self):
+        """
+        Check if job states should be updated. Updates are run at most every
+        poll_interval seconds.
+
+        :return: True if the update is due.
+        """
+        _now = time.time()
+        if _now - self.last_update < self.poll_interval:
+            return False
+        self.last_update = _now
+        return True
 
     def submit(self, job):
         """
@@ -80,6 +536,24 @@ class Scheduler(object):
         """
         raise NotImplementedError
 
+    def submit_batch(self, jobs):
+        """
+        Submit a batch of jobs for execution. Schedulers able to submit many
+        jobs at once should override it. By default jobs are submitted one by
+        one.
+
+        :param jobs: list of :py:class:`Job` instances
+        :return: list with True for every submitted job and False otherwise.
+        """
+        _results = []
+        for _job in jobs:
+            try:
+                _results.append(self.submit(_job))
+            except:
+                _job.die("Unable to submit job.", exc_info=True)
+                _results.append(False)
+        return _results
+
     def progress(self, job):
         """
         Extract the job progress log and expose it to the user.
@@ -113,6 +587,10 @@ class Scheduler(object):
         """Stop running job and remove it from execution queue."""
         raise NotImplementedError
 
+    def close(self):
+        """ Release resources held by the scheduler (threads, connections). """
+        pass
+
     def finalise(self, job):
         """
         Prepare output of finished job.
@@ -138,40 +616,18 @@ class Scheduler(object):
                          "directory %s", _work_dir, exc_info=True)
 
         if os.path.isdir(_work_dir):
+            _start = time.time()
             try:
-                # Remove output dir if it exists.
-                _out_dir = os.path.join(conf.gate_path_output, _jid)
-                _dump_dir = os.path.join(conf.gate_path_dump, _jid)
-                if os.path.isdir(_out_dir):
-                    logger.debug('@Scheduler - Remove existing output directory')
-                    # out and dump should be on the same partition so that rename
-                    # is used. This will make sure that processes reading from out
-                    # will not cause rmtree to throw exceptions
-                    shutil.move(_out_dir, _dump_dir)
-                    shutil.rmtree(_dump_dir, ignore_errors=True)
-                shutil.move(_work_dir, conf.gate_path_output)
-
-                # Make sure all files in the output directory are world readable -
-                # so that apache can actually serve them
+                # Make sure all files in the output directory are world
+                # readable - so that apache can actually serve them. Done
+                # before publishing so that incomplete output is never
+                # served
                 logger.debug('@Scheduler - Make output directory world readable')
-                os.chmod(_out_dir, os.stat(_out_dir).st_mode |
-                         stat.S_IRUSR | stat.S_IXUSR |
-                         stat.S_IRGRP | stat.S_IXGRP |
-                         stat.S_IROTH | stat.S_IXOTH)
-                for _root, _dirs, _files in os.walk(_out_dir):
-                    for _dir in _dirs:
-                        _name = os.path.join(_root, _dir)
-                        os.chmod(_name, os.stat(_name).st_mode |
-                                 stat.S_IRUSR | stat.S_IXUSR |
-                                 stat.S_IRGRP | stat.S_IXGRP |
-                                 stat.S_IROTH | stat.S_IXOTH)
-                    for _file in _files:
-                        _name = os.path.join(_root, _file)
-                        try:
-                            os.chmod(_name, os.stat(_name).st_mode |
-                                 stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
-                        except Exception as e:
-                            print e
+                _fixed = make_readable(_work_dir)
+                publish(_work_dir, _jid)
+                logger.debug("@Scheduler - Job %s output published in %.3fs "
+                             "(permissions of %s entries changed).", _jid,
+                             time.time() - _start, _fixed)
             except:
                 job.die("@Scheduler - Unable to retrive job output directory %s" %
                         _work_dir, exc_info=True)
@@ -182,7 +638,9 @@ class Scheduler(object):
 
         # Remove job from scheduler queue if it was queued
         try:
-            job.scheduler = None
+            if job.scheduler is not None:
+                job.scheduler = None
+                self.slots.release()
         except:
             logger.error("@Scheduler - Unable to remove job SchedulerQueue.",
                          exc_info=True)
@@ -215,7 +673,11 @@ class Scheduler(object):
         # Remove output dir if it exists.
         if os.path.isdir(_out_dir):
             logger.debug('@Scheduler - Remove existing output directory')
-            shutil.rmtree(_out_dir, ignore_errors=True)
+            try:
+                dump(_out_dir, _jid)
+            except:
+                logger.error("@Scheduler - Unable to move job output "
+                             "directory to dump: %s", _jid, exc_info=True)
         # Remove work dir if it exists.
         if os.path.isdir(_work_dir):
             logger.debug('@Scheduler - Remove working directory')
@@ -234,7 +696,9 @@ class Scheduler(object):
 
         # Remove job from scheduler queue if it was queued
         try:
-            job.scheduler = None
+            if job.scheduler is not None:
+                job.scheduler = None
+                self.slots.release()
         except:
             logger.error("@Scheduler - Unable to remove job SchedulerQueue.",
                          exc_info=True)
@@ -252,32 +716,24 @@ class Scheduler(object):
         """
         Generate scripts and job input files from templates.
 
-        Will walk through service_data_path/service and copy all files
-        including recursion through subdirectories to PBS work directory for
-        specified job (the directory structure is retained). For all files
-        substitute all occurences of @@{atribute_name} with specified values.
+        Will copy all files of service_data_path/service including
+        subdirectories to PBS work directory for specified job (the directory
+        structure is retained). For all files substitute all occurences of
+        @@{atribute_name} with specified values. The files are taken from
+        the :py:class:`ScriptBundle` of the service, files without template
+        markup are copied as they are.
 
         :param job: :py:class:`Job` instance after validation
         :return: True on success and False otherwise.
         """
-
-        # Input directory
-        _script_dir = os.path.join(conf.service_path_data, job.status.service)
+        # Scripts and templates compiled for the service
+        _bundle = G.SERVICE_STORE.get_bundle(job.status.service)
+        if _bundle.error is not None:
+            job.die("@Scheduler - %s" % _bundle.error)
+            return False
         # Output directory
         _work_dir = os.path.join(self.work_path, job.id())
 
-        # Verify that input dir exists
-        if not os.path.isdir(_script_dir):
-            job.die("@Scheduler - Service data directory not found: %s." %
-                    _script_dir)
-            return False
-
-        # Verify that input dir contains "pbs.sh" script
-        if not os.path.isfile(os.path.join(_script_dir, 'pbs.sh')):
-            job.die("@Scheduler - Missing \"pbs.sh\" script for service %s." %
-                    job.status.service)
-            return False
-
         # Create output dir
         if not os.path.isdir(_work_dir):
             try:
@@ -287,84 +743,37 @@ class Scheduler(object):
                         _work_dir, exc_info=True)
                 return False
 
-        # Recurse through input dir
         logger.debug("@Scheduler - generate scripts")
-        for _path, _dirs, _files in os.walk(_script_dir):
-            # Relative paths for subdirectories
-            _sub_dir = os.path.relpath(_path, _script_dir)
-            logger.debug("@Scheduler - Sub dir: %s", _sub_dir)
-            if _sub_dir != '.':
-                _out_dir = os.path.join(_work_dir, _sub_dir)
-            else:
-                _out_dir = _work_dir
-
-            # Create subdirectories in output dir
-            for _dir in _dirs:
-                _name = os.path.join(_out_dir, _dir)
-                try:
-                    os.mkdir(_name)
-                except:
-                    job.die(
-                        "@Scheduler - Cannot create job subdirectory %s." %
-                        _name, exc_info=True
-                    )
-                    return False
+        # Create subdirectories in output dir
+        for _dir in _bundle.dirs:
+            _name = os.path.join(_work_dir, _dir)
+            try:
+                os.mkdir(_name)
+            except:
+                job.die(
+                    "@Scheduler - Cannot create job subdirectory %s." %
+                    _name, exc_info=True
+                )
+                return False
 
-            # Iterate through script files in current subdir
-            for _file in _files:
-                # Skip editor buffers and recovery files
-                if _file.endswith('~'):
-                    continue
-                if _file.startswith('.') and _file.endswith('.swp'):
+        # Render script files
+        for _file, _template, _mode, _link in _bundle.files:
+            _fou_name = os.path.join(_work_dir, _file)
+            try:
+                if _template is None:
+                    copy_static(os.path.join(_bundle.path, _file), _fou_name,
+                                _mode, _link)
                     continue
-                # Input and output file names
-                _fin_name = os.path.join(_path, _file)
-                _fou_name = os.path.join(_out_dir, _file)
-                _template_name = os.path.join(job.status.service, _sub_dir, _file)
-                try:
-                    # Open input template script and output file
-                    template = self.template_env.get_template(_template_name)
-                    _fou = open(_fou_name, 'w')
-
-                    #_fou.write(template.render(job.data.data))
-                    _fou.writelines(template.generate(job.data.data))
-                    _fou.close()
+                with open(_fou_name, 'w') as _fou:
+                    _fou.writelines(_template.generate(job.data.data))
                     # Copy file permisions
-                    _st = os.stat(_fin_name)
-                    os.chmod(_fou_name, _st.st_mode)
-                except TypeError:
-                    job.die(
-                        "@Scheduler - Scripts creation failed for job: %s." %
-                        job.id(), exc_info=True
-                    )
-                    return False
-
-        # Make sure that "pbs.sh" is executable
-        try:
-            _st = os.stat(os.path.join(_script_dir, 'pbs.sh'))
-            os.chmod(os.path.join(_work_dir, 'pbs.sh'),
-                     _st.st_mode | stat.S_IXUSR)
-        except:
-            job.die(
-                "@Scheduler - Unable to change permissions for pbs.sh: %s." %
-                job.id(), exc_info=True
-            )
-            return False
-
-        # Make sure that "epilogue.sh" is executable
-        # Make sure it is not writable by group and others - torque will
-        # silently ignore it otherwise
-        try:
-            _st = os.stat(os.path.join(_script_dir, 'epilogue.sh'))
-            os.chmod(os.path.join(_work_dir, 'epilogue.sh'),
-                     (_st.st_mode | stat.S_IXUSR) &
-                     (~stat.S_IWGRP & ~stat.S_IWOTH))
-        except:
-            job.die(
-                "@Scheduler - Unable to change permissions for epilogue.sh: "
-                "%s." % job.id(), exc_info=True
-            )
-            return False
+                    os.fchmod(_fou.fileno(), _mode)
+            except TypeError:
+                job.die(
+                    "@Scheduler - Scripts creation failed for job: %s." %
+                    job.id(), exc_info=True
+                )
+                return False
 
         return True
 
@@ -373,12 +782,14 @@ class Scheduler(object):
         Chain output data of finished jobs as our input.
 
         Copies output data of specified job IDs into the working directory of
-        current job.
+        current job. Depending on the chain_mode of the service the files are
+        copied, cloned or linked (:py:func:`link_tree`).
 
         :param job: :py:class:`Job` instance after validation
         :return: True on success and False otherwise.
         """
         logger.debug('@Scheduler - Chaining input data')
+        _mode = G.SERVICE_STORE[job.status.service].config['chain_mode']
         _work_dir = os.path.join(self.work_path, job.id())
         for _cjob in job.chain:
             _id = _cjob.id
@@ -386,7 +797,10 @@ class Scheduler(object):
             _output_dir = os.path.join(_work_dir, _id)
             if os.path.exists(_input_dir):
                 try:
-                    shutil.copytree(_input_dir, _output_dir)
+                    if _mode == 'copy':
+                        shutil.copytree(_input_dir, _output_dir)
+                    else:
+                        link_tree(_input_dir, _output_dir, _mode)
                     logger.debug(
                         "@Scheduler - Job %s output chained as input for "
                         "Job %s", _id, job.id())
@@ -406,6 +820,185 @@ class Scheduler(object):
         return True
 
 
+def parse_qstat(source):
+    """
+    Extract job states from the XML output of "qstat -f -x".
+
+    The output is parsed as a stream and every job element is cleared as soon
+    as its state is extracted, so memory usage does not grow with the size of
+    the job history kept by PBS.
+
+    :param source: file name or file object with the qstat output.
+    :return: dict {PBS ID: (state, exit status)}. Exit status is None for
+        jobs that did not finish.
+    """
+    _job_states = {}
+    try:
+        for _event, _xelem in ET.iterparse(source):
+            if _xelem.tag == 'Job':
+                _job_states[_xelem.findtext('Job_Id')] = (
+                    _xelem.findtext('job_state'),
+                    _xelem.findtext('exit_status')
+                )
+                _xelem.clear()
+    except ET.ParseError as e:
+        # qstat does not output anything when there are no jobs. Truncated
+        # output of a killed qstat is caught by its exit code
+        if _job_states or not str(e).startswith('no element found'):
+            raise
+    return _job_states
+
+
+class QstatPoller(object):
+    """
+    Background poller of PBS job states.
+
+    qstat is run for all service users concurrently by a bounded pool of
+    threads every poll interval seconds. The last snapshot of job states is
+    kept per user together with the time the poll was started. When qstat
+    fails for a user the previous snapshot of this user is kept.
+    """
+
+    def __init__(self, users, threads=1, interval=0):
+        """
+        :param users: list of user names whose jobs are polled.
+        :param threads: maximum number of concurrent qstat calls.
+        :param interval: interval in seconds between polls.
+        """
+        #: User names whose jobs are polled
+        self.users = users
+        #: Maximum number of concurrent qstat calls
+        self.threads = threads
+        #: Interval in seconds between polls
+        self.interval = interval
+        #: Last snapshot per user: {user: (poll start time, {PBS ID: (state,
+        #: exit status)})}
+        self.snapshots = {}
+        #: Time jobs missing in the snapshot were first asked for: {PBS ID:
+        #: time}
+        self.missing = {}
+        #: Lock protecting the snapshots
+        self.lock = threading.Lock()
+        #: Event set to stop the poller
+        self.stopped = threading.Event()
+        #: Poller thread
+        self.thread = None
+
+    def start(self):
+        """ Start the poller thread. """
+        self.thread = threading.Thread(target=self.run, name="QstatPoller")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """ Stop the poller thread and wait for running qstat calls. """
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join(conf.pbs_timeout)
+
+    def run(self):
+        """ Poller thread main loop. """
+        _pool = ThreadPool(self.threads)
+        try:
+            while not self.stopped.is_set():
+                _start = time.time()
+                _pool.map(self.poll, list(self.users))
+                self.stopped.wait(
+                    max(0, self.interval - (time.time() - _start))
+                )
+        finally:
+            _pool.close()
+
+    def poll(self, user):
+        """
+        Run qstat for jobs of a user and store the snapshot.
+
+        :param user: user name.
+        """
+        _start = time.time()
+        try:
+            # Run qstat
+            logger.log(VERBOSE, "@PBS - Check jobs state for user %s", user)
+            _opts = ["/usr/bin/qstat", "-f", "-x", "-u", user]
+            logger.log(VERBOSE, "@PBS - Running command: %s", _opts)
+            # stderr is read only after qstat exits. Store it in a file so
+            # that qstat does not block on a full pipe.
+            with tempfile.TemporaryFile() as _stderr:
+                _proc = Popen(_opts, stdout=PIPE, stderr=_stderr)
+                # Parse the XML output while it is produced. Kill qstat if it
+                # does not finish in time
+                _timer = threading.Timer(conf.pbs_timeout, _proc.kill)
+                _timer.start()
+                try:
+                    _job_states = parse_qstat(_proc.stdout)
+                    _proc.wait()
+                except:
+                    if _proc.poll() is None:
+                        _proc.kill()
+                    _proc.wait()
+                    if _proc.returncode == 0:
+                        raise
+                finally:
+                    _timer.cancel()
+                # Check return code. If qstat was not killed by signal Popen
+                # will not rise an exception
+                if _proc.returncode != 0:
+                    _stderr.seek(0)
+                    raise OSError((
+                        _proc.returncode,
+                        "/usr/bin/qstat returned non zero exit code.\n%s" %
+                        _stderr.read(65536)
+                    ))
+        except:
+            logger.error("@PBS - Unable to check jobs state for user %s.",
+                         user, exc_info=True)
+            return
+        logger.log(VERBOSE, _job_states)
+
+        with self.lock:
+            self.snapshots[user] = (_start, _job_states)
+
+    def diff(self, jobs):
+        """
+        Get PBS states of jobs that differ from their stored states.
+
+        The snapshot is compared with the job states stored in the DB, so a
+        change that was not stored (e.g. rolled back) is handed out again on
+        the next call. Finished jobs are always handed out.
+
+        A job is reported as missing only when it is absent from a snapshot
+        of its user taken after the job was first asked for. This way jobs
+        submitted after the last poll are not reported. Jobs of users without
+        a snapshot are not reported at all.
+
+        :param jobs: dict {PBS ID: (user name, job state)} of jobs to check.
+            Job state is either 'queued' or 'running'.
+        :return: dict {PBS ID: (state, exit status)} of changed jobs. Missing
+            jobs have None as state.
+        """
+        _now = time.time()
+        _changes = {}
+        with self.lock:
+            for _pbs_id, (_user, _job_state) in jobs.items():
+                _snapshot = self.snapshots.get(_user)
+                if _snapshot is None:
+                    continue
+                _state = _snapshot[1].get(_pbs_id)
+                if _state is None:
+                    if _snapshot[0] > self.missing.setdefault(_pbs_id, _now):
+                        _changes[_pbs_id] = None
+                    continue
+                self.missing.pop(_pbs_id, None)
+                if _state[0] == 'C' or \
+                        (_state[0] in ('R', 'E')) != (_job_state == 'running'):
+                    _changes[_pbs_id] = _state
+        # Forget jobs that left the scheduler
+        if len(self.missing) > len(jobs):
+            for _pbs_id in [_id for _id in self.missing if _id not in jobs]:
+                del self.missing[_pbs_id]
+        return _changes
+
+
 class PbsScheduler(Scheduler):
     """
     Class implementing simple interface for PBS queue system.
@@ -423,8 +1016,16 @@ class PbsScheduler(Scheduler):
         self.default_queue = conf.pbs_default_queue
         #: Maximum number of concurent jobs
         self.max_jobs = conf.pbs_max_jobs
+        #: Maximum number of concurrent qstat calls
+        self.pool_size = conf.pbs_poll_threads
+        #: Maximum number of jobs submitted by a single shell
+        self.batch_size = conf.pbs_submit_batch
+        #: Interval in seconds between qstat runs
+        self.poll_interval = conf.pbs_poll_interval
         #: Scheduler name
         self.name = "pbs"
+        #: Background qstat poller, started on the first update
+        self.poller = None
 
     def submit(self, job):
         """
@@ -434,37 +1035,52 @@ class PbsScheduler(Scheduler):
         :param job: :py:class:`Job` instance
         :return: True on success and False otherwise.
         """
+        return self.submit_batch([job])[0]
+
+    def submit_batch(self, jobs):
+        """
+        Submit jobs to PBS queue. The "pbs.sh" scripts should be already
+        present in the pbs_work_path/job directories.
+
+        Job slots are reserved once for the whole batch. Jobs are submitted
+        by a single shell process per batch_size jobs that runs qsub for
+        each of them, instead of forking the worker for every qsub call.
+
+        :param jobs: list of :py:class:`Job` instances
+        :return: list with True for every submitted job and False otherwise.
+        """
+        _results = [False] * len(jobs)
 
         # Check that maximum job limit is not exceeded
-        # Use exclusive session to be thread safe, no need to pass the session
-        # from JobManager
-        _job_count = -1
-        try:
-            _session = G.STATE_MANAGER.new_session()
-            _job_count = G.STATE_MANAGER.get_job_count(scheduler=self.name,
-                                                         session=_session)
-            _session.close()
-        except:
-            logger.error("@PBS - Unable to connect to DB.", exc_info=True)
-        if _job_count < 0:
-            return False
-        if _job_count >= self.max_jobs:
-            return False
+        _free = self.slots.reserve(len(jobs))
+        for _first in range(0, _free, self.batch_size):
+            _last = min(_free, _first + self.batch_size)
+            _results[_first:_last] = self.__qsub(jobs[_first:_last])
+        # Return slots of jobs that were not submitted
+        self.slots.release(_free - sum(_results))
 
-        # Path names
-        _work_dir = os.path.join(self.work_path, job.id())
-        _run_script = os.path.join(_work_dir, "pbs.sh")
-        _output_log = os.path.join(_work_dir, "output.log")
-        # Select queue
-        _queue = G.SERVICE_STORE[job.status.service].config['queue']
-        if 'CIS_QUEUE' in job.data.data:
-            _queue = job.data.data['CIS_QUEUE']
+        return _results
+
+    def __qsub(self, jobs):
+        """
+        Run qsub for jobs in a single shell process.
+
+        :param jobs: list of :py:class:`Job` instances
+        :return: list with True for every submitted job and False otherwise.
+        """
+        _queues = []
+        _script = ['set -f']
+        for _job in jobs:
+            # Path names
+            _work_dir = os.path.join(self.work_path, _job.id())
+            _run_script = os.path.join(_work_dir, "pbs.sh")
+            _output_log = os.path.join(_work_dir, "output.log")
+            # Select queue
+            _queue = G.SERVICE_STORE[_job.status.service].config['queue']
+            if 'CIS_QUEUE' in _job.data.data:
+                _queue = _job.data.data['CIS_QUEUE']
+            _queues.append(_queue)
 
-        try:
-            # Submit
-            logger.debug("@PBS - Submitting new job")
-            # Run qsub with proper user permissions
-            #
             # @TODO
             # Implementation of dedicated users for each service
             # - The apprunner user currently does not allow to log in via ssh
@@ -501,39 +1117,62 @@ class PbsScheduler(Scheduler):
                      '-l', 'epilogue=epilogue.sh',
                      _run_script]
             logger.log(VERBOSE, "@PBS - Running command: %s", _opts)
-            _proc = Popen(_opts, stdout=PIPE, stderr=PIPE)
-            _out = _proc.communicate()
-            _output = _out[0]
-            logger.log(VERBOSE, _out)
-            # Hopefully qsub returned meaningful job ID
-            _pbs_id = _output.strip()
-            # Check return code. If qsub was not killed by signal Popen will
-            # not rise an exception
-            if _proc.returncode != 0:
-                raise OSError((
-                    _proc.returncode,
-                    "/usr/bin/qsub returned non zero exit code.\n%s" %
-                    str(_out)
-                ))
+            # Output one line per job: qsub exit code followed by its output
+            _script.append('_out=$(%s 2>&1); echo $? $_out' %
+                           ' '.join(pipes.quote(_opt) for _opt in _opts))
+
+        try:
+            # Submit
+            logger.debug("@PBS - Submitting %s new jobs", len(jobs))
+            _proc = Popen(['/bin/sh', '-s'], stdin=PIPE, stdout=PIPE,
+                          stderr=STDOUT)
+            _output = _proc.communicate('\n'.join(_script) + '\n')[0]
+            logger.log(VERBOSE, _output)
         except:
-            job.die("@PBS - Unable to submit job %s." % job.id(), exc_info=True)
-            return False
+            for _job in jobs:
+                _job.die("@PBS - Unable to submit job %s." % _job.id(),
+                         exc_info=True)
+            return [False] * len(jobs)
 
-        # @TODO Do I need DB session here???
-        # Store the PBS job ID
-        job.scheduler = Jobs.SchedulerQueue(
-            scheduler=self.name, id=_pbs_id, queue=_queue)
-        # Reduce memory footprint
-        job.compact()
+        _lines = _output.splitlines()
+        _results = []
+        for _i, _job in enumerate(jobs):
+            try:
+                _code, _pbs_id = (_lines[_i].split(' ', 1) + [''])[:2]
+                # Check return code. Hopefully qsub returned meaningful job ID
+                if _code != '0':
+                    raise OSError((
+                        _code,
+                        "/usr/bin/qsub returned non zero exit code.\n%s" %
+                        _pbs_id
+                    ))
+            except:
+                _job.die("@PBS - Unable to submit job %s." % _job.id(),
+                         exc_info=True)
+                _results.append(False)
+                continue
 
-        logger.info("Job successfully submitted: %s", job.id())
-        return True
+            # @TODO Do I need DB session here???
+            # Store the PBS job ID
+            _job.scheduler = Jobs.SchedulerQueue(
+                scheduler=self.name, id=_pbs_id.strip(), queue=_queues[_i])
+            # Reduce memory footprint
+            _job.compact()
+
+            logger.info("Job successfully submitted: %s", _job.id())
+            _results.append(True)
+
+        return _results
 
     @rollback(SQLAlchemyError)
     def update(self, jobs):
         """
         Update job states to match their current state in PBS queue.
 
+        Job states are read from the snapshot of the background
+        :py:class:`QstatPoller`. Only jobs whose PBS state differs from the
+        stored one are touched.
+
         :param jobs: A list of Job instances for jobs to be updated.
         """
         # Extract list of user names associated to the jobs
@@ -542,111 +1181,94 @@ class PbsScheduler(Scheduler):
             if _service.config['username'] not in _users:
                 _users.append(_service.config['username'])
 
-        # We agregate the jobs by user. This way one qstat call per user is
-        # required instead of on call per job
-        _job_states = {}
-        for _usr in _users:
-            try:
-                # Run qstat
-                logger.log(VERBOSE, "@PBS - Check jobs state for user %s", _usr)
-                _opts = ["/usr/bin/qstat", "-f", "-x", "-u", _usr]
-                logger.log(VERBOSE, "@PBS - Running command: %s", _opts)
-                _proc = Popen(_opts, stdout=PIPE, stderr=STDOUT)
-                # Requires subprocess32 module from pip
-                _output = _proc.communicate(timeout=conf.pbs_timeout)[0]
-                logger.log(VERBOSE, _output)
-                # Check return code. If qstat was not killed by signal Popen
-                # will not rise an exception
-                if _proc.returncode != 0:
-                    raise OSError((
-                        _proc.returncode,
-                        "/usr/bin/qstat returned non zero exit code.\n%s" %
-                        str(_output)
-                    ))
-            except TimeoutExpired:
-                _proc.kill()
-                logger.error("@PBS - Unable to check jobs state.",
-                             exc_info=True)
-                return
-            except:
-                logger.error("@PBS - Unable to check jobs state.",
-                             exc_info=True)
-                return
+        if self.poller is None:
+            self.poller = QstatPoller(_users, self.pool_size,
+                                      self.poll_interval)
+            self.poller.start()
+        self.poller.users = _users
 
-            # Parse the XML output of qstat
-            try:
-                _xroot = ET.fromstring(_output)
-                for _xjob in _xroot.iter('Job'):
-                    _xjid = _xjob.find('Job_Id').text
-                    _xstate = _xjob.find('job_state').text
-                    _xexit = _xjob.find('exit_status')
-                    if _xexit is not None:
-                        _xexit = _xexit.text
-                    _job_states[_xjid] = (_xstate, _xexit)
-            except:
-                logger.error("@PBS - Unable to parse qstat output.",
-                             exc_info=True)
-                return
-            logger.log(VERBOSE, _job_states)
+        # TODO rewrite to get an array JID -> queue from SchedulerQueue table with single SELECT
+        _pbs_jobs = {}
+        for _job in jobs:
+            _pbs_jobs[str(_job.scheduler.id)] = (
+                G.SERVICE_STORE[_job.status.service].config['username'],
+                _job.get_state())
+        self.__update(jobs, self.poller.diff(_pbs_jobs))
+
+    def __update(self, jobs, job_states):
+        """
+        Apply changed PBS states to jobs.
 
+        :param jobs: A list of Job instances for jobs to be updated.
+        :param job_states: dict {PBS ID: (state, exit status)} of changed jobs.
+            Jobs that do not exist in PBS have None as state.
+        """
         # Iterate through jobs
         for _job in jobs:
-            # TODO rewrite to get an array JID -> queue from SchedulerQueue table with single SELECT
             _pbs_id = str(_job.scheduler.id)
+            _state = job_states.get(_pbs_id, False)
             # Check if the job exists in the PBS
-            if _pbs_id not in _job_states:
-                _job.die('@PBS - Job %s does not exist in the PBS', _job.id())
-            else:
-                # Update job progress output
-                self.progress(_job)
-                _new_state = 'queued'
-                _exit_code = 0
-                _state = _job_states[_pbs_id]
-                logger.log(VERBOSE, "@PBS - Current job state: '%s' (%s)",
-                           _state[0], _job.id())
-                # Job has finished. Check the exit code.
-                if _state[0] == 'C':
-                    _new_state = 'done'
-                    _msg = 'Job finished succesfully'
-
-                    _exit_code = _state[1]
-                    if _exit_code is None:
-                        _new_state = 'killed'
-                        _msg = 'Job was killed by the scheduler'
-                        _exit_code = ExitCodes.SchedulerKill
+            if _state is None:
+                _job.die('@PBS - Job %s does not exist in the PBS' % _job.id())
+                continue
+            # Update job progress output
+            self.progress(_job)
+            # Job state did not change
+            if _state is False:
+                continue
+            _new_state = 'queued'
+            _exit_code = 0
+            logger.log(VERBOSE, "@PBS - Current job state: '%s' (%s)",
+                       _state[0], _job.id())
+            # Job has finished. Check the exit code.
+            if _state[0] == 'C':
+                _new_state = 'done'
+                _msg = 'Job finished succesfully'
 
-                    _exit_code = int(_exit_code)
-                    if _exit_code > 256:
-                        _new_state = 'killed'
-                        _msg = 'Job was killed by the scheduler'
-                    elif _exit_code > 128:
-                        _new_state = 'killed'
-                        _msg = 'Job was killed'
-                    elif _exit_code > 0:
-                        _new_state = 'failed'
-                        _msg = 'Job finished with error code'
+                _exit_code = _state[1]
+                if _exit_code is None:
+                    _new_state = 'killed'
+                    _msg = 'Job was killed by the scheduler'
+                    _exit_code = ExitCodes.SchedulerKill
+
+                _exit_code = int(_exit_code)
+                if _exit_code > 256:
+                    _new_state = 'killed'
+                    _msg = 'Job was killed by the scheduler'
+                elif _exit_code > 128:
+                    _new_state = 'killed'
+                    _msg = 'Job was killed'
+                elif _exit_code > 0:
+                    _new_state = 'failed'
+                    _msg = 'Job finished with error code'
 
+                try:
+                    _job.finish(_msg, _new_state, _exit_code)
+                except:
+                    _job.die('@PBS - Unable to set job state (%s : %s)' %
+                             (_new_state, _job.id()), exc_info=True)
+            # Job is running
+            elif _state[0] == 'R' or _state[0] == 'E':
+                if _job.get_state() != 'running':
                     try:
-                        _job.finish(_msg, _new_state, _exit_code)
+                        _job.run()
                     except:
-                        _job.die('@PBS - Unable to set job state (%s : %s)' %
-                                 (_new_state, _job.id()), exc_info=True)
-                # Job is running
-                elif _state[0] == 'R' or _state[0] == 'E':
-                    if _job.get_state() != 'running':
-                        try:
-                            _job.run()
-                        except:
-                            _job.die("@PBS - Unable to set job state "
-                                     "(running : %s)" % _job.id(), exc_info=True)
-                # Treat all other states as queued
-                else:
-                    if _job.get_state() != 'queued':
-                        try:
-                            _job.queue()
-                        except:
-                            _job.die("@PBS - Unable to set job state "
-                                     "(queued : %s)" % _job.id(), exc_info=True)
+                        _job.die("@PBS - Unable to set job state "
+                                 "(running : %s)" % _job.id(), exc_info=True)
+            # Treat all other states as queued
+            else:
+                if _job.get_state() != 'queued':
+                    try:
+                        _job.queue()
+                    except:
+                        _job.die("@PBS - Unable to set job state "
+                                 "(queued : %s)" % _job.id(), exc_info=True)
+
+    def close(self):
+        """ Stop the qstat poller. """
+        if self.poller is not None:
+            self.poller.stop()
+            self.poller = None
 
     def stop(self, job, msg, exit_code):
         """
@@ -710,14 +1332,31 @@ class SshScheduler(Scheduler):
         self.queue_path = conf.ssh_path_queue
         #: Default SSH execute host
         self.default_queue = conf.ssh_default_queue
-        #: Dict of maximum number of concurrent jobs per execution host
+        #: Dict of maximum number of concurrent jobs per execution host. The
+        #: limits are summed up into one pooled limit (see
+        #: :py:class:`SlotCounter`), per host limits are not enforced.
         self.max_jobs = conf.ssh_max_jobs
+        #: Maximum number of execution hosts checked concurrently
+        self.pool_size = conf.ssh_poll_threads
+        #: Maximum number of jobs submitted by a single shsub call
+        self.batch_size = conf.ssh_submit_batch
         #: Scheduler name
         self.name = "ssh"
-        #: Dictionary of ssh hosts and connection objects
-        self.hosts = {}
-        #: Lock for SSH scheduler
-        self.lock = threading.Lock()
+        #: Pool of connections to SSH execution hosts
+        self.pool = SshConnectionPool()
+        #: Thread pool running status checks of execution hosts
+        self.status_pool = None
+        #: Running status checks: {(user, host): (start time, AsyncResult)}
+        self.status_checks = {}
+        #: Time jobs were first asked for: {job ID: time}
+        self.status_seen = {}
+        #: Cursors of shstat job state journals: {(user, host): cursor}
+        self.status_cursors = {}
+        #: Last known job states: {(user, host): {PID: [state, time]}}
+        self.status_states = {}
+        #: Time in seconds after which states of processes that do not
+        #: belong to any job are forgotten
+        self.status_retention = 3600
 
     def submit(self, job):
         """
@@ -727,66 +1366,119 @@ class SshScheduler(Scheduler):
         :param job: :py:class:`Job` instance
         :return: True on success and False otherwise.
         """
+        return self.submit_batch([job])[0]
+
+    def submit_batch(self, jobs):
+        """
+        Submit jobs to execution hosts via SSH queue. The "pbs.sh" scripts
+        should be already present in the ssh_work_path/job directories.
 
-        # Select execution host
-        _queue = G.SERVICE_STORE[job.status.service].config['queue']
-        _user = G.SERVICE_STORE[job.status.service].config['username']
-        if 'CIS_SSH_HOST' in job.data.data:
-            _queue = job.data.data['CIS_SSH_HOST']
+        Jobs are grouped by user and execution host. Every group is submitted
+        by a single shsub call in batch mode (up to batch_size jobs per call),
+        so one SSH session and one round trip per host is required instead of
+        one per job.
+
+        :param jobs: list of :py:class:`Job` instances
+        :return: list with True for every submitted job and False otherwise.
+        """
+        _results = [False] * len(jobs)
 
         # Check that maximum job limit is not exceeded
-        # Use exclusive session to be thread safe, no need to pass the session
-        # from JobManager
-        _job_count = -1
-        try:
-            _session = G.STATE_MANAGER.new_session()
-            _job_count = G.STATE_MANAGER.get_job_count(scheduler=self.name,
-                                                         session=_session)
-            _session.close()
-        except:
-            logger.error("@SSH - Unable to connect to DB.", exc_info=True)
-        if _job_count < 0:
-            return False
         # @TODO fix !!! self.max_jobs[_queue], check that queue is defined,
         # otherwise use some default. What happens with the job when submit
         # fails - switch to waiting state? What if someting is mosconfigured
         # and it will never enter queue - max submit retries?
-        if _job_count >= self.max_jobs:
-            return False
+        _free = self.slots.reserve(len(jobs))
+
+        # Group jobs by login
+        _logins = {}
+        for _i, _job in enumerate(jobs[:_free]):
+            # Select execution host
+            _queue = G.SERVICE_STORE[_job.status.service].config['queue']
+            _user = G.SERVICE_STORE[_job.status.service].config['username']
+            if 'CIS_SSH_HOST' in _job.data.data:
+                _queue = _job.data.data['CIS_SSH_HOST']
+            _logins.setdefault((_user, _queue), []).append(_i)
+
+        for (_user, _queue), _ids in sorted(_logins.items()):
+            for _first in range(0, len(_ids), self.batch_size):
+                _chunk = _ids[_first:_first + self.batch_size]
+                _submitted = self.__shsub(_user, _queue,
+                                          [jobs[_i] for _i in _chunk])
+                for _i, _result in zip(_chunk, _submitted):
+                    _results[_i] = _result
+        # Return slots of jobs that were not submitted
+        self.slots.release(_free - sum(_results))
+
+        return _results
+
+    def __shsub(self, user, host, jobs):
+        """
+        Run shsub in batch mode for jobs of a single login.
 
-        # Path names
-        _work_dir = os.path.join(self.work_path, job.id())
-        _run_script = os.path.join(_work_dir, "pbs.sh")
-        _output_log = os.path.join(_work_dir, "output.log")
+        :param user: user name.
+        :param host: execution host name.
+        :param jobs: list of :py:class:`Job` instances
+        :return: list with True for every submitted job and False otherwise.
+        """
+        # Job manifest: one "ID OUT DIR command" line per job
+        _manifest = []
+        for _job in jobs:
+            # Path names
+            _work_dir = os.path.join(self.work_path, _job.id())
+            _run_script = os.path.join(_work_dir, "pbs.sh")
+            _output_log = os.path.join(_work_dir, "output.log")
+            _manifest.append(" ".join((_job.id(), _output_log, _work_dir,
+                                       _run_script)))
+        _manifest.append("")
 
         # @TODO handle timouts etc ...
         try:
             # Submit
-            logger.debug("@SSH - Submitting new job: %s@%s", _user, _queue)
+            logger.debug("@SSH - Submitting %s new jobs: %s@%s",
+                         len(jobs), user, host)
             # Run shsub with proper user permissions
             _shsub = os.path.join(os.path.dirname(conf.daemon_path_installdir),
                                   "Scripts")
             _shsub = os.path.join(_shsub, "shsub")
-            _ssh = self.__get_ssh_connection(_queue, _user)
-            _comm = [_shsub, "-i", job.id(), "-d", _work_dir, "-o",
-                     _output_log, _run_script]
+            _comm = [_shsub, "-b", str(len(jobs))]
             logger.log(VERBOSE, "@SSH - Running command: %s", _comm)
-            # Submit the job. Will rise exception if shsub would return an error
-            _result = _ssh.run(_comm)
+            # Submit the jobs. Will rise exception if shsub would return an
+            # error
+            _result = self.pool.run(host, user, _comm,
+                                    stdin="\n".join(_manifest))
             logger.log(VERBOSE, [_result.output, _result.stderr_output])
-            # Hopefully shsub returned meaningful job ID
-            _ssh_id = _result.output.strip()
         except:
-            job.die("@SSH - Unable to submit job %s." % job.id(), exc_info=True)
-            return False
+            for _job in jobs:
+                _job.die("@SSH - Unable to submit job %s." % _job.id(),
+                         exc_info=True)
+            return [False] * len(jobs)
 
-        # Store the SSH job ID
-        job.scheduler = Jobs.SchedulerQueue(scheduler=self.name, id=_ssh_id, queue=_queue)
-        # Reduce memory footprint
-        job.compact()
+        # shsub outputs "ID PID" for every started job and "ID ERROR message"
+        # for every job it was unable to start
+        _output = {}
+        for _line in _result.output.splitlines():
+            _line = _line.split(" ", 1)
+            if len(_line) == 2:
+                _output[_line[0]] = _line[1].strip()
 
-        logger.info("Job successfully submitted: %s", job.id())
-        return True
+        _results = []
+        for _job in jobs:
+            _ssh_id = _output.get(_job.id(), "ERROR missing shsub output")
+            if not _ssh_id.isdigit():
+                _job.die("@SSH - Unable to submit job %s: %s" %
+                         (_job.id(), _ssh_id))
+                _results.append(False)
+                continue
+            # Store the SSH job ID
+            _job.scheduler = Jobs.SchedulerQueue(
+                scheduler=self.name, id=_ssh_id, queue=host)
+            # Reduce memory footprint
+            _job.compact()
+            logger.info("Job successfully submitted: %s", _job.id())
+            _results.append(True)
+
+        return _results
 
     @rollback(SQLAlchemyError)
     def update(self, jobs):
@@ -796,65 +1488,77 @@ class SshScheduler(Scheduler):
         :param jobs: A list of Job instances for jobs to be updated.
         """
         # Extract list of user names and queues associated to the jobs
-        _users = {}
+        _start = time.time()
+        _seen = {}
+        _logins = set()
         for _job in jobs:
+            _seen[_job.id()] = self.status_seen.get(_job.id(), _start)
             _service = G.SERVICE_STORE[_job.status.service]
-            _usr = _service.config['username']
-            if _usr not in _users:
-                _users[_usr] = []
             # TODO rewrite to get an array JID -> queue from SchedulerQueue table with single SELECT
-            _queue = _job.scheduler.queue
-            if _queue not in _users[_usr]:
-                _users[_usr].append(_queue)
-
-        # We agregate the jobs by user. This way one shstat call per user is
-        # required instead of on call per job
+            _logins.add((_service.config['username'], _job.scheduler.queue))
+
+        # We agregate the jobs by user and host. This way one shstat call per
+        # login is required instead of on call per job. Hosts are checked
+        # concurrently. Checks that did not finish in time are left running
+        # and their results are awaited in the next update.
+        self.status_seen = _seen
+        if self.status_pool is None:
+            self.status_pool = ThreadPool(self.pool_size)
+        for _login in _logins:
+            if _login not in self.status_checks:
+                self.status_checks[_login] = (
+                    time.time(),
+                    self.status_pool.apply_async(self.shstat, _login))
+        _deadline = time.time() + conf.ssh_timeout
         _job_states = {}
-        for _usr, _queues in _users.items():
-            for _queue in _queues:
-                try:
-                    # Run shtat
-                    logger.log(VERBOSE, "@SSH - Check jobs state for user %s @ %s",
-                               _usr, _queue)
-                    _shstat = os.path.join(
-                        os.path.dirname(conf.daemon_path_installdir),
-                        "Scripts"
-                    )
-                    _shstat = os.path.join(_shstat, "shstat")
-                    _ssh = self.__get_ssh_connection(_queue, _usr)
-                    _opts = [_shstat, ]
-                    logger.log(VERBOSE, "@SSH - Running command: %s", _opts)
-		    # Run shstat. Will rise exception if shstat would return an error
-                    _result = _ssh.run(_opts)
-                    _output = _result.output
-                    logger.log(VERBOSE, [_output, _result.stderr_output])
-                except:
-                    logger.error("@SSH - Unable to check jobs state.",
-                                 exc_info=True)
-                    continue
-
-                for _line in _output.splitlines():
-                    try:
-                        _jid, _state = _line.split(" ")
-                        _job_states[_jid] = _state
-                    except:
-                        logger.error("@SSH - Unable to parse shstat output.",
-                                     exc_info=True)
-                        return
+        _started = {}
+        _stale = set()
+        for _login in _logins:
+            _started[_login], _check = self.status_checks[_login]
+            try:
+                _job_states[_login] = \
+                    _check.get(max(0, _deadline - time.time()))
+            except multiprocessing.TimeoutError:
+                logger.error("@SSH - Timeout while checking jobs state for "
+                             "user %s @ %s.", *_login)
+                _stale.add(_login)
+                continue
+            except:
+                logger.error("@SSH - Unable to check jobs state for user %s "
+                             "@ %s.", *_login, exc_info=True)
+                _stale.add(_login)
+            del self.status_checks[_login]
+        # Forget finished checks of hosts without jobs
+        for _login in self.status_checks.keys():
+            if _login not in _logins and \
+                    self.status_checks[_login][1].ready():
+                del self.status_checks[_login]
 
         # Iterate through jobs
+        _now = time.time()
         for _job in jobs:
             # TODO rewrite to get an array JID -> queue from SchedulerQueue table with single SELECT
             _pid = str(_job.scheduler.id)
             logger.log(VERBOSE, "Check job: %s - %s", _job.id(), _job.scheduler.id)
-            # Check if the job exists on a SSH execution host
-            if _pid not in _job_states:
-                _job.die('@SSH - Job %s does not exist on any of the SSH '
-                         'execution hosts' % _job.id())
+            # State of jobs on hosts that did not respond is unknown
+            _login = (G.SERVICE_STORE[_job.status.service].config['username'],
+                      _job.scheduler.queue)
+            if _login in _stale:
+                continue
+            # Check if the job exists on a SSH execution host. A check that
+            # timed out in a previous update may have started before the job
+            # was submitted. Its result cannot tell that the job is missing.
+            _state = _job_states[_login].get(_pid)
+            if _state is None:
+                if _started[_login] >= _seen[_job.id()]:
+                    _job.die('@SSH - Job %s does not exist on any of the SSH '
+                             'execution hosts' % _job.id())
             else:
+                # Job state is still reported
+                _state[1] = _now
                 # Update job progress output
                 self.progress(_job)
-                _state = int(_job_states[_pid])
+                _state = int(_state[0])
                 # Job has finished. Check the exit code.
                 if _state >= 0:
                     _new_state = 'done'
@@ -888,6 +1592,13 @@ class SshScheduler(Scheduler):
                         _job.die('@SSH - Unable to set job state (%s : %s)' %
                                  (_new_state, _job.id()), exc_info=True)
 
+        # Forget states of processes that are not our jobs or were not
+        # reported for a long time (job states kept by shstat expire too)
+        for _login, _states in _job_states.items():
+            for _pid in [_pid for _pid, _state in _states.items()
+                         if _now - _state[1] > self.status_retention]:
+                del _states[_pid]
+
     def stop(self, job, msg, exit_code):
         """
         Stop running job and remove it from SSH queue.
@@ -914,10 +1625,9 @@ class SshScheduler(Scheduler):
             "Scripts"
         )
         _shdel = os.path.join(_shdel, "shdel")
-        _ssh = self.__get_ssh_connection(_queue, _usr)
         _opts = [_shdel, _pid]
         logger.log(VERBOSE, "@SSH - Running command: %s", _opts)
-        _result = _ssh.run(_opts, allow_error=True)
+        _result = self.pool.run(_queue, _usr, _opts, allow_error=True)
         logger.log(VERBOSE, [_result.output, _result.stderr_output])
         # Check return code. If == 1 the job has already finished and we do not raise an exception
         if _result.return_code == 1:
@@ -933,44 +1643,259 @@ class SshScheduler(Scheduler):
         # Mark as killed by user
         job.mark(msg, exit_code)
 
-    def __get_ssh_connection(self, host_name, user_name):
-        _login = "%s@%s" % (user_name, host_name)
-        self.lock.acquire()
-        if _login in self.hosts:
-            self.lock.release()
-            return self.hosts[_login]
+    def shstat(self, user, host):
+        """
+        Get states of jobs of a user on an execution host.
+
+        The last known states are kept per login. shstat is asked only for
+        state changes after the cursor returned by its previous call (status
+        protocol v2). When shstat reports a full state list (first call,
+        journal rotation, host reboot or shstat without v2 support) the known
+        states are replaced.
+
+        :param user: user name.
+        :param host: execution host name.
+        :return: dict {job PID: [state, time it was last reported or used]}.
+        """
+        # Run shtat
+        logger.log(VERBOSE, "@SSH - Check jobs state for user %s @ %s",
+                   user, host)
+        _shstat = os.path.join(
+            os.path.dirname(conf.daemon_path_installdir),
+            "Scripts"
+        )
+        _shstat = os.path.join(_shstat, "shstat")
+        _login = (user, host)
+        _opts = [_shstat, "-c", self.status_cursors.get(_login, "0")]
+        logger.log(VERBOSE, "@SSH - Running command: %s", _opts)
+        # Run shstat. Will rise exception if shstat would return an error
+        _result = self.pool.run(host, user, _opts)
+        _output = _result.output
+        logger.log(VERBOSE, [_output, _result.stderr_output])
+
+        _lines = _output.splitlines()
+        _job_states = self.status_states.setdefault(_login, {})
+        _cursor = "0"
+        if _lines and _lines[0].startswith("# cursor "):
+            _header = _lines.pop(0).split()
+            _cursor = _header[2]
+            if _header[3] == "full":
+                _job_states.clear()
         else:
+            # shstat without v2 support outputs all states every time
+            _job_states.clear()
+
+        _now = time.time()
+        for _line in _lines:
             try:
-                logger.log(VERBOSE, "Create new SSH connection.")
-                try:
-                    _ssh = spur.SshShell(  # Assume default private key is valid
-                                           hostname=host_name,
-                                           username=user_name,
-                                           # Workaround for paramiko not understanding host ecdsa keys.
-                                           # @TODO If possible disable such keys on sshd at host and
-                                           # remove this from production code.
-                                           missing_host_key=spur.ssh.MissingHostKey.accept,
-                                           # Hack to speedup connection setup - use a minimal known_hosts file - requires a patch for spur
-                                           # Patch in Scripts directory
-                                           known_hosts_file=conf.ssh_known_hosts
-                    )
-                except TypeError:  # Fallback when spur is not patched
-                    _ssh = spur.SshShell(  # Assume default private key is valid
-                                           hostname=host_name,
-                                           username=user_name,
-                                           # Workaround for paramiko not understanding host ecdsa keys.
-                                           # @TODO If possible disable such keys on sshd at host and
-                                           # remove this from production code.
-                                           missing_host_key=spur.ssh.MissingHostKey.accept
-                    )
-                self.hosts[_login] = _ssh
-                # Establish the connection
-                _comm = ["/bin/hostname", ]
-                _ssh.run(_comm)
-            finally:
-                logger.log(VERBOSE, "SSH connection ready.")
-                self.lock.release()
-            return _ssh
+                _jid, _state = _line.split(" ")
+                _job_states[_jid] = [_state, _now]
+            except:
+                logger.error("@SSH - Unable to parse shstat output line: %s",
+                             _line, exc_info=True)
+        self.status_cursors[_login] = _cursor
+        return _job_states
+
+    def close(self):
+        """ Close connections to SSH execution hosts. """
+        if self.status_pool is not None:
+            self.status_pool.terminate()
+            self.status_pool = None
+        logger.debug("@SSH - Connection pool metrics: %s", self.pool.metrics())
+        self.pool.close()
+
+
+class LocalScheduler(Scheduler):
+    """
+    Class implementing job execution as local processes of the AppServer
+    host.
+
+    Every job runs in its own session (process group) detached from the
+    AppServer. The exit code of the job is written to a file in the
+    local_path_queue directory, so job states are checked without any
+    blocking calls or remote round trips. Intended for small installations
+    and benchmarks without a batch system.
+
+    Allows for job submission, deletion and extraction of job status.
+    """
+
+    #: Shell script starting a job: changes to the working directory ($1),
+    #: runs the job script ($2) in background with the output redirected to
+    #: $3 and stores its exit code in $4. Outputs the PID of the starting
+    #: shell which is the process group ID of the job.
+    run_script = 'cd "$1" || exit 1; ' \
+        '( "$2" > "$3" 2>&1; echo $? > "$4.tmp"; mv -f "$4.tmp" "$4" ) ' \
+        '< /dev/null > /dev/null 2>&1 & echo $$'
+
+    def __init__(self):
+        super(LocalScheduler, self).__init__()
+        #: Local working directory path
+        self.work_path = conf.local_path_work
+        #: Path where exit codes of local jobs are stored
+        self.queue_path = conf.local_path_queue
+        #: Default queue
+        self.default_queue = "localhost"
+        #: Maximum number of concurrent jobs
+        self.max_jobs = conf.local_max_jobs
+        #: Scheduler name
+        self.name = "local"
+
+    def submit(self, job):
+        """
+        Submit a job for execution as a local process. The "pbs.sh" script
+        should be already present in the local_path_work/job directory.
+
+        :param job: :py:class:`Job` instance
+        :return: True on success and False otherwise.
+        """
+        # Check that maximum job limit is not exceeded
+        if not self.slots.reserve():
+            return False
+
+        # Path names
+        _work_dir = os.path.abspath(os.path.join(self.work_path, job.id()))
+        _run_script = os.path.join(_work_dir, "pbs.sh")
+        _output_log = os.path.join(_work_dir, "output.log")
+        _exit_file = os.path.abspath(os.path.join(self.queue_path, job.id()))
+
+        try:
+            _opts = ['/bin/sh', '-c', self.run_script, 'local', _work_dir,
+                     _run_script, _output_log, _exit_file]
+            logger.log(VERBOSE, "@Local - Running command: %s", _opts)
+            # The starting shell exits at once, the job is left running in
+            # a new session
+            _proc = Popen(_opts, stdout=PIPE, stderr=STDOUT, close_fds=True,
+                          preexec_fn=os.setsid)
+            _output = _proc.communicate(timeout=conf.local_timeout)[0]
+            if _proc.returncode != 0:
+                raise OSError((_proc.returncode, _output))
+            # Job ID is the process group ID
+            _pgid = int(_output.strip())
+        except:
+            self.slots.release()
+            job.die("@Local - Unable to submit job %s." % job.id(),
+                    exc_info=True)
+            return False
+
+        # Store the local job ID
+        job.scheduler = Jobs.SchedulerQueue(
+            scheduler=self.name, id=str(_pgid), queue=self.default_queue)
+        # Reduce memory footprint
+        job.compact()
+
+        logger.info("Job successfully submitted: %s", job.id())
+        return True
+
+    @rollback(SQLAlchemyError)
+    def update(self, jobs):
+        """
+        Update job states to match the state of their local processes.
+
+        :param jobs: A list of Job instances for jobs to be updated.
+        """
+        for _job in jobs:
+            logger.log(VERBOSE, "Check job: %s - %s", _job.id(),
+                       _job.scheduler.id)
+            _exit_file = os.path.join(self.queue_path, _job.id())
+            _state = self.__read_exit(_exit_file)
+
+            if _state is None and not self.is_running(_job):
+                # The job could finish after its exit file was read. The
+                # exit file is stored before the process group exits.
+                _state = self.__read_exit(_exit_file)
+                if _state is None:
+                    _job.die('@Local - Job %s does not exist' % _job.id())
+                    continue
+
+            # Job is running
+            if _state is None:
+                self.progress(_job)
+                if _job.get_state() != 'running':
+                    try:
+                        _job.run()
+                    except:
+                        _job.die("@Local - Unable to set job state "
+                                 "(running : %s)" % _job.id(), exc_info=True)
+                continue
+
+            # Job has finished. Check the exit code.
+            self.progress(_job)
+            _new_state = 'done'
+            _msg = 'Job finished succesfully'
+            if _state > 128:
+                _new_state = 'killed'
+                _msg = 'Job was killed by a signal'
+            elif _state > 0:
+                _new_state = 'failed'
+                _msg = 'Job finished with error code'
+            elif _state < 0:
+                _new_state = 'failed'
+                _msg = 'Job finished with unknown exit state'
+            try:
+                _job.finish(_msg, _new_state, _state)
+                os.unlink(_exit_file)
+            except:
+                _job.die('@Local - Unable to set job state (%s : %s)' %
+                         (_new_state, _job.id()), exc_info=True)
+
+    @staticmethod
+    def __read_exit(exit_file):
+        """
+        Read the exit code of a job.
+
+        :return: exit code, None if the job did not finish yet or -2 if the
+            exit code is not valid.
+        """
+        try:
+            with open(exit_file) as _f:
+                return int(_f.read().strip())
+        except IOError:
+            return None
+        except ValueError:
+            return -2
+
+    def is_running(self, job):
+        """
+        Check if the process group of a job still exists.
+
+        :param job: :py:class:`Job` instance
+        """
+        try:
+            os.killpg(int(job.scheduler.id), 0)
+        except OSError as e:
+            # Process group exists but belongs to another user
+            return e.errno == errno.EPERM
+        return True
+
+    def stop(self, job, msg, exit_code):
+        """
+        Stop running job by killing its process group.
+
+        :param job: :py:class:`Job` instance
+        :param msg: Message that will be passed to the user
+        :param exit_code: Exit code of the job
+        """
+        # Get job process group ID
+        try:
+            _pgid = int(job.scheduler.id)
+        except:
+            job.die('@Local - Unable to read PID', exc_info=True)
+            return
+
+        logger.debug("@Local - Killing job")
+        try:
+            os.killpg(_pgid, signal.SIGTERM)
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                raise
+            logger.debug("Job %s already finished.", job.id())
+        try:
+            os.unlink(os.path.join(self.queue_path, job.id()))
+        except OSError:
+            pass
+
+        # Mark as killed by user
+        job.mark(msg, exit_code)
 
 
 class DummyScheduler(Scheduler):
@@ -983,7 +1908,9 @@ class DummyScheduler(Scheduler):
 
     def __init__(self):
         super(DummyScheduler, self).__init__()
-        #: Dict of maximum number of concurrent jobs per execution host
+        #: Dict of maximum number of concurrent jobs per execution host. The
+        #: limits are summed up into one pooled limit (see
+        #: :py:class:`SlotCounter`), per host limits are not enforced.
         self.max_jobs = conf.dummy_max_jobs
         #: Scheduler name
         self.name = "dummy"
@@ -999,23 +1926,11 @@ class DummyScheduler(Scheduler):
         #@TODO Rewrite submit, chain_jobs, generate_scripts to throw exceptions on errors
         logger.log(VERBOSE, "Trying to submit job %s", job.id())
         # Check that maximum job limit is not exceeded
-        # Use exclusive session to be thread safe, no need to pass the session
-        # from JobManager
-        _job_count = -1
-        try:
-            _session = G.STATE_MANAGER.new_session()
-            _job_count = G.STATE_MANAGER.get_job_count(scheduler=self.name,
-                                                         session=_session)
-            _session.close()
-        except:
-            logger.error("Unable to connect to DB.", exc_info=True)
-        if _job_count < 0:
-            return False
         # @TODO fix !!! self.max_jobs[_queue], check that queue is defined,
         # otherwise use some default. What happens with the job when submit
         # fails - switch to waiting state? What if someting is mosconfigured
         # and it will never enter queue - max submit retries?
-        if _job_count >= self.max_jobs:
+        if not self.slots.reserve():
             logger.debug("Active scheduler jobs limit reached - job will be held")
             return False
 
@@ -1087,7 +2002,9 @@ class DummyScheduler(Scheduler):
         _jid = job.id()
         # Remove job from scheduler queue if it was queued
         try:
-            job.scheduler = None
+            if job.scheduler is not None:
+                job.scheduler = None
+                self.slots.release()
         except:
             logger.error("@Scheduler - Unable to remove job SchedulerQueue.",
                          exc_info=True)
@@ -1111,7 +2028,9 @@ class DummyScheduler(Scheduler):
         _jid = job.id()
         # Remove job from scheduler queue if it was queued
         try:
-            job.scheduler = None
+            if job.scheduler is not None:
+                job.scheduler = None
+                self.slots.release()
         except:
             logger.error("@Scheduler - Unable to remove job SchedulerQueue.",
                          exc_info=True)
@@ -1158,16 +2077,90 @@ class SchedulerStore(dict):
     def __init__(self):
         super(SchedulerStore, self).__init__()
 
+    def clear(self):
+        for _scheduler in self.values():
+            _scheduler.close()
+        super(SchedulerStore, self).clear()
+
     def init(self):
-        # Load all files from service_conf_path. Configuration files should be
-        # in JSON format.
+        """
+        Create enabled schedulers (service_schedulers). Scheduler classes are
+        looked up in :py:data:`SCHEDULERS` and in the scheduler_classes config
+        option, so new backends may be added without changes to AppServer.
+        Working and queue directories of the schedulers are created if they do
+        not exist.
+        """
         logger.debug('Initializing schedulers.')
 
-        for _scheduler in conf.service_schedulers:
-            if _scheduler == 'pbs':
-                self[_scheduler] = PbsScheduler()
-            elif _scheduler == 'ssh':
-                self[_scheduler] = SshScheduler()
-            elif _scheduler == 'dummy':
-                self[_scheduler] = DummyScheduler()
+        for _name in conf.service_schedulers:
+            try:
+                _class = get_scheduler_class(_name)
+                _scheduler = _class()
+                _scheduler.name = _name
+                _scheduler.configure(conf.scheduler_options.get(_name, {}))
+                # Create the directories of the scheduler instance
+                for _path in (_scheduler.work_path, _scheduler.queue_path):
+                    if _path is not None:
+                        conf.mkdir_p(_path)
+            except:
+                logger.error("@Scheduler - Unable to initialize scheduler "
+                             "%s.", _name, exc_info=True)
+                continue
+            _scheduler.slots = SlotCounter(_scheduler.max_jobs)
+            self[_name] = _scheduler
+
+    def get_slots(self):
+        """
+        Get job slot counters of all schedulers.
 
+        :return: dict {scheduler name: :py:class:`SlotCounter`}.
+        """
+        return dict((_name, _scheduler.slots)
+                    for _name, _scheduler in self.items())
+
+    def share_slots(self, slots):
+        """
+        Use job slot counters shared by another process.
+
+        :param slots: dict {scheduler name: :py:class:`SlotCounter`}.
+        """
+        for _name, _slots in slots.items():
+            if _name in self:
+                self[_name].slots = _slots
+
+    def sync_slots(self, counters):
+        """
+        Set the number of used job slots of all schedulers.
+
+        :param counters: list of tuples (scheduler, job count), e.g. from
+            :py:meth:`StateManager.get_scheduler_counters`.
+        """
+        _counters = dict(counters)
+        for _name, _scheduler in self.items():
+            _scheduler.slots.reset(_counters.get(_name, 0))
+
+
+#: Built-in scheduler classes: {scheduler name: class}
+SCHEDULERS = {
+    'pbs': PbsScheduler,
+    'ssh': SshScheduler,
+    'local': LocalScheduler,
+    'dummy': DummyScheduler,
+}
+
+
+def get_scheduler_class(name):
+    """
+    Find the class of a scheduler. Classes listed in the scheduler_classes
+    config option as "module.Class" take precedence over the built-in ones.
+
+    :param name: scheduler name.
+    :return: :py:class:`Scheduler` subclass.
+    :raises ValueError: for unknown schedulers.
+    """
+    if name in conf.scheduler_classes:
+        _module, _class = conf.scheduler_classes[name].rsplit('.', 1)
+        return getattr(importlib.import_module(_module), _class)
+    if name in SCHEDULERS:
+        return SCHEDULERS[name]
+    raise ValueError("Unknown scheduler: %s" % name)
@@ -18,6 +18,7 @@ from yapsy.PluginManager import PluginManager
 # Import full modules - resolves circular dependencies
 import Jobs
 import Globals as G
+from Schedulers import ScriptBundle
 from Config import conf, VERBOSE
 
 
@@ -606,6 +607,7 @@ class Service(dict):
             'max_jobs': conf.service_max_jobs,
             'quota': conf.service_quota,
             'job_size': conf.service_job_size,
+            'chain_mode': conf.service_chain_mode,
             'username': conf.service_username,
             'scheduler': conf.service_default_scheduler,
             'queue': G.SCHEDULER_STORE[conf.service_default_scheduler].default_queue
@@ -627,6 +629,57 @@ class Service(dict):
 class ServiceStore(dict):
     def __init__(self):
         super(ServiceStore, self).__init__()
+        #: Service names grouped by length (longest first) used to find the
+        #: service of a job ID. Rebuilt on the first lookup after a change.
+        self.__prefixes = None
+        #: Compiled scripts of services: {service name: ScriptBundle}
+        self.bundles = {}
+
+    def __setitem__(self, key, value):
+        super(ServiceStore, self).__setitem__(key, value)
+        self.__prefixes = None
+        self.bundles.pop(key, None)
+
+    def __delitem__(self, key):
+        super(ServiceStore, self).__delitem__(key)
+        self.__prefixes = None
+        self.bundles.pop(key, None)
+
+    def clear(self):
+        super(ServiceStore, self).clear()
+        self.__prefixes = None
+        self.bundles = {}
+
+    def get_bundle(self, name):
+        """
+        Get compiled scripts of a service. Scripts are compiled on first use
+        if they were not compiled during :py:meth:`init`.
+
+        :param name: name of the service.
+        :return: :py:class:`ScriptBundle` instance.
+        """
+        if name not in self.bundles:
+            self.bundles[name] = ScriptBundle(name)
+        return self.bundles[name]
+
+    def match(self, job_id):
+        """
+        Find the service of a job. Job IDs start with the service name, the
+        longest matching name is used.
+
+        :param job_id: the unique job ID.
+        :return: name of the service, None if no service matches.
+        """
+        if self.__prefixes is None:
+            _lengths = {}
+            for _name in self:
+                _lengths.setdefault(len(_name), {})[_name] = _name
+            self.__prefixes = sorted(_lengths.items(), reverse=True)
+        for _length, _names in self.__prefixes:
+            _name = _names.get(job_id[:_length])
+            if _name is not None:
+                return _name
+        return None
 
     def init(self):
         # Load all files from service_conf_path. Configuration files should be
@@ -647,6 +700,8 @@ class ServiceStore(dict):
             if "name" in _data:
                 _service = _data["name"]
             self[_service] = Service(_service, _data)
+            # Compile service scripts
+            self.get_bundle(_service)
 
             logger.info("Initialized service: %s", _service)
 
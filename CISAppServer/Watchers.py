@@ -0,0 +1,273 @@
+# -*- coding: UTF-8 -*-
+"""
+Module with implementations of AppGW directory watchers.
+
+Watchers expose the contents of the shared directories used for communication
+with AppGateway (new job requests, stop and delete flags). The polling
+implementation lists the directory every time it is asked. The inotify based
+implementation keeps an in-memory copy of the directory contents that is
+updated from kernel events, so the directories are listed only once.
+"""
+
+import os
+import time
+import errno
+import select
+import struct
+import logging
+import ctypes
+import ctypes.util
+from collections import OrderedDict
+
+from Config import conf, VERBOSE
+
+logger = logging.getLogger(__name__)
+
+
+# inotify constants from <sys/inotify.h>
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+#: Events that add an entry to a watched directory
+IN_ADD = IN_CREATE | IN_MOVED_TO
+#: Events that remove an entry from a watched directory
+IN_REMOVE = IN_DELETE | IN_MOVED_FROM
+#: Events that invalidate the watch of a directory
+IN_LOST = IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED
+
+#: Header of the inotify_event structure: wd, mask, cookie, len
+_EVENT_HEADER = struct.Struct('iIII')
+
+
+class WatcherError(Exception):
+    """ Directory watcher could not be initialised. """
+
+
+class PollWatcher(object):
+    """
+    Directory watcher that lists the directories on every request.
+
+    Works on every file system including the network ones (NFS, Lustre) where
+    changes made on other hosts are not reported by inotify.
+    """
+
+    def __init__(self, paths):
+        """
+        :param paths: list of directories to watch.
+        """
+        #: Watched directories
+        self.paths = list(paths)
+
+    def start(self):
+        """ Start watching the directories. """
+        pass
+
+    def stop(self):
+        """ Stop watching the directories and release resources. """
+        pass
+
+    def listdir(self, path):
+        """
+        Get current contents of a watched directory.
+
+        :param path: one of the watched directories.
+        :return: list of entry names.
+        """
+        return os.listdir(path)
+
+    def wait(self, timeout):
+        """
+        Wait for new entries in the watched directories.
+
+        :param timeout: maximum time to wait in seconds.
+        :return: True if woken up by a new entry before timeout, False
+            otherwise.
+        """
+        if timeout > 0:
+            time.sleep(timeout)
+        return False
+
+
+class InotifyWatcher(PollWatcher):
+    """
+    Directory watcher based on Linux inotify.
+
+    Directory contents are read once at start and then kept up to date with
+    IN_CREATE/IN_MOVED_TO and IN_DELETE/IN_MOVED_FROM events. Entries are
+    returned in the order they appeared. If the kernel event queue overflows
+    the directories are listed again.
+    """
+
+    def __init__(self, paths):
+        super(InotifyWatcher, self).__init__(paths)
+        #: inotify file descriptor
+        self.fd = None
+        #: Mapping of watch descriptors to directories
+        self.watches = {}
+        #: Current contents of watched directories
+        self.entries = {}
+
+    def start(self):
+        """
+        Start watching the directories.
+
+        :raises WatcherError: when inotify is not available.
+        """
+        _name = ctypes.util.find_library('c')
+        try:
+            _libc = ctypes.CDLL(_name, use_errno=True)
+            _init = _libc.inotify_init1
+            _add_watch = _libc.inotify_add_watch
+        except (OSError, AttributeError) as e:
+            raise WatcherError("inotify not supported: %s" % e)
+
+        self.fd = _init(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            _errno = ctypes.get_errno()
+            self.fd = None
+            raise WatcherError("inotify_init1 failed: %s" %
+                               os.strerror(_errno))
+
+        _mask = IN_ADD | IN_REMOVE | IN_DELETE_SELF | IN_MOVE_SELF | \
+            IN_ONLYDIR
+        for _path in self.paths:
+            _name = _path
+            if isinstance(_name, unicode):
+                _name = _name.encode('utf-8')
+            _wd = _add_watch(self.fd, _name, _mask)
+            if _wd < 0:
+                _errno = ctypes.get_errno()
+                self.stop()
+                raise WatcherError("inotify_add_watch failed for %s: %s" %
+                                   (_path, os.strerror(_errno)))
+            self.watches[_wd] = _path
+        # List the directories after the watches are set so that no entry
+        # is missed
+        self.__rescan()
+        logger.debug("@InotifyWatcher - Watching: %s", self.paths)
+
+    def stop(self):
+        if self.fd is not None:
+            os.close(self.fd)
+        self.fd = None
+        self.watches = {}
+        self.entries = {}
+
+    def listdir(self, path):
+        self.__read_events()
+        if path not in self.entries:
+            return os.listdir(path)
+        return list(self.entries[path])
+
+    def wait(self, timeout):
+        _end = time.time() + timeout
+        while True:
+            _timeout = _end - time.time()
+            if _timeout <= 0:
+                return False
+            try:
+                _ready = select.select([self.fd], [], [], _timeout)[0]
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    # Interrupted by a signal (e.g. reload) - let the caller
+                    # decide what to do
+                    return False
+                raise
+            if _ready and self.__read_events():
+                return True
+
+    def __rescan(self):
+        """ List all watched directories. """
+        for _path in self.watches.values():
+            self.entries[_path] = OrderedDict.fromkeys(os.listdir(_path))
+
+    def __read_events(self):
+        """
+        Read all pending inotify events and apply them to the in-memory copy
+        of the directories.
+
+        :return: True if any entries were added.
+        """
+        _added = False
+        while True:
+            try:
+                _buf = os.read(self.fd, 65536)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    break
+                raise
+            if not _buf:
+                break
+
+            _pos = 0
+            while _pos < len(_buf):
+                _wd, _mask, _cookie, _len = \
+                    _EVENT_HEADER.unpack_from(_buf, _pos)
+                _pos += _EVENT_HEADER.size
+                _name = _buf[_pos:_pos + _len].rstrip('\0')
+                _pos += _len
+
+                if _mask & IN_Q_OVERFLOW:
+                    logger.warning("@InotifyWatcher - Event queue overflow. "
+                                   "Rescan directories.")
+                    self.__rescan()
+                    _added = True
+                    continue
+
+                _path = self.watches.get(_wd)
+                if _path is None:
+                    continue
+                if _mask & IN_LOST:
+                    # The directory is gone - fall back to os.listdir
+                    logger.error("@InotifyWatcher - Lost watch for %s.",
+                                 _path)
+                    del self.watches[_wd]
+                    self.entries.pop(_path, None)
+                    continue
+
+                _entries = self.entries[_path]
+                if _mask & IN_ADD:
+                    _entries[_name] = None
+                    _added = True
+                elif _mask & IN_REMOVE:
+                    _entries.pop(_name, None)
+
+        return _added
+
+
+def create_watcher(paths, mode=None):
+    """
+    Create a watcher for AppGW directories.
+
+    :param paths: list of directories to watch.
+    :param mode: "poll" or "inotify", defaults to conf.gate_watch_mode.
+        When inotify is not available polling is used.
+    :return: started watcher instance.
+    """
+    if mode is None:
+        mode = conf.gate_watch_mode
+
+    if mode == 'inotify':
+        _watcher = InotifyWatcher(paths)
+        try:
+            _watcher.start()
+            return _watcher
+        except (WatcherError, OSError):
+            logger.warning("@Watcher - Unable to start inotify watcher. "
+                           "Fall back to polling.", exc_info=True)
+    elif mode != 'poll':
+        logger.error("@Watcher - Unknown watch mode %s. Use polling.", mode)
+
+    _watcher = PollWatcher(paths)
+    _watcher.start()
+    logger.log(VERBOSE, "@Watcher - Polling: %s", paths)
+    return _watcher
@@ -0,0 +1,134 @@
+# Test suite for Admission module
+import tempfile
+import shutil
+
+from Config import conf
+from Admission import AdmissionController, WaitQueue, ADMIT, NO_SLOTS, \
+    NO_QUOTA
+from Jobs import JobState
+from nose.tools import eq_, ok_
+
+
+class FakeService(object):
+    def __init__(self, max_jobs, quota, job_size):
+        self.config = {'max_jobs': max_jobs, 'quota': quota,
+                       'job_size': job_size}
+
+
+class FakeJob(object):
+    def __init__(self, jid, service):
+        self.jid = jid
+        self.status = FakeService(0, 0, 0)
+        self.status.service = service
+
+
+class TestAdmissionController(object):
+
+    def setup(self):
+        self.path = tempfile.mkdtemp()
+        self.conf = dict((_key, conf[_key]) for _key in
+                         ('gate_path_output', 'config_max_jobs',
+                          'config_admission_step'))
+        conf.gate_path_output = self.path
+        conf.config_max_jobs = 4
+        conf.config_admission_step = 2
+        self.admission = AdmissionController({
+            'a': FakeService(2, 100, 10),
+            'b': FakeService(3, 15, 10),
+        })
+        self.counters = [('a', 1, 30), ('b', 0, 0), ('old', 1, 10)]
+        ok_(self.admission.sync(lambda: self.counters))
+
+    def teardown(self):
+        conf.update(self.conf)
+        shutil.rmtree(self.path)
+
+    def test_tokens(self):
+        """
+        AdmissionController consumes and returns slot and quota tokens
+        :return:
+        """
+        eq_(self.admission.slots, 2)
+        eq_(self.admission.admit('a'), ADMIT)
+        eq_(self.admission.admit('a'), NO_SLOTS)
+        eq_(self.admission.admit('b'), ADMIT)
+        eq_(self.admission.admit('b'), NO_SLOTS)
+        # Job finished - slot returned
+        self.admission.transition('b', 'cleanup', 'done')
+        eq_(self.admission.admit('b'), NO_QUOTA)
+        self.admission.release('b', 10)
+        eq_(self.admission.admit('b'), ADMIT)
+        # Job killed in waiting state occupies a slot
+        self.admission.transition('a', 'cleanup', 'done')
+        self.admission.transition('a', 'waiting', 'closing')
+        eq_(self.admission.admit('a'), NO_SLOTS)
+
+    def test_sync(self):
+        """
+        AdmissionController reloads tokens every n-th call or on demand
+        :return:
+        """
+        self.admission.admit('a')
+        self.counters = []
+        ok_(not self.admission.sync(lambda: self.counters))
+        eq_(self.admission.slots, 1)
+        ok_(self.admission.sync(lambda: self.counters))
+        eq_(self.admission.slots, 4)
+        self.admission.invalidate()
+        ok_(self.admission.sync(lambda: self.counters))
+
+    def test_ready(self):
+        """
+        AdmissionController.ready skips services without slots
+        :return:
+        """
+        _jobs = [FakeJob(_i, _s) for _i, _s in
+                 enumerate(('a', 'a', 'b', 'a', 'b', 'b'))]
+        _ready = []
+        for _job in self.admission.ready(_jobs):
+            _ready.append(_job.jid)
+            self.admission.admit(_job.status.service)
+        eq_(_ready, [0, 2])
+        self.counters = [('a', 2, 0)]
+        self.admission.invalidate()
+        self.admission.sync(lambda: self.counters)
+        eq_([_job.jid for _job in self.admission.ready(_jobs)], [2, 4, 5])
+
+
+class TestWaitQueue(object):
+
+    def setup(self):
+        self.queue = WaitQueue()
+        self.queue.park('a_0', 'a', 10, JobState.FLAG_WAIT_QUOTA)
+        self.queue.park('a_1', 'a', 5, JobState.FLAG_WAIT_INPUT)
+        self.queue.park('b_0', 'b', 20, JobState.FLAG_WAIT_QUOTA)
+
+    def test_expire(self):
+        """
+        WaitQueue wakes up jobs in the order of wait expiry
+        :return:
+        """
+        eq_(self.queue.expire(4), 0)
+        eq_(self.queue.expire(10), 2)
+        eq_(len(self.queue), 1)
+        ok_('b_0' in self.queue)
+        ok_(self.queue.pop_woken('a_0'))
+        ok_(not self.queue.pop_woken('a_0'))
+        # Parking again replaces the old entry
+        self.queue.park('b_0', 'b', 30, JobState.FLAG_WAIT_QUOTA)
+        eq_(self.queue.expire(25), 0)
+        eq_(self.queue.expire(30), 1)
+
+    def test_wake(self):
+        """
+        WaitQueue wakes up jobs early per service and wait flag
+        :return:
+        """
+        eq_(self.queue.wake_service('a', JobState.FLAG_WAIT_QUOTA), 1)
+        ok_(self.queue.pop_woken('a_0'))
+        eq_(self.queue.waiting_for(JobState.FLAG_WAIT_INPUT), set(['a_1']))
+        eq_(self.queue.wake(['a_1', 'b_0'], JobState.FLAG_WAIT_INPUT), 1)
+        eq_(self.queue.waiting_for(JobState.FLAG_WAIT_INPUT), set())
+        self.queue.discard('b_0')
+        eq_(len(self.queue), 0)
+        eq_(self.queue.expire(100), 0)
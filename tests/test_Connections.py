@@ -0,0 +1,125 @@
+# Test suite for Connections module
+import time
+import spur
+
+from Config import conf
+from Connections import SshConnectionPool, SshPoolError
+from nose.tools import eq_, ok_, assert_raises
+
+
+class FakeTransport(object):
+    def __init__(self):
+        self.active = True
+        self.keepalive = None
+
+    def is_active(self):
+        return self.active
+
+    def set_keepalive(self, interval):
+        self.keepalive = interval
+
+
+class FakeClient(object):
+    def __init__(self, transport):
+        self.transport = transport
+
+    def get_transport(self):
+        return self.transport
+
+
+class FakeShell(object):
+    """ spur.SshShell replacement. Fails on commands listed in errors. """
+    def __init__(self, host, errors):
+        self.host = host
+        self.errors = errors
+        self._client = None
+        self.closed = False
+
+    def _get_ssh_transport(self):
+        if self.host == 'down':
+            raise spur.ssh.ConnectionError('Host unreachable')
+        self._client = FakeClient(FakeTransport())
+        return self._client.transport
+
+    def run(self, command, **kwargs):
+        if command[0] in self.errors:
+            raise self.errors.pop(command[0])
+        return command
+
+    def close(self):
+        self.closed = True
+
+
+class TestSshConnectionPool(object):
+
+    def setup(self):
+        self.conf = dict((_key, conf[_key]) for _key in
+                         ('ssh_backoff', 'ssh_backoff_max'))
+        conf.ssh_backoff = 10
+        conf.ssh_backoff_max = 15
+        self.shells = []
+        self.errors = {}
+        self.pool = SshConnectionPool(factory=self.factory)
+
+    def teardown(self):
+        conf.update(self.conf)
+
+    def factory(self, host, user):
+        _shell = FakeShell(host, self.errors)
+        self.shells.append(_shell)
+        return _shell
+
+    def test_reuse(self):
+        """
+        SshConnectionPool reuses live connections and replaces dead ones
+        :return:
+        """
+        eq_(self.pool.run('host', 'user', ['ls']), ['ls'])
+        self.pool.run('host', 'user', ['ls'])
+        self.pool.run('host', 'other', ['ls'])
+        eq_(len(self.shells), 2)
+        eq_(self.shells[0]._client.transport.keepalive, conf.ssh_keepalive)
+        # Connection closed by the host
+        self.shells[0]._client.transport.active = False
+        self.pool.run('host', 'user', ['ls'])
+        eq_(len(self.shells), 3)
+        ok_(self.shells[0].closed)
+        _metrics = self.pool.metrics()['user@host']
+        eq_(_metrics['connects'], 2)
+        eq_(_metrics['commands'], 3)
+        eq_(_metrics['active'], 0)
+
+    def test_retry(self):
+        """
+        SshConnectionPool retries commands that did not start once
+        :return:
+        """
+        self.errors['ls'] = spur.ssh.ConnectionError('Channel closed')
+        eq_(self.pool.run('host', 'user', ['ls']), ['ls'])
+        eq_(len(self.shells), 2)
+        # Command errors are not retried
+        self.errors['ls'] = OSError('shsub failed')
+        assert_raises(OSError, self.pool.run, 'host', 'user', ['ls'])
+        eq_(len(self.shells), 2)
+        eq_(self.pool.metrics()['user@host']['errors'], 2)
+
+    def test_backoff(self):
+        """
+        SshConnectionPool does not reconnect to failed hosts before backoff
+        :return:
+        """
+        assert_raises(spur.ssh.ConnectionError, self.pool.run,
+                      'down', 'user', ['ls'])
+        assert_raises(SshPoolError, self.pool.run, 'down', 'user', ['ls'])
+        eq_(len(self.shells), 1)
+        _login = self.pool.logins['user@down']
+        ok_(0 < self.pool.metrics()['user@down']['backoff'] <= 10)
+        # Backoff doubles up to the maximum
+        _login.retry_time = 0
+        assert_raises(spur.ssh.ConnectionError, self.pool.run,
+                      'down', 'user', ['ls'])
+        ok_(10 < _login.retry_time - time.time() <= 15)
+        # Other hosts are not affected
+        self.pool.run('host', 'user', ['ls'])
+        self.pool.close()
+        ok_(self.shells[-1].closed)
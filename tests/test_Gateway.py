@@ -0,0 +1,113 @@
+# Test suite for Gateway module
+import os
+import json
+import shutil
+import tempfile
+
+from Gateway import GatewayBatch, RECORD_VERSION
+from nose.tools import eq_, ok_
+
+
+class TestGatewayBatch(object):
+
+    def setup(self):
+        self.path = tempfile.mkdtemp()
+        for _dir in ('jobs', 'waiting', 'queued', 'opts', 'time'):
+            os.mkdir(os.path.join(self.path, _dir))
+        self.job = os.path.join(self.path, 'jobs', 'job_0')
+        open(self.job, 'w').close()
+
+    def teardown(self):
+        shutil.rmtree(self.path)
+
+    def test_state_transition(self):
+        """
+        GatewayBatch moves the job link and tolerates existing/missing entries
+        :return:
+        """
+        _waiting = os.path.join(self.path, 'waiting')
+        _queued = os.path.join(self.path, 'queued')
+        os.symlink(self.job, os.path.join(_waiting, 'job_0'))
+        os.symlink(self.job, os.path.join(_queued, 'job_1'))
+        _batch = GatewayBatch()
+        _batch.link(_queued, 'job_0', self.job)
+        _batch.link(_queued, 'job_1', self.job)
+        _batch.unlink(_waiting, 'job_0')
+        _batch.unlink(_waiting, 'job_1')
+        eq_(len(_batch), 4)
+        eq_(_batch.execute(), 0)
+        eq_(len(_batch), 0)
+        eq_(os.listdir(_waiting), [])
+        eq_(sorted(os.listdir(_queued)), ['job_0', 'job_1'])
+        eq_(os.readlink(os.path.join(_queued, 'job_0')), self.job)
+
+    def test_files(self):
+        """
+        GatewayBatch writes opts files and time stamps
+        :return:
+        """
+        _opts = os.path.join(self.path, 'opts')
+        _time = os.path.join(self.path, 'time')
+        _batch = GatewayBatch()
+        _batch.write(_opts, 'message_job_0', u'Done')
+        _batch.touch(_time, 'submit_job_0', 1000000000.0)
+        _batch.touch(_time, 'stop_job_0', 1000000000.0)
+        _batch.unlink(_time, 'stop_job_0')
+        eq_(_batch.execute(), 0)
+        with open(os.path.join(_opts, 'message_job_0')) as _f:
+            eq_(_f.read(), 'Done')
+        eq_(os.listdir(_time), ['submit_job_0'])
+        eq_(os.stat(os.path.join(_time, 'submit_job_0')).st_mtime,
+            1000000000.0)
+
+    def test_errors(self):
+        """
+        GatewayBatch counts failed operations and continues
+        :return:
+        """
+        _batch = GatewayBatch()
+        _batch.link(os.path.join(self.path, 'missing'), 'job_0', self.job)
+        _batch.link(os.path.join(self.path, 'waiting'), 'job_0', self.job)
+        eq_(_batch.execute(), 1)
+        ok_(os.path.islink(os.path.join(self.path, 'waiting', 'job_0')))
+
+    def test_record(self):
+        """
+        GatewayBatch merges updates of JSON status records
+        :return:
+        """
+        _status = os.path.join(self.path, 'opts')
+        _batch = GatewayBatch()
+        _batch.update(_status, 'job_0.json', {'id': 'job_0', 'state': 'new'})
+        _batch.update(_status, 'job_0.json', {'state': 'waiting'})
+        eq_(_batch.execute(), 0)
+        _batch.update(_status, 'job_0.json', {'exit_code': 0})
+        eq_(_batch.execute(), 0)
+        eq_(os.listdir(_status), ['job_0.json'])
+        with open(os.path.join(_status, 'job_0.json')) as _f:
+            eq_(json.load(_f), {'version': RECORD_VERSION, 'id': 'job_0',
+                                'state': 'waiting', 'exit_code': 0})
+
+    def test_record_concurrent(self):
+        """
+        GatewayBatch does not lose concurrent updates of a status record
+        :return:
+        """
+        _status = os.path.join(self.path, 'opts')
+        _pids = []
+        for _i in range(4):
+            _pid = os.fork()
+            if _pid == 0:
+                _errors = 0
+                for _j in range(50):
+                    _batch = GatewayBatch()
+                    _batch.update(_status, 'job_0.json',
+                                  {'field_%s_%s' % (_i, _j): _j})
+                    _errors += _batch.execute()
+                os._exit(_errors)
+            _pids.append(_pid)
+        for _pid in _pids:
+            eq_(os.waitpid(_pid, 0)[1], 0)
+        eq_(os.listdir(_status), ['job_0.json'])
+        with open(os.path.join(_status, 'job_0.json')) as _f:
+            eq_(len(json.load(_f)), 201)
@@ -0,0 +1,227 @@
+# Test suite for JobManager module
+import shutil
+import tempfile
+
+from datetime import datetime, timedelta
+
+import Globals as G
+from Config import conf
+from JobManager import JobManager
+from Admission import AdmissionController, WaitQueue
+from Jobs import JobState
+from nose.tools import eq_, ok_
+
+
+class FakeService(object):
+    def __init__(self):
+        self.config = {'max_jobs': 10, 'quota': 1000, 'job_size': 10}
+
+
+class FakeStatus(object):
+    def __init__(self, service, flags, wait_time):
+        self.service = service
+        self.flags = flags
+        self.submit_time = wait_time
+        self.wait_time = wait_time
+
+
+class FakeJob(object):
+    def __init__(self, jid, flags, wait_time):
+        self.jid = jid
+        self.status = FakeStatus('test', flags, wait_time)
+
+    def id(self):
+        return self.jid
+
+    def get_flag(self, flag):
+        return self.status.flags & flag
+
+    def set_flag(self, flag, remove=False):
+        if remove:
+            self.status.flags &= ~flag
+        else:
+            self.status.flags |= flag
+
+    def get_state(self):
+        return 'waiting'
+
+
+class FakeStateManager(object):
+    def __init__(self, jobs):
+        self.jobs = jobs
+        self.counters = []
+
+    def get_service_counters(self):
+        return self.counters
+
+    def get_new_job_list(self):
+        return self.jobs
+
+    def get_input_list(self):
+        return []
+
+    def get_job_list(self, *args, **kwargs):
+        return []
+
+    def check_commit(self, session=None):
+        return True
+
+
+class FakeThread(object):
+    def __init__(self, result):
+        self.result = result
+
+    def ready(self):
+        return True
+
+    def get(self):
+        return self.result
+
+
+class FakeJobManager(JobManager):
+    """ JobManager without DB, schedulers and worker pools. """
+
+    def init(self):
+        self._JobManager__admission = AdmissionController(
+            {'test': FakeService()})
+        self._JobManager__wait_queue = WaitQueue()
+        self._JobManager__input_list = None
+        self._JobManager__w_counter_slots = {'test': 0}
+        self._JobManager__timing = {}
+        self._JobManager__thread_list_submit = []
+        self._JobManager__thread_list_cleanup = []
+        self._JobManager__slots_step = 100
+        self.submitted = []
+
+    def batch_submit(self, batch):
+        self.submitted.extend(_job.id() for _job in batch)
+
+    @property
+    def wait_queue(self):
+        return self._JobManager__wait_queue
+
+    @property
+    def admission(self):
+        return self._JobManager__admission
+
+
+class TestCheckNewJobs(object):
+
+    def setup(self):
+        self.path = tempfile.mkdtemp()
+        self.conf = dict((_key, conf[_key]) for _key in
+                         ('gate_path_output', 'config_max_jobs',
+                          'config_admission_step', 'config_wait_time'))
+        self.state_manager = G.STATE_MANAGER
+        conf.gate_path_output = self.path
+        conf.config_max_jobs = 10
+        conf.config_admission_step = 1
+        conf.config_wait_time = 600
+        _now = datetime.utcnow()
+        self.jobs = [
+            FakeJob('quota', JobState.FLAG_WAIT_QUOTA, _now),
+            FakeJob('input', JobState.FLAG_WAIT_INPUT, _now),
+        ]
+        G.STATE_MANAGER = FakeStateManager(self.jobs)
+        self.manager = FakeJobManager()
+
+    def teardown(self):
+        G.STATE_MANAGER = self.state_manager
+        conf.update(self.conf)
+        shutil.rmtree(self.path)
+
+    def test_expire(self):
+        """
+        JobManager submits jobs with expired wait time without wait flags
+        :return:
+        """
+        self.manager.check_new_jobs()
+        eq_(self.manager.submitted, [])
+        eq_(len(self.manager.wait_queue), 2)
+        # Wait time expired
+        self.manager.wait_queue.expire(
+            datetime.utcnow() + timedelta(seconds=conf.config_wait_time))
+        self.manager.check_new_jobs()
+        eq_(self.manager.submitted, ['quota', 'input'])
+        eq_([_job.status.flags for _job in self.jobs], [0, 0])
+        eq_(self.manager.wait_queue.woken, set())
+
+    def test_wake_no_slots(self):
+        """
+        JobManager keeps woken jobs eligible until a job slot is free
+        :return:
+        """
+        self.manager.check_new_jobs()
+        self.manager.wait_queue.wake_service('test', JobState.FLAG_WAIT_QUOTA)
+        # No free job slots
+        G.STATE_MANAGER.counters = [('test', 10, 0)]
+        self.manager.check_new_jobs()
+        eq_(self.manager.submitted, [])
+        ok_('quota' not in self.manager.wait_queue)
+        G.STATE_MANAGER.counters = []
+        self.manager.check_new_jobs()
+        eq_(self.manager.submitted, ['quota'])
+        eq_(self.jobs[0].status.flags, 0)
+        ok_('input' in self.manager.wait_queue)
+
+
+class TestCheckFinishedThreads(object):
+
+    def setup(self):
+        self.path = tempfile.mkdtemp()
+        self.conf = dict((_key, conf[_key]) for _key in
+                         ('gate_path_output', 'config_max_jobs',
+                          'config_admission_step'))
+        self.state_manager = G.STATE_MANAGER
+        conf.gate_path_output = self.path
+        conf.config_max_jobs = 10
+        conf.config_admission_step = 5
+        G.STATE_MANAGER = FakeStateManager([])
+        self.manager = FakeJobManager()
+        self.manager.admission.sync(G.STATE_MANAGER.get_service_counters)
+
+    def teardown(self):
+        G.STATE_MANAGER = self.state_manager
+        conf.update(self.conf)
+        shutil.rmtree(self.path)
+
+    def test_failed_worker(self):
+        """
+        JobManager resyncs admission tokens when a worker reports no states
+        :return:
+        """
+        self.manager.admission.admit('test')
+        self.manager._JobManager__thread_list_submit.append(
+            FakeThread([('test', 'test', 'queued')]))
+        self.manager.check_finished_threads()
+        eq_(self.manager.admission.steps, 4)
+        # Tokens of the failed batch are returned by the next sync
+        self.manager.admission.admit('test')
+        self.manager._JobManager__thread_list_submit.append(FakeThread([]))
+        self.manager.check_finished_threads()
+        eq_(self.manager.admission.steps, 0)
+        ok_(self.manager.admission.sync(G.STATE_MANAGER.get_service_counters))
+        eq_(self.manager.admission.slots, 10)
+
+    def test_sync_running_worker(self):
+        """
+        JobManager does not resync admission tokens while workers are running
+        :return:
+        """
+        G.STATE_MANAGER.counters = [('test', 1, 0)]
+        self.manager.admission.invalidate()
+        self.manager.check_new_jobs()
+        eq_(self.manager.admission.slots, 9)
+        # Cleanup worker stored the final state, its result is not applied
+        G.STATE_MANAGER.counters = []
+        self.manager._JobManager__thread_list_cleanup.append(
+            FakeThread([('test', 'done')]))
+        self.manager.admission.invalidate()
+        self.manager.check_new_jobs()
+        eq_(self.manager.admission.slots, 9)
+        self.manager.check_finished_threads()
+        eq_(self.manager.admission.slots, 10)
+        # Without workers the tokens are reloaded
+        self.manager.admission.invalidate()
+        self.manager.check_new_jobs()
+        eq_(self.manager.admission.slots, 10)
@@ -0,0 +1,100 @@
+# Test suite for Jobs module
+import os
+
+import Globals as G
+from Config import conf
+from Jobs import StateManager, JobState
+from nose.tools import eq_, ok_
+
+
+def setup_module():
+    """
+    Some configuration options to adapt environment for testing
+    :return:
+    """
+    test_assets = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'assets')
+    conf.gate_path_jobs = os.path.join(test_assets, 'payloads')
+    conf.service_path_conf = os.path.join(test_assets, 'services')
+    conf.service_path_data = os.path.join(test_assets, 'services', 'Data')
+    G.init()
+
+
+class TestStateManager(object):
+
+    def setup(self):
+        self.conf = {'config_db': conf.config_db}
+        # New in-memory DB for every test
+        conf.config_db = 'sqlite://'
+        self.manager = StateManager()
+        self.manager.init()
+        self.session = self.manager.session
+
+    def teardown(self):
+        self.manager.clear()
+        conf.update(self.conf)
+
+    def get_ids(self):
+        return sorted(_id for (_id,) in self.session.query(JobState.id))
+
+    def test_insert_jobs(self):
+        """
+        StateManager.insert_jobs rejects unknown and skips existing jobs
+        :return:
+        """
+        _rows, _rejected, _existing = self.manager.insert_jobs(
+            ['test_0', 'test_1', 'test_1', 'unknown_0', 'test_' + 'x' * 300])
+        self.manager.commit()
+        eq_(sorted(_row['id'] for _row in _rows), ['test_0', 'test_1'])
+        eq_(_rows[0]['state'], 'waiting')
+        eq_(_rows[0]['service'], 'test')
+        eq_(sorted(_rejected), ['test_' + 'x' * 300, 'unknown_0'])
+        eq_(_existing, [])
+
+        _rows, _rejected, _existing = self.manager.insert_jobs(
+            ['test_1', 'test_2'])
+        self.manager.commit()
+        eq_([_row['id'] for _row in _rows], ['test_2'])
+        eq_(_rejected, [])
+        eq_(_existing, ['test_1'])
+        eq_(self.get_ids(), ['test_0', 'test_1', 'test_2'])
+        # Every job has its Job row
+        eq_(len(self.manager.get_job_list_byid(self.get_ids())), 3)
+
+    def test_insert_isolated(self):
+        """
+        StateManager.insert_jobs isolates a failing job and inserts the rest
+        :return:
+        """
+        self.session.execute(
+            "CREATE TRIGGER reject_bad BEFORE INSERT ON job_states "
+            "WHEN NEW.id = 'test_bad' BEGIN "
+            "SELECT RAISE(ABORT, 'malformed job'); END")
+        self.session.commit()
+        _ids = ['test_%s' % _i for _i in range(9)] + ['test_bad']
+        _rows, _rejected, _existing = self.manager.insert_jobs(_ids)
+        self.manager.commit()
+        eq_(len(_rows), 9)
+        eq_(_rejected, ['test_bad'])
+        eq_(self.get_ids(), sorted(_ids[:-1]))
+
+    def test_set_flag_many(self):
+        """
+        StateManager.set_flag_many sets flags and returns missing jobs
+        :return:
+        """
+        self.manager.insert_jobs(['test_0', 'test_1'])
+        self.manager.commit()
+        _job = self.manager.get_job_list_byid(['test_0'])[0]
+        eq_(_job.status.flags, 0)
+        eq_(self.manager.set_flag_many(
+            ['test_0', 'test_1', 'test_2'], JobState.FLAG_DELETE),
+            set(['test_2']))
+        self.manager.commit()
+        # Loaded instances see the new flags
+        ok_(_job.get_flag(JobState.FLAG_DELETE))
+        eq_(self.manager.set_flag_many(['test_1'], JobState.FLAG_STOP),
+            set())
+        self.manager.commit()
+        eq_(sorted(self.session.query(JobState.id, JobState.flags)),
+            [('test_0', JobState.FLAG_DELETE),
+             ('test_1', JobState.FLAG_DELETE | JobState.FLAG_STOP)])
@@ -0,0 +1,90 @@
+# Test suite for Reaper module
+import os
+import errno
+import time
+import shutil
+import tempfile
+
+from Config import conf
+from Reaper import DumpReaper, dump
+from nose.tools import eq_, ok_
+
+
+class TestDumpReaper(object):
+
+    def setup(self):
+        self.path = tempfile.mkdtemp()
+        self.conf = {'gate_path_dump': conf.gate_path_dump}
+        conf.gate_path_dump = os.path.join(self.path, 'dump')
+        os.mkdir(conf.gate_path_dump)
+        self.output = os.path.join(self.path, 'output')
+        for _i in range(5):
+            _dir = os.path.join(self.output, 'd%s' % _i)
+            os.makedirs(_dir)
+            for _j in range(10):
+                with open(os.path.join(_dir, 'f%s' % _j), 'w') as _f:
+                    _f.write('x' * 100)
+        os.symlink(self.path, os.path.join(self.output, 'link'))
+
+    def teardown(self):
+        conf.update(self.conf)
+        shutil.rmtree(self.path)
+
+    def test_dump(self):
+        """
+        dump moves directories to the dump directory under unique names
+        :return:
+        """
+        dump(self.output, 'j0')
+        os.mkdir(self.output)
+        dump(self.output, 'j0')
+        ok_(not os.path.exists(self.output))
+        eq_(len(os.listdir(conf.gate_path_dump)), 2)
+
+    def test_remove(self):
+        """
+        DumpReaper removes dumped trees respecting the rate limit
+        :return:
+        """
+        dump(self.output, 'j0')
+        _reaper = DumpReaper(conf.gate_path_dump, files_rate=20,
+                             bytes_rate=10000, interval=0.1)
+        _start = time.time()
+        _reaper.start()
+        for _i in range(100):
+            if not os.listdir(conf.gate_path_dump):
+                break
+            time.sleep(0.05)
+        _reaper.stop()
+        eq_(os.listdir(conf.gate_path_dump), [])
+        # 51 files at 20 files per second
+        ok_(time.time() - _start > 2)
+        eq_(_reaper.backlog(), {'pending': 0, 'removed_files': 51,
+                                'removed_bytes': 5000 + len(self.path)})
+        # Link target is not removed
+        ok_(os.path.isdir(self.path))
+
+    def test_failure(self):
+        """
+        DumpReaper waits before retrying entries it cannot remove
+        :return:
+        """
+        dump(self.output, 'j0')
+        _calls = []
+
+        def _rmdir(path):
+            _calls.append(path)
+            raise OSError(errno.EACCES, 'Permission denied', path)
+
+        _reaper = DumpReaper(conf.gate_path_dump, interval=10)
+        _rmdir_orig = os.rmdir
+        os.rmdir = _rmdir
+        try:
+            _reaper.start()
+            time.sleep(0.5)
+            _reaper.stop()
+        finally:
+            os.rmdir = _rmdir_orig
+        # One pass: 5 subdirectories and the dumped directory
+        eq_(len(_calls), 6)
+        eq_(_reaper.backlog()['pending'], 1)
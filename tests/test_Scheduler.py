@@ -1,11 +1,20 @@
 # Test suite for Scheduler module
+import errno
+import sys
 import shutil
+import stat
+import tempfile
+import time
+from StringIO import StringIO
 
 import Globals as G
+import Schedulers
 from Config import conf
-from Schedulers import Scheduler
+from Schedulers import Scheduler, SshScheduler, LocalScheduler, \
+    DummyScheduler, SchedulerStore, ScriptBundle, QstatPoller, SlotCounter, \
+    parse_qstat, copy_static, link_tree, make_readable, publish
 from Jobs import Job
-from nose.tools import eq_, ok_, raises
+from nose.tools import eq_, ok_, raises, assert_raises
 import os
 #from Services import ServiceStore, Service, Validator
 
@@ -96,3 +105,604 @@ class TestGenerateScripts(object):
                     "    B: 21 ?",
                     "    B: 30 ?",
                     "    B: 41 ?"])
+
+
+class TestScriptBundle(object):
+
+    def test_compile(self):
+        """
+        ScriptBundle compiles only files with template markup
+        :return:
+        """
+        _bundle = ScriptBundle('basic')
+        eq_(_bundle.error, None)
+        eq_(_bundle.dirs, ['subdir'])
+        _files = dict((_f[0], _f) for _f in _bundle.files)
+        eq_(sorted(_files), ['epilogue.sh', 'input.txt', 'pbs.sh',
+                             os.path.join('subdir', 'bla.txt')])
+        ok_(_files['pbs.sh'][1] is not None)
+        ok_(_files['pbs.sh'][2] & stat.S_IXUSR)
+        eq_(_files['epilogue.sh'][1], None)
+        eq_(_files['epilogue.sh'][2] & (stat.S_IWGRP | stat.S_IWOTH), 0)
+        ok_(ScriptBundle('missing').error.startswith(
+            'Service data directory not found'))
+
+    def test_copy_static(self):
+        """
+        copy_static links or copies static files with the requested mode
+        :return:
+        """
+        _path = tempfile.mkdtemp()
+        try:
+            _source = os.path.join(_path, 'data')
+            with open(_source, 'wb') as _f:
+                _f.write('static\x00data\n' * 100000)
+            os.chmod(_source, 0o640)
+            copy_static(_source, os.path.join(_path, 'copy'), 0o600)
+            copy_static(_source, os.path.join(_path, 'link'), 0o640, True)
+            _st = os.stat(os.path.join(_path, 'copy'))
+            eq_(stat.S_IMODE(_st.st_mode), 0o600)
+            ok_(_st.st_ino != os.stat(_source).st_ino)
+            with open(os.path.join(_path, 'copy'), 'rb') as _f:
+                eq_(_f.read(), 'static\x00data\n' * 100000)
+            eq_(os.stat(os.path.join(_path, 'link')).st_ino,
+                os.stat(_source).st_ino)
+        finally:
+            shutil.rmtree(_path)
+
+
+class TestLinkTree(object):
+
+    def setup(self):
+        self.path = tempfile.mkdtemp()
+        self.source = os.path.join(self.path, 'source')
+        os.makedirs(os.path.join(self.source, 'sub'))
+        for _name in ('a.txt', os.path.join('sub', 'b.txt')):
+            with open(os.path.join(self.source, _name), 'w') as _f:
+                _f.write(_name)
+            os.chmod(os.path.join(self.source, _name), 0o664)
+
+    def teardown(self):
+        shutil.rmtree(self.path)
+
+    def check_tree(self, mode, name=None):
+        _target = os.path.join(self.path, name or mode)
+        link_tree(self.source, _target, mode)
+        for _name in ('a.txt', os.path.join('sub', 'b.txt')):
+            with open(os.path.join(_target, _name)) as _f:
+                eq_(_f.read(), _name)
+        return _target
+
+    def test_modes(self):
+        """
+        link_tree clones, hardlinks or symlinks files of a directory tree
+        :return:
+        """
+        _source = os.path.join(self.source, 'sub', 'b.txt')
+        _target = self.check_tree('reflink')
+        _st = os.stat(os.path.join(_target, 'sub', 'b.txt'))
+        ok_(_st.st_ino != os.stat(_source).st_ino)
+        eq_(stat.S_IMODE(os.stat(_source).st_mode), 0o664)
+
+        _target = self.check_tree('hardlink')
+        _st = os.stat(os.path.join(_target, 'sub', 'b.txt'))
+        eq_(_st.st_ino, os.stat(_source).st_ino)
+        # Source files are protected from modification
+        eq_(stat.S_IMODE(_st.st_mode), 0o444)
+
+        _target = self.check_tree('symlink')
+        eq_(os.readlink(os.path.join(_target, 'sub', 'b.txt')), _source)
+        assert_raises(ValueError, link_tree, self.source,
+                      os.path.join(self.path, 'bad'), 'bad')
+
+    def test_fallback(self):
+        """
+        link_tree copies files it cannot protect or link
+        :return:
+        """
+        # Writable file of another user is not changed
+        _source = os.path.join(self.source, 'a.txt')
+        os.chown(_source, os.geteuid() + 1, -1)
+        _target = self.check_tree('hardlink')
+        ok_(os.stat(os.path.join(_target, 'a.txt')).st_ino !=
+            os.stat(_source).st_ino)
+        eq_(stat.S_IMODE(os.stat(_source).st_mode), 0o664)
+        # Link not permitted
+        _link = os.link
+
+        def _link_eperm(source, target):
+            raise OSError(errno.EPERM, 'Operation not permitted', target)
+
+        os.link = _link_eperm
+        try:
+            _target = self.check_tree('hardlink', 'eperm')
+        finally:
+            os.link = _link
+        ok_(not os.path.islink(os.path.join(_target, 'sub', 'b.txt')))
+
+
+class TestPublish(object):
+
+    def setup(self):
+        self.path = tempfile.mkdtemp()
+        self.conf = dict((_key, conf[_key]) for _key in
+                         ('gate_path_output', 'gate_path_dump'))
+        conf.gate_path_output = os.path.join(self.path, 'output')
+        conf.gate_path_dump = os.path.join(self.path, 'dump')
+        os.mkdir(conf.gate_path_output)
+        os.mkdir(conf.gate_path_dump)
+        self.work_dir = os.path.join(self.path, 'j0')
+        os.makedirs(os.path.join(self.work_dir, 'sub'))
+        for _name in ('a.txt', os.path.join('sub', 'b.txt')):
+            with open(os.path.join(self.work_dir, _name), 'w') as _f:
+                _f.write(_name)
+        os.chmod(os.path.join(self.work_dir, 'a.txt'), 0o600)
+        os.chmod(os.path.join(self.work_dir, 'sub', 'b.txt'), 0o644)
+        os.chmod(os.path.join(self.work_dir, 'sub'), 0o700)
+        os.symlink('/nonexistent', os.path.join(self.work_dir, 'link'))
+
+    def teardown(self):
+        conf.update(self.conf)
+        shutil.rmtree(self.path)
+
+    def test_make_readable(self):
+        """
+        make_readable changes only entries that are not world readable
+        :return:
+        """
+        eq_(make_readable(self.work_dir), 2)
+        eq_(stat.S_IMODE(os.stat(
+            os.path.join(self.work_dir, 'a.txt')).st_mode), 0o644)
+        eq_(stat.S_IMODE(os.stat(
+            os.path.join(self.work_dir, 'sub')).st_mode), 0o755)
+        eq_(make_readable(self.work_dir), 0)
+
+    def test_publish(self):
+        """
+        publish replaces existing job output with the working directory
+        :return:
+        """
+        _out_dir = os.path.join(conf.gate_path_output, 'j0')
+        os.makedirs(os.path.join(_out_dir, 'old'))
+        publish(self.work_dir, 'j0')
+        ok_(not os.path.exists(self.work_dir))
+        eq_(sorted(os.listdir(_out_dir)), ['a.txt', 'link', 'sub'])
+        # Previous output waits for removal in the dump directory
+        _dump = os.listdir(conf.gate_path_dump)
+        eq_(len(_dump), 1)
+        ok_(_dump[0].startswith('j0.'))
+        eq_(os.listdir(os.path.join(conf.gate_path_dump, _dump[0])), ['old'])
+
+    def test_publish_exchange(self):
+        """
+        publish never leaves the job without output
+        :return:
+        """
+        _out_dir = os.path.join(conf.gate_path_output, 'j0')
+        os.makedirs(os.path.join(_out_dir, 'old'))
+        _ino = os.stat(self.work_dir).st_ino
+        _rename = os.rename
+        _renamed = []
+
+        def _rename_log(source, target):
+            _renamed.append(source)
+            _rename(source, target)
+
+        os.rename = _rename_log
+        try:
+            publish(self.work_dir, 'j0')
+        finally:
+            os.rename = _rename
+        eq_(os.stat(_out_dir).st_ino, _ino)
+        ok_(_out_dir not in _renamed)
+        # Without atomic exchange the old output is renamed aside
+        os.mkdir(self.work_dir)
+        _libc = Schedulers._libc
+        Schedulers._libc = None
+        try:
+            publish(self.work_dir, 'j0')
+        finally:
+            Schedulers._libc = _libc
+        eq_(os.listdir(_out_dir), [])
+        eq_(len(os.listdir(conf.gate_path_dump)), 2)
+        eq_(os.listdir(conf.gate_path_output), ['j0'])
+
+
+class TestQstatPoller(object):
+
+    def setup(self):
+        self.poller = QstatPoller(['a', 'b'])
+        self.poller.snapshots['a'] = (time.time(), {'1': ('Q', None)})
+
+    def test_diff(self):
+        """
+        QstatPoller.diff returns only changed and missing jobs
+        :return:
+        """
+        _jobs = {'1': ('a', 'queued'), '2': ('a', 'queued'),
+                 '3': ('b', 'queued')}
+        eq_(self.poller.diff(_jobs), {})
+        # Job 2 is missing only in snapshot taken after it was asked for
+        self.poller.snapshots['a'] = (time.time() + 1,
+                                      {'1': ('R', None), '3': ('R', None)})
+        # Jobs of users without a snapshot are not reported
+        eq_(self.poller.diff(_jobs), {'1': ('R', None), '2': None})
+        # Jobs in their stored state are not reported, finished always are
+        _jobs['1'] = ('a', 'running')
+        del _jobs['2']
+        eq_(self.poller.diff(_jobs), {})
+        self.poller.snapshots['a'] = (time.time() + 2, {'1': ('C', '0')})
+        eq_(self.poller.diff(_jobs), {'1': ('C', '0')})
+
+    def test_poll(self):
+        """
+        QstatPoller.poll does not block on large qstat error output
+        :return:
+        """
+        _popen = Schedulers.Popen
+        _timeout = conf.pbs_timeout
+        _script = "import sys; sys.stderr.write('x' * 1000000); " \
+                  "sys.stdout.write('<Data><Job><Job_Id>1</Job_Id>" \
+                  "<job_state>R</job_state></Job></Data>')"
+
+        def _qstat(opts, **kwargs):
+            return _popen([sys.executable, '-c', _script], **kwargs)
+
+        Schedulers.Popen = _qstat
+        conf.pbs_timeout = 10
+        try:
+            _start = time.time()
+            self.poller.poll('a')
+        finally:
+            Schedulers.Popen = _popen
+            conf.pbs_timeout = _timeout
+        ok_(time.time() - _start < 5)
+        eq_(self.poller.snapshots['a'][1], {'1': ('R', None)})
+
+    def test_rollback(self):
+        """
+        QstatPoller.diff hands out changes again if they were not stored
+        :return:
+        """
+        _jobs = {'1': ('a', 'queued')}
+        self.poller.snapshots['a'] = (time.time(), {'1': ('R', None)})
+        eq_(self.poller.diff(_jobs), {'1': ('R', None)})
+        # The transition to running was rolled back
+        eq_(self.poller.diff(_jobs), {'1': ('R', None)})
+        # The transition was stored
+        _jobs['1'] = ('a', 'running')
+        eq_(self.poller.diff(_jobs), {})
+
+
+class TestParseQstat(object):
+
+    def test_parse(self):
+        """
+        parse_qstat extracts job states from a large qstat output
+        :return:
+        """
+        _xjob = '<Job><Job_Id>%d.pbs</Job_Id><Job_Name>test</Job_Name>' \
+                '<job_state>%s</job_state>%s<Resource_List><walltime>' \
+                '01:00:00</walltime></Resource_List></Job>'
+        with tempfile.TemporaryFile() as _f:
+            _f.write('<Data>')
+            for _i in range(50000):
+                if _i % 2:
+                    _f.write(_xjob % (_i, 'C', '<exit_status>%d</exit_status>'
+                                      % (_i % 3)))
+                else:
+                    _f.write(_xjob % (_i, 'R', ''))
+            _f.write('</Data>')
+            _f.seek(0)
+            _states = parse_qstat(_f)
+        eq_(len(_states), 50000)
+        eq_(_states['0.pbs'], ('R', None))
+        eq_(_states['49999.pbs'], ('C', '1'))
+
+    def test_empty(self):
+        """
+        parse_qstat accepts empty output and rejects garbage
+        :return:
+        """
+        eq_(parse_qstat(StringIO('')), {})
+        assert_raises(SyntaxError, parse_qstat, StringIO('qstat: error'))
+        assert_raises(SyntaxError, parse_qstat,
+                      StringIO('<Data><Job><Job_Id>1</Job_Id></Job><Job>'))
+
+
+class TestSlotCounter(object):
+
+    def test_reserve(self):
+        """
+        SlotCounter reserves at most the free job slots
+        :return:
+        """
+        _slots = SlotCounter({'host1': 2, 'host2': 1})
+        eq_(_slots.limit, 3)
+        eq_(_slots.reserve(2), 2)
+        eq_(_slots.reserve(5), 1)
+        eq_(_slots.reserve(), 0)
+        _slots.release()
+        eq_(_slots.reserve(), 1)
+        _slots.reset(1)
+        eq_(_slots.reserve(5), 2)
+        _slots.release(10)
+        eq_(_slots.used.value, 0)
+
+
+class FakeResult(object):
+    def __init__(self, output):
+        self.output = output
+        self.stderr_output = ''
+
+
+class FakeSshPool(object):
+    def __init__(self, outputs):
+        self.outputs = outputs
+        self.commands = []
+
+    def run(self, host, user, command, **kwargs):
+        self.commands.append(command[1:])
+        return FakeResult(self.outputs.pop(0))
+
+    def metrics(self):
+        return {}
+
+    def close(self):
+        pass
+
+
+class TestShstat(object):
+
+    def test_cursor(self):
+        """
+        SshScheduler.shstat applies job state changes after the cursor
+        :return:
+        """
+        _scheduler = SshScheduler()
+        _scheduler.pool = FakeSshPool([
+            '# cursor 1:0 full\n10 -1\n11 -1\n',
+            '# cursor 1:12 delta\n10 0\n',
+            '# cursor 2:0 full\n12 -1\n',
+            '13 1\n',
+        ])
+        _states = _scheduler.shstat('user', 'host')
+        eq_(sorted(_states), ['10', '11'])
+        _states = _scheduler.shstat('user', 'host')
+        eq_(_states['10'][0], '0')
+        eq_(_states['11'][0], '-1')
+        # Journal rotated - all states are reported again
+        eq_(sorted(_scheduler.shstat('user', 'host')), ['12'])
+        # shstat without cursor support
+        eq_(_scheduler.shstat('user', 'host').keys(), ['13'])
+        eq_(_scheduler.pool.commands,
+            [['-c', '0'], ['-c', '1:0'], ['-c', '1:12'], ['-c', '2:0']])
+
+
+class FakeCheck(object):
+    def __init__(self, states):
+        self.states = states
+
+    def ready(self):
+        return True
+
+    def get(self, timeout=None):
+        return self.states
+
+
+class TestSshUpdate(object):
+
+    def test_stale_check(self):
+        """
+        SshScheduler.update does not kill jobs missing in stale check results
+        :return:
+        """
+        _scheduler = SshScheduler()
+        _scheduler.pool = FakeSshPool(['# cursor 1:0 full\n'])
+        _job = FakeSshJob('j0')
+        _job.scheduler = FakeResult('')
+        _job.scheduler.id = '100'
+        _job.scheduler.queue = 'host'
+        _login = (G.SERVICE_STORE['test'].config['username'], 'host')
+        # Check that timed out before the job was submitted
+        _scheduler.status_checks[_login] = (time.time() - 10, FakeCheck({}))
+        _scheduler.update([_job])
+        eq_(_job.message, None)
+        eq_(_scheduler.status_checks, {})
+        # New check started after the job was submitted
+        _scheduler.update([_job])
+        ok_('does not exist' in _job.message)
+        _scheduler.close()
+
+
+class FakeSshJob(object):
+    def __init__(self, jid, host=None):
+        self.jid = jid
+        self.status = FakeResult('')
+        self.status.service = 'test'
+        self.data = FakeResult('')
+        self.data.data = {}
+        if host is not None:
+            self.data.data['CIS_SSH_HOST'] = host
+        self.scheduler = None
+        self.message = None
+
+    def id(self):
+        return self.jid
+
+    def die(self, message, **kwargs):
+        self.message = message
+
+    def compact(self):
+        pass
+
+
+class TestShsub(object):
+
+    def test_batch(self):
+        """
+        SshScheduler.submit_batch submits jobs with one shsub call per login
+        :return:
+        """
+        _scheduler = SshScheduler()
+        _scheduler.slots = SlotCounter(4)
+        _scheduler.pool = FakeSshPool([
+            'j0 100\nj2 ERROR Job already exists.\n',
+            'j1 101\n',
+        ])
+        _jobs = [FakeSshJob('j0', 'host1'), FakeSshJob('j1', 'host2'),
+                 FakeSshJob('j2', 'host1'), FakeSshJob('j3', 'host1'),
+                 FakeSshJob('j4', 'host1')]
+        _results = _scheduler.submit_batch(_jobs)
+        eq_(_results, [True, True, False, False, False])
+        eq_(_scheduler.pool.commands, [['-b', '3'], ['-b', '1']])
+        eq_(_jobs[0].scheduler.id, '100')
+        eq_(_jobs[0].scheduler.queue, 'host1')
+        eq_(_jobs[1].scheduler.queue, 'host2')
+        ok_('already exists' in _jobs[2].message)
+        ok_('missing' in _jobs[3].message)
+        # No slots left for the last job
+        eq_(_jobs[4].message, None)
+        eq_(_scheduler.slots.reserve(4), 2)
+
+
+class FakeLocalJob(FakeSshJob):
+    def __init__(self, jid):
+        super(FakeLocalJob, self).__init__(jid)
+        self.state = 'queued'
+
+    def get_state(self):
+        return self.state
+
+    def run(self):
+        self.state = 'running'
+
+    def finish(self, message, state, exit_code):
+        self.state = state
+        self.message = exit_code
+
+    def mark(self, message, exit_code):
+        self.message = message
+
+
+class TestLocalScheduler(object):
+
+    def setup(self):
+        self.path = tempfile.mkdtemp()
+        self.conf = dict((_key, conf[_key]) for _key in
+                         ('local_path_work', 'local_path_queue'))
+        conf.local_path_work = os.path.join(self.path, 'work')
+        conf.local_path_queue = os.path.join(self.path, 'queue')
+        os.mkdir(conf.local_path_queue)
+        self.scheduler = LocalScheduler()
+        self.scheduler.slots = SlotCounter(2)
+
+    def teardown(self):
+        conf.update(self.conf)
+        shutil.rmtree(self.path)
+
+    def submit(self, jid, script):
+        _work_dir = os.path.join(conf.local_path_work, jid)
+        os.makedirs(_work_dir)
+        with open(os.path.join(_work_dir, 'pbs.sh'), 'w') as _f:
+            _f.write('#!/bin/sh\n' + script)
+        os.chmod(os.path.join(_work_dir, 'pbs.sh'), 0o755)
+        _job = FakeLocalJob(jid)
+        ok_(self.scheduler.submit(_job))
+        return _job
+
+    def test_run(self):
+        """
+        LocalScheduler runs jobs as local processes and reports their state
+        :return:
+        """
+        _done = self.submit('j0', 'pwd\nexit 3\n')
+        _stopped = self.submit('j1', 'sleep 30\n')
+        ok_(not self.scheduler.submit(FakeLocalJob('j2')))
+        for _i in range(100):
+            if os.path.exists(os.path.join(conf.local_path_queue, 'j0')):
+                break
+            time.sleep(0.05)
+        self.scheduler.update([_done, _stopped])
+        eq_(_done.state, 'failed')
+        eq_(_done.message, 3)
+        eq_(_stopped.state, 'running')
+        with open(os.path.join(conf.local_path_work, 'j0', 'output.log')) as _f:
+            eq_(_f.read().strip(), os.path.realpath(
+                os.path.join(conf.local_path_work, 'j0')))
+        self.scheduler.stop(_stopped, 'Killed', 1)
+        eq_(_stopped.message, 'Killed')
+        for _i in range(100):
+            if not self.scheduler.is_running(_stopped):
+                break
+            time.sleep(0.05)
+        ok_(not self.scheduler.is_running(_stopped))
+
+
+    def test_finish_race(self):
+        """
+        LocalScheduler reads the exit code of jobs that finish during update
+        :return:
+        """
+        _job = FakeLocalJob('j0')
+        _job.scheduler = FakeResult('')
+        _job.scheduler.id = '0'
+        _exit_file = os.path.join(conf.local_path_queue, 'j0')
+
+        def _is_running(job):
+            # The job finishes after its exit file was read
+            with open(_exit_file, 'w') as _f:
+                _f.write('0\n')
+            return False
+
+        self.scheduler.is_running = _is_running
+        self.scheduler.update([_job])
+        eq_(_job.state, 'done')
+        eq_(_job.message, 0)
+        ok_(not os.path.exists(_exit_file))
+
+
+class TestSchedulerStore(object):
+
+    def setup(self):
+        self.path = tempfile.mkdtemp()
+        self.conf = dict((_key, conf[_key]) for _key in
+                         ('service_schedulers', 'scheduler_classes',
+                          'scheduler_options', 'local_path_work',
+                          'local_path_queue'))
+        conf.local_path_work = os.path.join(self.path, 'work')
+        conf.local_path_queue = os.path.join(self.path, 'queue')
+
+    def teardown(self):
+        conf.update(self.conf)
+        shutil.rmtree(self.path)
+
+    def test_init(self):
+        """
+        SchedulerStore creates built-in and configured scheduler classes
+        :return:
+        """
+        conf.service_schedulers = ('mine', 'fast', 'dummy', 'missing')
+        conf.scheduler_classes = {'fast': 'Schedulers.DummyScheduler',
+                                  'mine': 'Schedulers.LocalScheduler',
+                                  'missing': 'NoSuchModule.Scheduler'}
+        conf.scheduler_options = {
+            'fast': {'max_jobs': 7, 'poll_interval': 10, 'batch_size': 5},
+            'dummy': {'no_such_setting': 1},
+        }
+        _store = SchedulerStore()
+        _store.init()
+        eq_(sorted(_store.keys()), ['fast', 'mine'])
+        ok_(isinstance(_store['mine'], LocalScheduler))
+        # Directories are created for schedulers registered under any name
+        eq_(sorted(os.listdir(self.path)), ['queue', 'work'])
+        _scheduler = _store['fast']
+        ok_(isinstance(_scheduler, DummyScheduler))
+        eq_(_scheduler.name, 'fast')
+        eq_(_scheduler.batch_size, 5)
+        eq_(_scheduler.slots.limit, 7)
+        # Updates are throttled by poll_interval
+        ok_(_scheduler.update_due())
+        ok_(not _scheduler.update_due())
+        ok_(_store['mine'].update_due())
+        ok_(_store['mine'].update_due())
@@ -2,7 +2,7 @@
 
 from Config import conf
 import Globals as G
-from Services import Service, ValidatorError
+from Services import Service, ServiceStore, ValidatorError
 from Jobs import Job
 from nose.tools import eq_, ok_, raises, assert_raises
 import os
@@ -189,3 +189,20 @@ class TestValidator:
         # Service developer messed up variable type and 'hacker' noticed
         assert_raises(ValidatorError, G.VALIDATOR.validate_value, var_name, "Hack payload", template)
 
+
+
+class TestServiceStore:
+    def test_match(self):
+        """
+        ServiceStore.match selects the longest service name prefix
+        :return:
+        """
+        store = ServiceStore()
+        for name in ('test', 'test_long', 'basic'):
+            dict.__setitem__(store, name, None)
+        eq_(store.match('test_long_job'), 'test_long')
+        eq_(store.match('test_job'), 'test')
+        eq_(store.match('unknown_job'), None)
+        store['tes'] = None
+        del store['test']
+        eq_(store.match('test_job'), 'tes')
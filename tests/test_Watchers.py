@@ -0,0 +1,80 @@
+# Test suite for Watchers module
+import os
+import shutil
+import tempfile
+import threading
+
+from Watchers import PollWatcher, InotifyWatcher, create_watcher
+from nose.tools import eq_, ok_
+
+
+class TestInotifyWatcher(object):
+
+    def setup(self):
+        self.path = tempfile.mkdtemp()
+        self.new = os.path.join(self.path, 'new')
+        self.stop = os.path.join(self.path, 'stop')
+        os.mkdir(self.new)
+        os.mkdir(self.stop)
+        # Entry that exists before the watcher is started
+        open(os.path.join(self.new, 'job_0'), 'w').close()
+        self.watcher = create_watcher((self.new, self.stop), 'inotify')
+
+    def teardown(self):
+        self.watcher.stop()
+        shutil.rmtree(self.path)
+
+    def test_initial_scan(self):
+        """
+        InotifyWatcher lists entries present before start
+        :return:
+        """
+        ok_(isinstance(self.watcher, InotifyWatcher), "Inotify not available")
+        eq_(self.watcher.listdir(self.new), ['job_0'])
+        eq_(self.watcher.listdir(self.stop), [])
+
+    def test_create_delete(self):
+        """
+        InotifyWatcher follows created, renamed and removed entries
+        :return:
+        """
+        for _i in range(1, 4):
+            open(os.path.join(self.new, 'job_%s' % _i), 'w').close()
+        os.symlink(os.path.join(self.new, 'job_1'),
+                   os.path.join(self.stop, 'job_1'))
+        os.unlink(os.path.join(self.new, 'job_0'))
+        os.rename(os.path.join(self.new, 'job_2'),
+                  os.path.join(self.path, 'job_2'))
+        eq_(self.watcher.listdir(self.new), ['job_1', 'job_3'])
+        eq_(self.watcher.listdir(self.stop), ['job_1'])
+        eq_(sorted(self.watcher.listdir(self.new)),
+            sorted(os.listdir(self.new)))
+
+    def test_wait(self):
+        """
+        InotifyWatcher.wait returns as soon as a new entry appears
+        :return:
+        """
+        eq_(self.watcher.wait(0.05), False)
+        _timer = threading.Timer(
+            0.05, open, (os.path.join(self.stop, 'job_0'), 'w'))
+        _timer.start()
+        ok_(self.watcher.wait(5), "Woken up by the new entry")
+        _timer.join()
+        eq_(self.watcher.listdir(self.stop), ['job_0'])
+
+
+def test_poll_fallback():
+    """
+    create_watcher falls back to polling for unknown modes
+    :return:
+    """
+    _path = tempfile.mkdtemp()
+    try:
+        _watcher = create_watcher((_path,), 'unknown')
+        ok_(isinstance(_watcher, PollWatcher))
+        ok_(not isinstance(_watcher, InotifyWatcher))
+        open(os.path.join(_path, 'job_0'), 'w').close()
+        eq_(_watcher.listdir(_path), ['job_0'])
+    finally:
+        shutil.rmtree(_path)